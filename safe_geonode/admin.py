@@ -1,13 +1,55 @@
 from django.contrib import admin
-from safe_geonode.models import Calculation, Server, Workspace
+from safe_geonode.models import Calculation, CalculationJob
+from safe_geonode.models import Server, Workspace, LayerMetadata
+from safe_geonode.models import PerformanceProfile
+from safe_geonode.models import CALCULATION_STAGES
+from django.core.urlresolvers import reverse
 
 
 class CalculationAdmin(admin.ModelAdmin):
     date_hierarchy = 'run_date'
-    list_filter = 'user', 'impact_function', 'success'
-    list_display = ('run_date', 'success', 'user', 'errors',
+    list_filter = 'user', 'impact_function', 'success', 'status'
+    list_display = ('run_date', 'status', 'success', 'user', 'errors',
                     'run_duration', 'layer', 'exposure_layer',
-                    'hazard_layer', 'impact_function')
+                    'hazard_layer', 'impact_function', 'resolution',
+                    'stage_timings', 'bytes_downloaded', 'features',
+                    'pixels', 'peak_rss')
+
+    def stage_timings(self, calculation):
+        timings = calculation.get_timings()
+        return ', '.join('%s %.2fs' % (stage, timings[stage])
+                         for stage in CALCULATION_STAGES if stage in timings)
+    stage_timings.short_description = 'Timings'
+
+
+class CalculationJobAdmin(admin.ModelAdmin):
+    list_filter = 'done', 'worker'
+    list_display = ('calculation', 'created', 'done', 'worker',
+                    'heartbeat', 'attempts')
+
+
+class LayerMetadataAdmin(admin.ModelAdmin):
+    list_filter = 'server_url', 'layertype', 'category'
+    list_display = ('name', 'title', 'server_url', 'layertype', 'category',
+                    'synced')
+    search_fields = 'name', 'title'
+
+class PerformanceProfileAdmin(admin.ModelAdmin):
+    date_hierarchy = 'created'
+    list_filter = 'name',
+    list_display = ('created', 'name', 'duration', 'calculation', 'path',
+                    'download')
+    exclude = 'stats',
+
+    def download(self, profile):
+        url = reverse('safe-profile', args=[profile.id])
+        return ('<a href="%s">pstats</a> <a href="%s?format=collapsed">'
+                'collapsed</a> <a href="%s?format=text">text</a>' %
+                (url, url, url))
+    download.allow_tags = True
 
 admin.site.register(Calculation, CalculationAdmin)
+admin.site.register(CalculationJob, CalculationJobAdmin)
+admin.site.register(LayerMetadata, LayerMetadataAdmin)
+admin.site.register(PerformanceProfile, PerformanceProfileAdmin)
 admin.site.register([Server, Workspace])
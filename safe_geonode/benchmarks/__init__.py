@@ -0,0 +1,10 @@
+"""Benchmarks for safe_geonode
+
+   Benchmarks are plain modules run with a configured GeoNode, e.g.
+
+   DJANGO_SETTINGS_MODULE=geonode.settings \
+       python -m safe_geonode.benchmarks.roundtrips ...
+
+   and print their results as JSON so they can be compared between
+   releases.
+"""
@@ -0,0 +1,520 @@
+"""Local stand-in for a GeoServer serving synthetic layers
+
+   Serves the subset of WCS 1.0.0 and WFS 1.0.0 used by safe_geonode:
+   GetCapabilities, DescribeCoverage, GetCoverage as GeoTIFF, GetFeature
+   as SHAPE-ZIP and feature counts with resultType=hits. Each layer is
+   also published as a virtual service at <root>/<workspace>/<name>/ows
+   like GeoServer does. Data is generated from a seed, so runs with the
+   same configuration see the same bytes. A fixed latency can be added
+   to every response to mimic a remote server.
+
+   Usage:
+       server = StandInServer([SyntheticRaster('bench:hazard', 1000, 1000),
+                               SyntheticVector('bench:exposure', 5000)],
+                              latency=0.05)
+       server.start()
+       get_metadata(server.url, 'bench:hazard')
+       server.stop()
+"""
+
+import os
+import sys
+import time
+import socket
+import shutil
+import urlparse
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from zipfile import ZipFile, ZIP_DEFLATED
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy
+
+from osgeo import gdal, ogr, osr
+
+# Area covered by synthetic layers unless given
+DEFAULT_BBOX = [106.0, -7.0, 108.0, -6.0]
+
+NODATA = -9999.0
+
+WCS_NAMESPACES = ('xmlns="http://www.opengis.net/wcs" '
+                  'xmlns:gml="http://www.opengis.net/gml" '
+                  'xmlns:xlink="http://www.w3.org/1999/xlink"')
+
+WFS_NAMESPACES = ('xmlns="http://www.opengis.net/wfs" '
+                  'xmlns:ogc="http://www.opengis.net/ogc"')
+
+
+def wgs84_wkt():
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    return srs.ExportToWkt()
+
+
+class SyntheticRaster(object):
+    """Raster layer with a smooth random field
+
+    Input
+        name: Layer name of the form workspace:name
+        rows, cols: Size of the native grid in pixels
+        bbox: Area covered [W, S, E, N]
+        keywords: Dictionary of keywords, a hazard by default
+        seed: Seed of the random field
+    """
+
+    layertype = 'raster'
+
+    def __init__(self, name, rows, cols, bbox=DEFAULT_BBOX, keywords=None,
+                 seed=0):
+        self.name = name
+        self.rows = rows
+        self.cols = cols
+        self.bbox = list(bbox)
+        if keywords is None:
+            keywords = {'category': 'hazard', 'subcategory': 'earthquake',
+                        'unit': 'MMI'}
+        self.keywords = keywords
+
+        # Sum of a few waves and some noise, values between 1 and 10
+        random = numpy.random.RandomState(seed)
+        y, x = numpy.mgrid[0:1:rows * 1j, 0:1:cols * 1j]
+        field = numpy.zeros((rows, cols))
+        for i in range(4):
+            fx, fy, phase = random.uniform(1, 6, 3)
+            field += numpy.sin(2 * numpy.pi * (fx * x + fy * y) + phase)
+        field += random.normal(0, 0.1, (rows, cols))
+        low, high = field.min(), field.max()
+        self.data = (1 + 9 * (field - low) / (high - low)).astype('float32')
+
+    @property
+    def resolution(self):
+        west, south, east, north = self.bbox
+        return (east - west) / self.cols, (north - south) / self.rows
+
+    def render(self, bbox, width, height):
+        """Get GeoTIFF of the area bbox sampled on a width x height grid
+
+        Pixels are sampled with nearest neighbour, pixels outside the
+        layer are nodata.
+        """
+
+        west, south, east, north = bbox
+        resx = (east - west) / width
+        resy = (north - south) / height
+        src_resx, src_resy = self.resolution
+
+        # Source pixel containing the centre of every target pixel
+        x = west + (numpy.arange(width) + 0.5) * resx
+        y = north - (numpy.arange(height) + 0.5) * resy
+        cols = numpy.floor((x - self.bbox[0]) / src_resx).astype(int)
+        rows = numpy.floor((self.bbox[3] - y) / src_resy).astype(int)
+        valid_cols = (cols >= 0) & (cols < self.cols)
+        valid_rows = (rows >= 0) & (rows < self.rows)
+
+        data = self.data[numpy.clip(rows, 0, self.rows - 1)][:,
+                         numpy.clip(cols, 0, self.cols - 1)]
+        data[~valid_rows, :] = NODATA
+        data[:, ~valid_cols] = NODATA
+
+        dirname = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(dirname, 'coverage.tif')
+            driver = gdal.GetDriverByName('GTiff')
+            dst = driver.Create(filename, width, height, 1,
+                                gdal.GDT_Float32)
+            dst.SetGeoTransform((west, resx, 0.0, north, 0.0, -resy))
+            dst.SetProjection(wgs84_wkt())
+            band = dst.GetRasterBand(1)
+            band.SetNoDataValue(NODATA)
+            band.WriteArray(data)
+            band = None
+            dst = None
+
+            with open(filename, 'rb') as fid:
+                return fid.read()
+        finally:
+            shutil.rmtree(dirname, ignore_errors=True)
+
+
+class SyntheticVector(object):
+    """Vector layer of randomly placed buildings
+
+    Input
+        name: Layer name of the form workspace:name
+        features: Number of features
+        bbox: Area covered [W, S, E, N]
+        keywords: Dictionary of keywords, exposure by default
+        geometry: point or polygon, polygons are small squares
+        seed: Seed of the random placement
+    """
+
+    layertype = 'vector'
+
+    def __init__(self, name, features, bbox=DEFAULT_BBOX, keywords=None,
+                 geometry='polygon', seed=0):
+        self.name = name
+        self.features = features
+        self.bbox = list(bbox)
+        if keywords is None:
+            keywords = {'category': 'exposure', 'subcategory': 'structure',
+                        'datatype': 'osm'}
+        self.keywords = keywords
+        self.geometry = geometry
+
+        random = numpy.random.RandomState(seed)
+        west, south, east, north = self.bbox
+        self.x = random.uniform(west, east, features)
+        self.y = random.uniform(south, north, features)
+        self.floors = random.randint(1, 5, features)
+        self.types = numpy.array(['residential', 'school', 'hospital',
+                                  'commercial'])[random.randint(0, 4,
+                                                                features)]
+
+        # Side of squares in degrees, roughly 10 metres
+        self.size = 1.0e-4
+
+    def select(self, bbox):
+        """Get indices of features within bbox
+        """
+
+        west, south, east, north = bbox
+        inside = ((self.x >= west) & (self.x <= east) &
+                  (self.y >= south) & (self.y <= north))
+        return numpy.nonzero(inside)[0]
+
+    def render(self, bbox):
+        """Get zipped shapefile of the features within bbox
+        """
+
+        indices = self.select(bbox)
+        basename = self.name.split(':')[-1]
+
+        dirname = tempfile.mkdtemp()
+        try:
+            shpname = os.path.join(dirname, basename + '.shp')
+            driver = ogr.GetDriverByName('ESRI Shapefile')
+            datasource = driver.CreateDataSource(shpname)
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(4326)
+            if self.geometry == 'point':
+                geometry_type = ogr.wkbPoint
+            else:
+                geometry_type = ogr.wkbPolygon
+            layer = datasource.CreateLayer(basename, srs, geometry_type)
+
+            field = ogr.FieldDefn('TYPE', ogr.OFTString)
+            field.SetWidth(16)
+            layer.CreateField(field)
+            layer.CreateField(ogr.FieldDefn('FLOORS', ogr.OFTInteger))
+
+            definition = layer.GetLayerDefn()
+            half = self.size / 2
+            for i in indices:
+                x, y = self.x[i], self.y[i]
+                if self.geometry == 'point':
+                    wkt = 'POINT (%r %r)' % (x, y)
+                else:
+                    wkt = ('POLYGON ((%r %r, %r %r, %r %r, %r %r, %r %r))'
+                           % (x - half, y - half, x + half, y - half,
+                              x + half, y + half, x - half, y + half,
+                              x - half, y - half))
+                feature = ogr.Feature(definition)
+                feature.SetField('TYPE', str(self.types[i]))
+                feature.SetField('FLOORS', int(self.floors[i]))
+                feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+                layer.CreateFeature(feature)
+                feature = None
+            datasource = None
+
+            zipname = os.path.join(dirname, basename + '.zip')
+            zf = ZipFile(zipname, 'w', ZIP_DEFLATED)
+            for ext in ['.shp', '.shx', '.dbf', '.prj']:
+                filename = os.path.join(dirname, basename + ext)
+                if os.path.exists(filename):
+                    zf.write(filename, basename + ext)
+            zf.close()
+
+            with open(zipname, 'rb') as fid:
+                return fid.read()
+        finally:
+            shutil.rmtree(dirname, ignore_errors=True)
+
+
+def format_keywords(keywords):
+    return ','.join('%s:%s' % (key, value)
+                    for key, value in sorted(keywords.items()))
+
+
+def wcs_capabilities(url, layers):
+    """Get WCS 1.0.0 capabilities document listing layers
+    """
+
+    operations = ''.join(
+        '<%s><DCPType><HTTP><Get><OnlineResource xlink:href=%s/>'
+        '</Get></HTTP></DCPType></%s>' % (operation, quoteattr(url),
+                                          operation)
+        for operation in ['GetCapabilities', 'DescribeCoverage',
+                          'GetCoverage'])
+
+    offerings = ''.join(
+        '<CoverageOfferingBrief><name>%s</name><label>%s</label>'
+        '<lonLatEnvelope srsName="urn:ogc:def:crs:OGC:1.3:CRS84">'
+        '<gml:pos>%r %r</gml:pos><gml:pos>%r %r</gml:pos></lonLatEnvelope>'
+        '<keywords><keyword>%s</keyword></keywords>'
+        '</CoverageOfferingBrief>' % (escape(layer.name),
+                                      escape(layer.name.split(':')[-1]),
+                                      layer.bbox[0], layer.bbox[1],
+                                      layer.bbox[2], layer.bbox[3],
+                                      escape(format_keywords(layer.keywords)))
+        for layer in layers)
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<WCS_Capabilities version="1.0.0" %s>'
+            '<Service><name>WCS</name><label>Stand-in WCS</label>'
+            '<responsibleParty><organisationName>safe_geonode'
+            '</organisationName></responsibleParty>'
+            '<fees>NONE</fees><accessConstraints>NONE</accessConstraints>'
+            '</Service>'
+            '<Capability><Request>%s</Request>'
+            '<Exception><Format>application/vnd.ogc.se_xml</Format>'
+            '</Exception></Capability>'
+            '<ContentMetadata>%s</ContentMetadata>'
+            '</WCS_Capabilities>' % (WCS_NAMESPACES, operations, offerings))
+
+
+def wcs_describe_coverage(layer):
+    """Get WCS 1.0.0 DescribeCoverage document of a raster layer
+    """
+
+    west, south, east, north = layer.bbox
+    resx, resy = layer.resolution
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<CoverageDescription version="1.0.0" %s>'
+            '<CoverageOffering><name>%s</name><label>%s</label>'
+            '<domainSet><spatialDomain>'
+            '<gml:Envelope srsName="EPSG:4326">'
+            '<gml:pos>%r %r</gml:pos><gml:pos>%r %r</gml:pos>'
+            '</gml:Envelope>'
+            '<gml:RectifiedGrid dimension="2" srsName="EPSG:4326">'
+            '<gml:limits><gml:GridEnvelope><gml:low>0 0</gml:low>'
+            '<gml:high>%i %i</gml:high></gml:GridEnvelope></gml:limits>'
+            '<gml:axisName>x</gml:axisName><gml:axisName>y</gml:axisName>'
+            '<gml:origin><gml:pos>%r %r</gml:pos></gml:origin>'
+            '<gml:offsetVector>%r 0.0</gml:offsetVector>'
+            '<gml:offsetVector>0.0 %r</gml:offsetVector>'
+            '</gml:RectifiedGrid></spatialDomain></domainSet>'
+            '</CoverageOffering></CoverageDescription>'
+            % (WCS_NAMESPACES, escape(layer.name),
+               escape(layer.name.split(':')[-1]), west, south, east, north,
+               layer.cols - 1, layer.rows - 1, west + resx / 2,
+               north - resy / 2, resx, -resy))
+
+
+def wfs_capabilities(url, layers):
+    """Get WFS 1.0.0 capabilities document listing layers
+    """
+
+    operations = ''.join(
+        '<%s><DCPType><HTTP><Get onlineResource=%s/></HTTP></DCPType></%s>'
+        % (operation, quoteattr(url), operation)
+        for operation in ['GetCapabilities', 'DescribeFeatureType',
+                          'GetFeature'])
+
+    feature_types = ''.join(
+        '<FeatureType><Name>%s</Name><Title>%s</Title><Abstract/>'
+        '<Keywords>%s</Keywords><SRS>EPSG:4326</SRS>'
+        '<LatLongBoundingBox minx="%r" miny="%r" maxx="%r" maxy="%r"/>'
+        '</FeatureType>' % (escape(layer.name),
+                            escape(layer.name.split(':')[-1]),
+                            escape(format_keywords(layer.keywords)),
+                            layer.bbox[0], layer.bbox[1],
+                            layer.bbox[2], layer.bbox[3])
+        for layer in layers)
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<WFS_Capabilities version="1.0.0" %s>'
+            '<Service><Name>WFS</Name><Title>Stand-in WFS</Title>'
+            '<Abstract/><Keywords/><OnlineResource>%s</OnlineResource>'
+            '<Fees>NONE</Fees><AccessConstraints>NONE</AccessConstraints>'
+            '</Service>'
+            '<Capability><Request>%s</Request></Capability>'
+            '<FeatureTypeList><Operations><Query/></Operations>%s'
+            '</FeatureTypeList></WFS_Capabilities>'
+            % (WFS_NAMESPACES, escape(url), operations, feature_types))
+
+
+def wfs_hits(count):
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<wfs:FeatureCollection xmlns:wfs="http://www.opengis.net/wfs" '
+            'numberOfFeatures="%i" timeStamp="%s"/>'
+            % (count, time.strftime('%Y-%m-%dT%H:%M:%S')))
+
+
+def service_exception(message):
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<ServiceExceptionReport version="1.2.0" '
+            'xmlns="http://www.opengis.net/ogc">'
+            '<ServiceException>%s</ServiceException>'
+            '</ServiceExceptionReport>' % escape(message))
+
+
+def parse_bbox(value):
+    """Get [W, S, E, N] from a bbox parameter, ignoring a trailing crs
+    """
+
+    return [float(x) for x in value.split(',')[:4]]
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer OWS requests for the layers of self.server.stand_in
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        stand_in = self.server.stand_in
+        if stand_in.latency:
+            time.sleep(stand_in.latency)
+
+        parts = urlparse.urlsplit(self.path)
+        params = dict((key.lower(), value) for key, value
+                      in urlparse.parse_qsl(parts.query))
+
+        # Global service or virtual service of one layer
+        segments = [s for s in parts.path.split('/') if s]
+        if segments == [stand_in.root, 'ows']:
+            url = stand_in.url
+            layers = stand_in.layers.values()
+        elif (stand_in.virtual_services and
+              len(segments) == 4 and segments[0] == stand_in.root and
+              segments[3] == 'ows' and
+              '%s:%s' % tuple(segments[1:3]) in stand_in.layers):
+            url = stand_in.url[:-4] + '/%s/%s/ows' % tuple(segments[1:3])
+            layers = [stand_in.layers['%s:%s' % tuple(segments[1:3])]]
+        else:
+            return self.respond(404, 'text/plain', 'Not found')
+
+        stand_in.requests += 1
+        try:
+            self.answer(url, layers, params)
+        except Exception, e:
+            self.respond(200, 'application/vnd.ogc.se_xml',
+                         service_exception(str(e)))
+
+    def answer(self, url, layers, params):
+        service = params.get('service', '').lower()
+        request = params.get('request', '').lower()
+        by_name = dict((layer.name, layer) for layer in layers)
+
+        if not request:
+            # Reachability checks request the bare service url
+            return self.respond(200, 'text/plain', 'Stand-in OWS server')
+
+        if request == 'getcapabilities':
+            if service == 'wcs':
+                rasters = [l for l in layers if l.layertype == 'raster']
+                content = wcs_capabilities(url, rasters)
+            elif service == 'wfs':
+                vectors = [l for l in layers if l.layertype == 'vector']
+                content = wfs_capabilities(url, vectors)
+            else:
+                raise Exception('Unknown service %s' % service)
+            return self.respond(200, 'application/vnd.ogc.wcs_xml', content)
+
+        if request == 'describecoverage':
+            layer = by_name[params['coverage']]
+            return self.respond(200, 'application/xml',
+                                wcs_describe_coverage(layer))
+
+        if request == 'getcoverage':
+            layer = by_name[params['coverage']]
+            bbox = parse_bbox(params['bbox'])
+            if 'width' in params:
+                width = int(params['width'])
+                height = int(params['height'])
+            else:
+                width = max(1, int(round((bbox[2] - bbox[0]) /
+                                         float(params['resx']))))
+                height = max(1, int(round((bbox[3] - bbox[1]) /
+                                          float(params['resy']))))
+            return self.respond(200, 'image/tiff',
+                                layer.render(bbox, width, height))
+
+        if request == 'getfeature':
+            layer = by_name[params['typename']]
+            if 'bbox' in params:
+                bbox = parse_bbox(params['bbox'])
+            else:
+                bbox = layer.bbox
+            if params.get('resulttype') == 'hits':
+                return self.respond(200, 'text/xml',
+                                    wfs_hits(len(layer.select(bbox))))
+            return self.respond(200, 'application/zip', layer.render(bbox))
+
+        raise Exception('Unknown request %s' % request)
+
+    def respond(self, status, content_type, content):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients may close kept alive connections at any time
+        if not issubclass(sys.exc_info()[0], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+
+class StandInServer(object):
+    """OWS server for synthetic layers running in a background thread
+
+    Input
+        layers: List of SyntheticRaster and SyntheticVector
+        latency: Seconds added to every response
+        port: Port to listen on, a free one is chosen if 0
+        root: First path segment, the service is at /<root>/ows
+        virtual_services: Whether layers are also published as virtual
+                          services, like GeoServer does
+    """
+
+    def __init__(self, layers, latency=0.0, port=0, root='geoserver',
+                 virtual_services=True):
+        self.layers = dict((layer.name, layer) for layer in layers)
+        self.latency = latency
+        self.root = root
+        self.virtual_services = virtual_services
+        self.requests = 0
+        self._server = ThreadingHTTPServer(('127.0.0.1', port),
+                                           RequestHandler)
+        self._server.stand_in = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://%s:%i/%s/ows' % (host, port, self.root)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='stand-in-ows')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,315 @@
+"""Measure how the questions view scales with the size of the catalog
+
+   Usage:
+       DJANGO_SETTINGS_MODULE=geonode.settings \
+           python -m safe_geonode.benchmarks.questionsbench [options]
+
+   Synthetic catalogs of --sizes layers are built with hazards and
+   exposures of varied keyword signatures and bounding boxes spread over
+   Indonesia. Questions are looked up in a synthetic registry of
+   --plugins impact functions, each admitting one combination of hazard
+   and exposure keywords, so neither GeoServer nor the impact functions
+   of safe are consulted.
+
+   For each size the output of the questions view is built --repeats
+   times by get_questions and serialised as the view does. Each size runs
+   in a fresh process, so the peak memory it reports is its own.
+
+   Results are printed as JSON with the seconds, peak memory growth,
+   response bytes and number of questions for each size, and the exponent
+   of a power law fitted to each of them: 1 means linear growth, 2 means
+   quadratic growth with the size of the catalog.
+"""
+
+import sys
+import json
+import time
+import random
+import platform
+import datetime
+import multiprocessing
+
+from optparse import OptionParser
+
+import numpy
+
+import safe_geonode
+
+from safe_geonode.views import get_questions
+from safe_geonode.utilities import get_peak_rss
+
+SIZES = [10, 50, 100, 500, 1000, 2000, 5000]
+
+# Area layers are spread over [W, S, E, N]
+AREA = [95.0, -11.0, 141.0, 6.0]
+
+# Hazard subcategories with their units
+HAZARDS = {'earthquake': ['MMI'],
+           'flood': ['m', 'wetdry'],
+           'tsunami': ['m'],
+           'volcano': ['kg2/m2', 'normalised'],
+           'landslide': ['normalised'],
+           'drought': ['normalised']}
+
+# Exposure subcategories with their datatypes
+EXPOSURES = {'population': ['density', 'count'],
+             'structure': ['osm', 'itb', 'sigab'],
+             'road': ['osm'],
+             'landcover': ['ogr']}
+
+LAYERTYPES = ['raster', 'vector']
+
+# Fraction of layers without category, like administrative boundaries
+UNCATEGORISED = 0.05
+
+
+def synthetic_layers(count, hazard_fraction=0.3, seed=0):
+    """Generate layer metadata as returned by get_metadata
+
+    Input
+        count: Number of layers
+        hazard_fraction: Fraction of categorised layers that are hazards
+        seed: Seed of the random choices
+
+    Output
+        Dictionary of layer metadata by layer name
+    """
+
+    rng = random.Random(seed)
+    layers = {}
+    for i in range(count):
+        name = 'bench:layer%05i' % i
+        keywords = {'title': 'Synthetic layer %i' % i,
+                    'source': 'safe_geonode benchmark'}
+
+        draw = rng.random()
+        if draw < UNCATEGORISED:
+            pass
+        elif draw < UNCATEGORISED + hazard_fraction * (1 - UNCATEGORISED):
+            subcategory = rng.choice(sorted(HAZARDS))
+            keywords.update({'category': 'hazard',
+                             'subcategory': subcategory,
+                             'unit': rng.choice(HAZARDS[subcategory])})
+        else:
+            subcategory = rng.choice(sorted(EXPOSURES))
+            keywords.update({'category': 'exposure',
+                             'subcategory': subcategory,
+                             'datatype': rng.choice(EXPOSURES[subcategory])})
+
+        # Boxes between a city and a province in size
+        width = rng.uniform(0.2, 5.0)
+        height = rng.uniform(0.2, 5.0)
+        west = rng.uniform(AREA[0], AREA[2] - width)
+        south = rng.uniform(AREA[1], AREA[3] - height)
+        bbox = [west, south, west + width, south + height]
+
+        layertype = rng.choice(LAYERTYPES)
+        if layertype == 'raster':
+            resolution = rng.choice([0.00833333, 0.025, 0.1])
+            keywords['resolution'] = resolution
+            geotransform = (west, resolution, 0.0,
+                            south + height, 0.0, -resolution)
+            resolution = (resolution, resolution)
+        else:
+            resolution = None
+            geotransform = None
+
+        layers[name] = {'layertype': layertype,
+                        'bounding_box': bbox,
+                        'resolution': resolution,
+                        'geotransform': geotransform,
+                        'title': keywords['title'],
+                        'id': name,
+                        'keywords': keywords}
+
+    return layers
+
+
+def synthetic_plugins(count, seed=0):
+    """Generate a registry of impact functions
+
+    Input
+        count: Number of impact functions
+        seed: Seed of the random choices
+
+    Output
+        Dictionary of classes by name. Each class has the attributes of
+        an impact function shown by the questions view and requirements,
+        a list of hazard and exposure keywords it admits.
+    """
+
+    rng = random.Random(seed)
+    plugins = {}
+    for i in range(count):
+        hazard = rng.choice(sorted(HAZARDS))
+        exposure = rng.choice(sorted(EXPOSURES))
+        hazard_keywords = {'category': 'hazard', 'subcategory': hazard,
+                           'layertype': rng.choice(LAYERTYPES)}
+        exposure_keywords = {'category': 'exposure',
+                             'subcategory': exposure,
+                             'layertype': rng.choice(LAYERTYPES)}
+
+        # Some functions only work for a particular unit or datatype
+        if rng.random() < 0.5:
+            hazard_keywords['unit'] = rng.choice(HAZARDS[hazard])
+        if rng.random() < 0.5:
+            exposure_keywords['datatype'] = rng.choice(EXPOSURES[exposure])
+
+        name = '%s %s Impact Function %i' % (hazard.title(),
+                                             exposure.title(), i)
+        plugins[name] = type('SyntheticFunction%i' % i, (object,), {
+            '__doc__': 'Impact of %s on %s' % (hazard, exposure),
+            'title': 'Estimate %s affected by %s' % (exposure, hazard),
+            'author': 'safe_geonode benchmark',
+            'rating': rng.randint(1, 4),
+            'requirements': [hazard_keywords, exposure_keywords]})
+
+    return plugins
+
+
+def make_lookup(plugins):
+    """Get function finding the admissible plugins for keywords
+
+    Works like get_admissible_plugins: every plugin is checked against
+    the keyword dictionaries in turn.
+    """
+
+    def lookup(keywords):
+        admissible = {}
+        for name, plugin in plugins.items():
+            for required, given in zip(plugin.requirements, keywords):
+                if any(given.get(key) != value
+                       for key, value in required.items()):
+                    break
+            else:
+                admissible[name] = plugin
+        return admissible
+
+    return lookup
+
+
+def measure_size(size, plugin_count, repeats, hazard_fraction, seed, bbox):
+    """Build the questions output for a synthetic catalog of size layers
+
+    Output
+        Dictionary with min and median seconds, growth of peak memory
+        in bytes, bytes of the response and number of layers, hazards,
+        exposures and questions
+    """
+
+    layers = synthetic_layers(size, hazard_fraction=hazard_fraction,
+                              seed=seed)
+    plugins = synthetic_plugins(plugin_count, seed=seed)
+    lookup = make_lookup(plugins)
+
+    peak_before = get_peak_rss()
+    timings = []
+    for i in range(repeats):
+        start = time.time()
+        output = get_questions(layers, plugins, plugin_lookup=lookup,
+                               bbox=bbox)
+        jsondata = json.dumps(output)
+        timings.append(time.time() - start)
+    peak = get_peak_rss() - peak_before
+
+    categories = [params['keywords'].get('category')
+                  for params in output['layers'].values()]
+    timings.sort()
+    return {'layers': size,
+            'hazards': categories.count('hazard'),
+            'exposures': categories.count('exposure'),
+            'questions': len(output['questions']),
+            'bytes': len(jsondata),
+            'peak_memory': peak,
+            'min': timings[0],
+            'median': timings[len(timings) // 2]}
+
+
+def fit_exponent(sizes, values):
+    """Fit values = a * sizes ** k and return k
+
+    Sizes with zero values are left out, None is returned if fewer than
+    two remain.
+    """
+
+    points = [(size, value) for size, value in zip(sizes, values)
+              if value > 0]
+    if len(points) < 2:
+        return None
+
+    x, y = zip(*points)
+    slope, intercept = numpy.polyfit(numpy.log(x), numpy.log(y), 1)
+    return float(slope)
+
+
+def run(sizes=SIZES, plugins=50, repeats=3, hazard_fraction=0.3, seed=0,
+        bbox=None):
+    """Measure all sizes and return dictionary of results
+
+    Each size is measured in a process of its own.
+    """
+
+    results = []
+    for size in sizes:
+        pool = multiprocessing.Pool(1)
+        try:
+            results.append(pool.apply(measure_size,
+                                      (size, plugins, repeats,
+                                       hazard_fraction, seed, bbox)))
+        finally:
+            pool.close()
+            pool.join()
+
+    sizes = [result['layers'] for result in results]
+    scaling = {}
+    for name, key in [('seconds', 'min'), ('peak_memory', 'peak_memory'),
+                      ('bytes', 'bytes'), ('questions', 'questions')]:
+        scaling[name] = fit_exponent(sizes, [result[key]
+                                             for result in results])
+
+    return {'sizes': results, 'exponents': scaling}
+
+
+def main(argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default=','.join(str(s) for s in SIZES),
+                      help='Comma separated numbers of layers')
+    parser.add_option('--plugins', type='int', default=50,
+                      help='Number of synthetic impact functions')
+    parser.add_option('--repeats', type='int', default=3,
+                      help='Number of runs for each size')
+    parser.add_option('--hazard-fraction', type='float', default=0.3,
+                      help='Fraction of layers that are hazards')
+    parser.add_option('--seed', type='int', default=0,
+                      help='Seed of the synthetic catalog and functions')
+    parser.add_option('--bbox', default=None,
+                      help='Area of interest W,S,E,N as sent by safe.js')
+    parser.add_option('--output', default=None,
+                      help='Write results to this file instead of stdout')
+    options, args = parser.parse_args(argv)
+
+    bbox = None
+    if options.bbox is not None:
+        bbox = [float(x) for x in options.bbox.split(',')]
+
+    config = dict(sizes=[int(s) for s in options.sizes.split(',')],
+                  plugins=options.plugins, repeats=options.repeats,
+                  hazard_fraction=options.hazard_fraction,
+                  seed=options.seed, bbox=bbox)
+    output = {'benchmark': 'questions',
+              'version': safe_geonode.get_version(),
+              'python': platform.python_version(),
+              'date': datetime.datetime.now().isoformat(),
+              'config': config}
+    output.update(run(**config))
+
+    jsondata = json.dumps(output, indent=2, sort_keys=True)
+    if options.output is None:
+        print jsondata
+    else:
+        with open(options.output, 'w') as fid:
+            fid.write(jsondata)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+"""Count OWS round trips made when downloading the layers of a calculation
+
+   Usage:
+       python -m safe_geonode.benchmarks.roundtrips hazard_server hazard \
+           exposure_server exposure bbox
+
+   Two ways of downloading the hazard and exposure layers are compared,
+   both with cold caches and the download cache disabled:
+
+   standalone: download() resolves metadata and checks the server itself,
+               as it does when called without metadata.
+   calculate: Metadata is resolved once per layer and handed to download()
+              the way views.calculate does it.
+"""
+
+import sys
+import time
+import json
+
+from safe_geonode import storage
+from safe_geonode import httpclient
+from safe_geonode.utilities import get_common_resolution
+from safe_geonode.utilities import get_bounding_boxes
+
+
+def reset():
+    """Empty all caches and request counters
+    """
+
+    storage.invalidate_metadata()
+    storage.REACHABLE_SERVERS.invalidate()
+    httpclient.POOL.requests.clear()
+
+
+def count_requests():
+    return sum(httpclient.POOL.requests.values())
+
+
+def standalone(layers, bbox):
+    """Download layers without passing metadata
+    """
+
+    haz_metadata = storage.get_metadata(*layers[0])
+    exp_metadata = storage.get_metadata(*layers[1])
+    resolution = get_common_resolution(haz_metadata, exp_metadata)
+    bboxes = get_bounding_boxes(haz_metadata, exp_metadata, bbox)
+
+    # Forget what calculate would have learned
+    storage.invalidate_metadata()
+    storage.REACHABLE_SERVERS.invalidate()
+
+    for (server, layer_name), layer_bbox in zip(layers, bboxes):
+        storage.download(server, layer_name, layer_bbox, resolution)
+
+
+def calculate(layers, bbox):
+    """Download layers the way views.calculate does
+    """
+
+    haz_metadata = storage.get_metadata(*layers[0])
+    exp_metadata = storage.get_metadata(*layers[1])
+    resolution = get_common_resolution(haz_metadata, exp_metadata)
+    bboxes = get_bounding_boxes(haz_metadata, exp_metadata, bbox)
+
+    for (server, layer_name), layer_bbox, metadata in zip(
+                        layers, bboxes, [haz_metadata, exp_metadata]):
+        storage.download(server, layer_name, layer_bbox, resolution,
+                         metadata=metadata)
+
+
+def run(layers, bbox, repeats=3):
+    """Run both scenarios and return dictionary of results
+    """
+
+    download_cache = storage.DOWNLOAD_CACHE
+    storage.DOWNLOAD_CACHE = None
+
+    results = {}
+    try:
+        for scenario in [standalone, calculate]:
+            timings = []
+            for i in range(repeats):
+                reset()
+                start = time.time()
+                scenario(layers, bbox)
+                timings.append(time.time() - start)
+
+            results[scenario.__name__] = {'requests': count_requests(),
+                                          'seconds': min(timings)}
+    finally:
+        storage.DOWNLOAD_CACHE = download_cache
+
+    results['saved_requests'] = (results['standalone']['requests'] -
+                                 results['calculate']['requests'])
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 6:
+        print __doc__
+        sys.exit(1)
+
+    hazard_server, hazard, exposure_server, exposure, bbox = sys.argv[1:]
+    layers = [(hazard_server, hazard), (exposure_server, exposure)]
+    print json.dumps(run(layers, bbox), indent=2)
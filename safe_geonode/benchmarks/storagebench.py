@@ -0,0 +1,223 @@
+"""Time the storage layer against a local stand-in OWS server
+
+   Usage:
+       DJANGO_SETTINGS_MODULE=geonode.settings \
+           python -m safe_geonode.benchmarks.storagebench [options]
+
+   A StandInServer serving one synthetic raster and one synthetic vector
+   layer is started, so no GeoServer or test data is needed. Only the
+   upload benchmark, enabled with --upload, needs the GeoNode and
+   GeoServer configured in the settings.
+
+   Benchmarks:
+
+   get_metadata_server: Metadata of all layers with cold caches
+   get_metadata_raster, get_metadata_vector: Metadata of one layer
+       through its virtual service with cold caches
+   get_metadata_cached: Metadata of one layer from the in memory cache
+   download_raster, download_vector: Layers downloaded at their native
+       resolution the way calculate does, with the download cache disabled
+   download_cached: Raster downloaded again from the download cache
+   get_file: Plain transfer of the whole raster as GeoTIFF
+   save_to_geonode: Upload of the downloaded raster, with --upload
+
+   Each benchmark runs --repeats times. Results are printed as JSON with
+   the minimum, median and maximum seconds, the OWS requests made per run
+   and, for transfers, the bytes received, so they can be compared
+   between releases.
+"""
+
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import datetime
+
+from optparse import OptionParser
+
+import safe_geonode
+
+from safe_geonode import storage
+from safe_geonode.cache import DownloadCache
+from safe_geonode.models import LayerMetadata, CatalogSync
+from safe_geonode.scratch import SCRATCH
+from safe_geonode.utilities import WCS_TEMPLATE, bboxlist2string
+from safe_geonode.benchmarks.owsserver import StandInServer
+from safe_geonode.benchmarks.owsserver import SyntheticRaster
+from safe_geonode.benchmarks.owsserver import SyntheticVector
+
+RASTER = 'bench:hazard'
+VECTOR = 'bench:exposure'
+
+
+def reset(server_url):
+    """Forget everything cached about the layers of server_url
+    """
+
+    storage.invalidate_metadata()
+    storage.REACHABLE_SERVERS.invalidate()
+    LayerMetadata.objects.filter(server_url=server_url).delete()
+    CatalogSync.objects.filter(server_url=server_url).delete()
+
+
+def measure(server, function, repeats, setup=None):
+    """Time function repeats times, calling setup untimed before each run
+
+    Output
+        Dictionary with min, median and max seconds, the number of OWS
+        requests per run and the result of the last run
+    """
+
+    timings = []
+    requests = 0
+    result = None
+    for i in range(repeats):
+        if setup is not None:
+            setup()
+        before = server.requests
+        start = time.time()
+        result = function()
+        timings.append(time.time() - start)
+        requests += server.requests - before
+
+    timings.sort()
+    return {'repeats': repeats,
+            'min': timings[0],
+            'median': timings[len(timings) // 2],
+            'max': timings[-1],
+            'requests': requests / float(repeats)}, result
+
+
+def run(rows=1000, cols=1000, features=10000, latency=0.0, repeats=5,
+        upload=False):
+    """Run all benchmarks and return dictionary of results
+    """
+
+    raster = SyntheticRaster(RASTER, rows, cols)
+    vector = SyntheticVector(VECTOR, features)
+    server = StandInServer([raster, vector], latency=latency)
+    server.start()
+    url = server.url
+    bbox = raster.bbox
+
+    download_cache = storage.DOWNLOAD_CACHE
+    storage.DOWNLOAD_CACHE = None
+
+    cold = lambda: reset(url)
+    results = {}
+    try:
+        with SCRATCH.workspace():
+            results['get_metadata_server'], metadata = measure(
+                server, lambda: storage.get_metadata(url), repeats, cold)
+
+            for name, layer_name in [('raster', RASTER),
+                                     ('vector', VECTOR)]:
+                results['get_metadata_' + name], metadata[layer_name] = \
+                    measure(server,
+                            lambda: storage.get_metadata(url, layer_name),
+                            repeats, cold)
+
+            results['get_metadata_cached'], _ = measure(
+                server, lambda: storage.get_metadata(url, RASTER), repeats)
+
+            for name, layer_name in [('raster', RASTER),
+                                     ('vector', VECTOR)]:
+                stats = {}
+                download = lambda: storage.download(
+                                        url, layer_name, bbox,
+                                        metadata=metadata[layer_name],
+                                        stats=stats)
+                results['download_' + name], layer = measure(server,
+                                                             download,
+                                                             repeats)
+                results['download_' + name]['bytes'] = (stats['bytes'] //
+                                                        repeats)
+                if layer_name == RASTER:
+                    raster_filename = layer.filename
+
+            # Fill a fresh download cache once, then time hits
+            cache_dir = tempfile.mkdtemp()
+            try:
+                storage.DOWNLOAD_CACHE = DownloadCache(cache_dir)
+                storage.download(url, RASTER, bbox,
+                                 metadata=metadata[RASTER])
+                results['download_cached'], _ = measure(
+                    server, lambda: storage.download(
+                                        url, RASTER, bbox,
+                                        metadata=metadata[RASTER]),
+                    repeats)
+            finally:
+                storage.DOWNLOAD_CACHE = None
+                shutil.rmtree(cache_dir, ignore_errors=True)
+
+            stats = {}
+            download_url = WCS_TEMPLATE % (url, RASTER,
+                                           bboxlist2string(bbox),
+                                           raster.resolution[0],
+                                           raster.resolution[1])
+            results['get_file'], _ = measure(
+                server, lambda: storage.get_file(download_url, '.tif',
+                                                 stats=stats),
+                repeats)
+            results['get_file']['bytes'] = stats['bytes'] // repeats
+            results['get_file']['throughput'] = (stats['bytes'] /
+                                                 stats['seconds'])
+
+            if upload:
+                from geonode.layers.utils import get_valid_user
+                user = get_valid_user()
+                results['save_to_geonode'], layer = measure(
+                    server,
+                    lambda: storage.save_file_to_geonode(raster_filename,
+                                                         user=user,
+                                                         overwrite=True),
+                    repeats)
+                layer.delete()
+    finally:
+        storage.DOWNLOAD_CACHE = download_cache
+        reset(url)
+        server.stop()
+
+    return results
+
+
+def main(argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--rows', type='int', default=1000,
+                      help='Rows of the synthetic raster')
+    parser.add_option('--cols', type='int', default=1000,
+                      help='Columns of the synthetic raster')
+    parser.add_option('--features', type='int', default=10000,
+                      help='Features of the synthetic vector layer')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='Seconds added to every response')
+    parser.add_option('--repeats', type='int', default=5,
+                      help='Number of runs of every benchmark')
+    parser.add_option('--upload', action='store_true', default=False,
+                      help='Time save_to_geonode, needs GeoNode')
+    parser.add_option('--output', default=None,
+                      help='Write results to this file instead of stdout')
+    options, args = parser.parse_args(argv)
+
+    config = dict(rows=options.rows, cols=options.cols,
+                  features=options.features, latency=options.latency,
+                  repeats=options.repeats, upload=options.upload)
+    output = {'benchmark': 'storage',
+              'version': safe_geonode.get_version(),
+              'python': platform.python_version(),
+              'date': datetime.datetime.now().isoformat(),
+              'config': config,
+              'results': run(**config)}
+
+    jsondata = json.dumps(output, indent=2, sort_keys=True)
+    if options.output is None:
+        print jsondata
+    else:
+        with open(options.output, 'w') as fid:
+            fid.write(jsondata)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,483 @@
+"""Caching helpers for safe_geonode
+
+   The OWS round trips made by the storage module are by far the most
+   expensive part of answering a SAFE API request. This module provides
+   the caches used to avoid repeating them.
+"""
+
+import os
+import json
+import time
+import zlib
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import contextlib
+
+from collections import OrderedDict
+
+from safe_geonode import metrics
+
+
+class TTLCache(object):
+    """Thread safe least recently used cache with expiring entries
+
+    Input
+        timeout: Number of seconds an entry stays valid.
+        max_entries: Maximal number of entries kept. When exceeded the
+                     least recently used entry is dropped.
+        name: Optional name under which hits and misses are reported to
+              safe_geonode.metrics
+
+    Values stored in the cache are shared between all callers, so they
+    must be treated as immutable. Callers that need to modify a value
+    should copy it first.
+    """
+
+    def __init__(self, timeout=300, max_entries=64, name=None):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get value stored under key or default if missing or expired
+        """
+
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                expires, value = 0, default
+
+            if expires < time.time():
+                self.misses += 1
+                hit = False
+            else:
+                # Reinsert to mark entry as most recently used
+                self._entries[key] = (expires, value)
+                self.hits += 1
+                hit = True
+
+        if self.name is not None:
+            count_lookup(self.name, hit)
+
+        if hit:
+            return value
+        else:
+            return default
+
+    def set(self, key, value, timeout=None):
+        """Store value under key, evicting old entries if needed
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + timeout, value)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def update(self, key, function):
+        """Replace value stored under key by function(value)
+
+        The entry keeps its expiry time. Nothing happens if key is missing
+        or expired. As values are shared, function must return a new
+        object instead of modifying value.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.time():
+                self._entries[key] = (entry[0], function(entry[1]))
+
+    def invalidate(self, key=None):
+        """Remove key from the cache. If key is None remove all entries.
+        """
+
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """Remove all entries whose key satisfies predicate
+        """
+
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] >= time.time()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def count_lookup(name, hit):
+    """Report a hit or miss of cache name to safe_geonode.metrics
+    """
+
+    if hit:
+        metrics.inc('safe_cache_hits_total', cache=name)
+    else:
+        metrics.inc('safe_cache_misses_total', cache=name)
+
+
+def make_key(*parts):
+    """Make a file system safe cache key from a number of values
+    """
+
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+class DownloadCache(object):
+    """Disk cache of downloaded layers shared between processes
+
+    Input
+        root: Directory holding the cache. It is created if needed.
+        max_size: Maximal total size of cached files in bytes. When
+                  exceeded, least recently used entries are removed.
+        timeout: Number of seconds after which an entry is discarded.
+        name: Optional name under which hits and misses are reported to
+              safe_geonode.metrics
+
+    Every entry is a directory named by its key containing the layer
+    files and a manifest. Entries are written to a temporary directory
+    and renamed into place, so other processes never see partial
+    entries. Concurrent requests for a missing key, whether from threads
+    or processes, wait for a single download through a lock file. Keys
+    share a fixed set of LOCK_STRIPES locks, so rarely two different keys
+    wait for each other but the number of locks does not grow.
+
+    Entries may belong to a group, e.g. all downloads of one layer. Each
+    group has an index directory holding an empty file per key, so the
+    entries of a group are found without reading every manifest.
+
+    Cached files must not be modified. get_or_create hands out hard
+    links (or copies) so entries can be evicted while in use.
+    """
+
+    MANIFEST = 'entry.json'
+    LOCK_STRIPES = 256
+
+    # Temporary directories older than this many seconds were left by
+    # killed processes and are removed by evict
+    STALE_AGE = 6 * 3600
+
+    def __init__(self, root, max_size=2 * 1024 ** 3, timeout=24 * 3600,
+                 name=None):
+        self.root = root
+        self.max_size = max_size
+        self.timeout = timeout
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._key_locks = [threading.Lock()
+                           for i in range(self.LOCK_STRIPES)]
+
+        for dirname in [self.root, self._path('.locks'),
+                        self._path('.groups')]:
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # Created by another process in the meantime
+                    pass
+
+    def _path(self, *args):
+        return os.path.join(self.root, *args)
+
+    @contextlib.contextmanager
+    def single_flight(self, key):
+        """Hold exclusive access to key across threads and processes
+        """
+
+        stripe = (zlib.crc32(key) & 0xffffffff) % self.LOCK_STRIPES
+        with self._key_locks[stripe]:
+            with open(self._path('.locks', '%i.lock' % stripe), 'w') as fid:
+                fcntl.flock(fid, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fid, fcntl.LOCK_UN)
+
+    def read_manifest(self, key):
+        """Get manifest of entry for key, even if expired, or None
+        """
+
+        filename = self._path(key, self.MANIFEST)
+        try:
+            with open(filename) as fid:
+                return json.load(fid)
+        except (IOError, ValueError):
+            return None
+
+    def is_expired(self, manifest):
+        return manifest['created'] + self.timeout < time.time()
+
+    def manifest(self, key):
+        """Get manifest of valid entry for key or None if there is none
+
+        Expired entries are left in place. They are replaced under the
+        lock of their key when created again, or removed by evict.
+        """
+
+        manifest = self.read_manifest(key)
+        if manifest is None or self.is_expired(manifest):
+            return None
+
+        return manifest
+
+    def entries(self, group=None):
+        """Iterate over (key, manifest) of all valid entries
+
+        If group is given, only the entries of that group are read.
+        """
+
+        if group is None:
+            keys = [key for key in os.listdir(self.root)
+                    if not key.startswith('.')]
+        else:
+            try:
+                keys = os.listdir(self._path('.groups', group))
+            except OSError:
+                keys = []
+
+        for key in keys:
+            manifest = self.manifest(key)
+            if manifest is not None:
+                yield key, manifest
+            elif group is not None and not os.path.exists(self._path(key)):
+                # Entry is gone, so is its place in the index
+                self.unindex(key, group)
+
+    def index(self, key, group):
+        """Record that entry key belongs to group
+        """
+
+        dirname = self._path('.groups', group)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Created by another process in the meantime
+                pass
+        open(os.path.join(dirname, key), 'w').close()
+
+    def unindex(self, key, group):
+        """Remove entry key from the index of group
+        """
+
+        try:
+            os.remove(self._path('.groups', group, key))
+        except OSError:
+            pass
+
+    def filename(self, key, manifest):
+        """Get full path of the main file of an entry
+
+        The file must only be read. It may disappear at any time when
+        the entry is evicted.
+        """
+
+        return self._path(key, manifest['filename'])
+
+    def checkout(self, key, manifest, dirname):
+        """Link files of entry into dirname and return the main file name
+        """
+
+        # Mark entry as recently used
+        os.utime(self._path(key, self.MANIFEST), None)
+
+        for name in os.listdir(self._path(key)):
+            if name == self.MANIFEST:
+                continue
+
+            source = self._path(key, name)
+            target = os.path.join(dirname, name)
+            try:
+                os.link(source, target)
+            except OSError:
+                # Hard links are not possible across file systems
+                shutil.copy2(source, target)
+
+        return os.path.join(dirname, manifest['filename'])
+
+    def get_or_create(self, key, create, dirname, info=None, group=None):
+        """Get the files cached under key, creating them if needed
+
+        Input
+            key: Cache key as obtained from make_key
+            create: Function that takes a directory name, writes the files
+                    of the entry there and returns the name of the main
+                    file relative to that directory.
+            dirname: Directory where the files of the entry are placed
+            info: Optional dictionary recorded in the manifest
+            group: Optional name of the group of the entry, see entries
+
+        Output
+            filename: Full path of the main file in dirname
+        """
+
+        manifest = self.manifest(key)
+        if manifest is None:
+            filename = None
+            with self.single_flight(key):
+                # Another thread or process may have created it meanwhile
+                manifest = self.manifest(key)
+                if manifest is None:
+                    self.misses += 1
+                    if self.name is not None:
+                        count_lookup(self.name, False)
+                    manifest = self.create(key, create, info, group)
+                    filename = self.checkout(key, manifest, dirname)
+
+            if filename is not None:
+                # Outside of the lock, evict takes the locks of other keys
+                self.evict()
+                return filename
+
+        self.hits += 1
+        if self.name is not None:
+            count_lookup(self.name, True)
+        try:
+            return self.checkout(key, manifest, dirname)
+        except (IOError, OSError):
+            # Entry was evicted while linking or copying, try again
+            return self.get_or_create(key, create, dirname, info=info,
+                                      group=group)
+
+    def create(self, key, create, info=None, group=None):
+        """Create entry for key atomically and return its manifest
+        """
+
+        tempdir = tempfile.mkdtemp(prefix='.tmp-', dir=self.root)
+        try:
+            filename = create(tempdir)
+            manifest = {'filename': filename,
+                        'created': time.time(),
+                        'info': info,
+                        'group': group}
+            with open(os.path.join(tempdir, self.MANIFEST), 'w') as fid:
+                json.dump(manifest, fid)
+
+            self.remove(key)
+            os.rename(tempdir, self._path(key))
+        except:
+            shutil.rmtree(tempdir, ignore_errors=True)
+            raise
+
+        if group is not None:
+            self.index(key, group)
+
+        return manifest
+
+    def remove(self, key, group=None):
+        """Remove entry for key if it exists
+        """
+
+        # Rename first so the entry disappears atomically
+        trash = tempfile.mkdtemp(prefix='.trash-', dir=self.root)
+        try:
+            os.rename(self._path(key), os.path.join(trash, key))
+        except OSError:
+            pass
+        shutil.rmtree(trash, ignore_errors=True)
+
+        if group is not None:
+            self.unindex(key, group)
+
+    def invalidate(self, predicate, group=None):
+        """Remove all entries for which predicate(info) is True
+
+        If group is given, only the entries of that group are considered.
+        """
+
+        for key, manifest in list(self.entries(group)):
+            if predicate(manifest['info']):
+                self.remove(key, manifest.get('group'))
+
+    def size(self, key):
+        """Get size in bytes of files in entry
+        """
+
+        total = 0
+        dirname = self._path(key)
+        for name in os.listdir(dirname):
+            total += os.path.getsize(os.path.join(dirname, name))
+        return total
+
+    def remove_stale(self):
+        """Remove temporary directories left behind by killed processes
+        """
+
+        oldest = time.time() - self.STALE_AGE
+        for name in os.listdir(self.root):
+            if not (name.startswith('.tmp-') or name.startswith('.trash-')):
+                continue
+
+            dirname = self._path(name)
+            try:
+                stale = os.path.getmtime(dirname) < oldest
+            except OSError:
+                # Removed by its process in the meantime
+                continue
+            if stale:
+                shutil.rmtree(dirname, ignore_errors=True)
+
+    def evict(self):
+        """Remove expired and least recently used entries to fit max_size
+
+        Stale temporary directories are removed as well, see remove_stale.
+        """
+
+        self.remove_stale()
+
+        entries = []
+        total = 0
+        for key in os.listdir(self.root):
+            if key.startswith('.'):
+                continue
+
+            manifest = self.read_manifest(key)
+            if manifest is None:
+                # Removed by another process
+                continue
+
+            if self.is_expired(manifest):
+                with self.single_flight(key):
+                    # Check again, it may have been created anew meanwhile
+                    manifest = self.read_manifest(key)
+                    if manifest is not None and self.is_expired(manifest):
+                        self.remove(key, manifest.get('group'))
+                continue
+
+            try:
+                used = os.path.getmtime(self._path(key, self.MANIFEST))
+                size = self.size(key)
+            except OSError:
+                # Removed by another process
+                continue
+            entries.append((used, size, key, manifest.get('group')))
+            total += size
+
+        entries.sort()
+        for used, size, key, group in entries:
+            if total <= self.max_size:
+                break
+            self.remove(key, group)
+            total -= size
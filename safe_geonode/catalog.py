@@ -0,0 +1,105 @@
+"""Catalog of layer metadata kept in the database
+
+   Building layer metadata from OWS capabilities takes seconds for
+   servers with many layers. Metadata fetched by get_metadata is
+   therefore written to the LayerMetadata table and later lookups are
+   answered from there until the entries are older than
+   SAFE_LAYER_CATALOG_MAX_AGE seconds (3600).
+
+   Layers uploaded through save_file_to_geonode are entered as soon as
+   their metadata is verified. Run the safesynclayers command
+   periodically to refresh the catalog of remote servers.
+"""
+
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+
+from safe_geonode.models import LayerMetadata, CatalogSync
+from safe_geonode import metrics
+
+MAX_AGE = getattr(settings, 'SAFE_LAYER_CATALOG_MAX_AGE', 3600)
+
+
+def oldest_valid(max_age):
+    return datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+
+
+def get_layer(server_url, layer_name, max_age=MAX_AGE):
+    """Get metadata of one layer from the catalog
+
+    Output
+        metadata: Dictionary as returned by get_metadata or None if the
+                  layer is not in the catalog or its entry is too old
+    """
+
+    entries = LayerMetadata.objects.filter(server_url=server_url,
+                                           name=layer_name,
+                                           synced__gte=oldest_valid(max_age))
+    for entry in entries.order_by('-synced')[:1]:
+        metrics.inc('safe_cache_hits_total', cache='catalog')
+        return entry.to_metadata()
+
+    metrics.inc('safe_cache_misses_total', cache='catalog')
+    return None
+
+
+def get_server(server_url, max_age=MAX_AGE):
+    """Get metadata of all layers of a server from the catalog
+
+    Output
+        metadata: Dictionary of metadata dictionaries, one per layer, or
+                  None if the server has not been synchronized recently
+    """
+
+    synced = CatalogSync.objects.filter(server_url=server_url,
+                                        synced__gte=oldest_valid(max_age))
+    if not synced.exists():
+        metrics.inc('safe_cache_misses_total', cache='catalog')
+        return None
+
+    metrics.inc('safe_cache_hits_total', cache='catalog')
+    metadata = {}
+    entries = LayerMetadata.objects.filter(server_url=server_url)
+    for entry in entries.order_by('synced'):
+        # Newer entries replace older ones of the same layer
+        metadata[entry.name] = entry.to_metadata()
+
+    return metadata
+
+
+@transaction.commit_on_success
+def store_layer(server_url, layer_name, metadata):
+    """Write metadata of one layer to the catalog
+    """
+
+    now = datetime.datetime.now()
+    forget_layer(server_url, layer_name)
+    LayerMetadata.from_metadata(server_url, layer_name, metadata, now).save()
+
+
+@transaction.commit_on_success
+def store_server(server_url, metadata):
+    """Replace catalog of a server with metadata of all its layers
+
+    The catalog is replaced in one transaction, so get_server never sees
+    a new synchronization without the layers that came with it.
+    """
+
+    now = datetime.datetime.now()
+    LayerMetadata.objects.filter(server_url=server_url).delete()
+    LayerMetadata.objects.bulk_create(
+        [LayerMetadata.from_metadata(server_url, name, layer_metadata, now)
+         for name, layer_metadata in metadata.items()])
+
+    CatalogSync.objects.filter(server_url=server_url).delete()
+    CatalogSync.objects.create(server_url=server_url, synced=now)
+
+
+def forget_layer(server_url, layer_name):
+    """Remove a layer from the catalog
+    """
+
+    LayerMetadata.objects.filter(server_url=server_url,
+                                 name=layer_name).delete()
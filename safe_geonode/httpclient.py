@@ -0,0 +1,302 @@
+"""HTTP client shared by all OWS requests made by safe_geonode
+
+   Connections are kept alive and reused for each host and the number of
+   concurrent requests sent to one host is limited, so bursts of
+   calculations do not overwhelm a GeoServer. Responses are requested
+   gzip compressed and decompressed transparently while streaming.
+
+   Timeouts and limits are configured in the Django settings:
+
+   SAFE_HTTP_CONNECT_TIMEOUT: Seconds to wait for a connection (10)
+   SAFE_HTTP_READ_TIMEOUT: Seconds to wait for data on a socket (300)
+   SAFE_HTTP_MAX_CONNECTIONS_PER_HOST: Concurrent requests per host (8)
+"""
+
+import zlib
+import time
+import socket
+import httplib
+import urlparse
+import threading
+import contextlib
+
+from django.conf import settings
+
+from safe_geonode import metrics
+
+CONNECT_TIMEOUT = getattr(settings, 'SAFE_HTTP_CONNECT_TIMEOUT', 10)
+READ_TIMEOUT = getattr(settings, 'SAFE_HTTP_READ_TIMEOUT', 300)
+MAX_CONNECTIONS_PER_HOST = getattr(settings,
+                                   'SAFE_HTTP_MAX_CONNECTIONS_PER_HOST', 8)
+
+# Maximal number of redirects followed for one request
+MAX_REDIRECTS = 5
+
+
+class HTTPError(Exception):
+    """Request failed with an HTTP error status
+    """
+
+    def __init__(self, url, status, reason):
+        msg = 'Request to %s failed with status %s: %s' % (url, status, reason)
+        Exception.__init__(self, msg)
+        self.url = url
+        self.status = status
+
+
+class Response(object):
+    """Streaming HTTP response
+
+    Use read to get the decompressed body in chunks. The underlying
+    connection is returned to the pool once the response is closed.
+    """
+
+    def __init__(self, url, response):
+        self.url = url
+        self.status = response.status
+        self.headers = dict(response.getheaders())
+        self.content_type = self.headers.get('content-type',
+                                             '').split(';')[0].strip()
+        self._response = response
+
+        # Bytes received so far, before decompression
+        self.bytes_read = 0
+
+        if self.headers.get('content-encoding') == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = None
+
+    def read(self, size=-1):
+        """Read up to size bytes of the body, all of it if size is negative
+
+        Returns an empty string when the body has been read.
+        """
+
+        if self._decompressor is None:
+            return self._read(size)
+
+        if size < 0:
+            data = self._read(size)
+            return (self._decompressor.decompress(data) +
+                    self._decompressor.flush())
+
+        # Decompressed data may be empty for small compressed chunks
+        while True:
+            data = self._read(size)
+            if not data:
+                return self._decompressor.flush()
+            data = self._decompressor.decompress(data)
+            if data:
+                return data
+
+    def _read(self, size):
+        if size < 0:
+            data = self._response.read()
+        else:
+            data = self._response.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def is_complete(self):
+        """Determine if the whole body has been read from the connection
+        """
+
+        return self._response.isclosed() or self._response.length == 0
+
+
+class ConnectionPool(object):
+    """Pool of keep-alive connections with a concurrency limit per host
+
+    Input
+        connect_timeout: Seconds to wait while connecting
+        read_timeout: Seconds to wait for data once connected
+        max_connections: Maximal number of concurrent requests per host
+    """
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT,
+                 max_connections=MAX_CONNECTIONS_PER_HOST):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._semaphores = {}
+
+        # Number of requests sent to each host
+        self.requests = {}
+
+    def _semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(
+                                                    self.max_connections)
+            return self._semaphores[host]
+
+    def _get_connection(self, host):
+        """Get an idle connection to host or create a new one
+
+        Output
+            connection, reused: reused is True for idle connections which
+                                the server may have closed in the meantime
+        """
+
+        with self._lock:
+            idle = self._idle.get(host, [])
+            if idle:
+                return idle.pop(), True
+
+        scheme, netloc = host
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(netloc,
+                                                 timeout=self.connect_timeout)
+        else:
+            connection = httplib.HTTPConnection(netloc,
+                                                timeout=self.connect_timeout)
+
+        connection.connect()
+        connection.sock.settimeout(self.read_timeout)
+        return connection, False
+
+    def _put_connection(self, host, connection):
+        with self._lock:
+            self._idle.setdefault(host, []).append(connection)
+
+    def _send(self, host, path, headers):
+        """Send GET request, retrying once on a stale idle connection
+        """
+
+        with self._lock:
+            self.requests[host] = self.requests.get(host, 0) + 1
+
+        connection, reused = self._get_connection(host)
+        try:
+            connection.request('GET', path, headers=headers)
+            return connection, connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+
+        connection, reused = self._get_connection(host)
+        try:
+            connection.request('GET', path, headers=headers)
+            return connection, connection.getresponse()
+        except:
+            connection.close()
+            raise
+
+    @contextlib.contextmanager
+    def request(self, url):
+        """Send a GET request and yield the streaming Response
+
+        Redirects are followed and HTTPError is raised for error statuses.
+        """
+
+        for i in range(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            host = (parts.scheme, parts.netloc)
+            path = urlparse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+            headers = {'Accept-Encoding': 'gzip',
+                       'Connection': 'keep-alive'}
+
+            semaphore = self._semaphore(host)
+            semaphore.acquire()
+            connection = None
+            result = None
+            failed = True
+            start = time.time()
+            try:
+                connection, response = self._send(host, path, headers)
+                result = Response(url, response)
+
+                if result.status in (301, 302, 303, 307):
+                    location = result.headers.get('location')
+                    result.read()
+                    self._release(host, connection, result)
+                    connection = None
+                    failed = False
+                    url = urlparse.urljoin(url, location)
+                    continue
+
+                if result.status >= 400:
+                    raise HTTPError(url, result.status, response.reason)
+
+                # Errors of the caller are not errors of the server
+                failed = False
+                try:
+                    yield result
+                except (socket.error, httplib.HTTPException):
+                    failed = True
+                    raise
+                self._release(host, connection, result)
+                connection = None
+                return
+            finally:
+                if connection is not None:
+                    connection.close()
+                semaphore.release()
+                record_request('%s://%s' % host, time.time() - start,
+                               result, failed)
+
+        raise HTTPError(url, result.status, 'Too many redirects')
+
+    def _release(self, host, connection, response):
+        """Keep connection for reuse if the response was read completely
+        """
+
+        if response.is_complete() and not response._response.will_close:
+            self._put_connection(host, connection)
+        else:
+            connection.close()
+
+    def get(self, url):
+        """Get the complete body of url
+        """
+
+        with self.request(url) as response:
+            return response.read()
+
+    def close(self):
+        """Close all idle connections
+        """
+
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+
+def record_request(server, seconds, response, failed):
+    """Count a request to server in the metrics
+    """
+
+    metrics.inc('safe_ows_requests_total', server=server)
+    metrics.observe('safe_ows_request_duration_seconds', seconds,
+                    server=server)
+    if response is not None:
+        metrics.inc('safe_ows_bytes_total', response.bytes_read,
+                    server=server)
+    if failed:
+        metrics.inc('safe_ows_errors_total', server=server)
+
+
+# Pool used for all OWS traffic of this process
+POOL = ConnectionPool()
+
+
+def urlopen(url):
+    """Open url through the shared pool, use as a context manager
+    """
+
+    return POOL.request(url)
+
+
+def get(url):
+    """Get the complete body of url through the shared pool
+    """
+
+    return POOL.get(url)
@@ -0,0 +1,307 @@
+"""Background execution of calculations
+
+   Calculations requested through the API are queued, so requests return
+   immediately instead of holding a web server worker for the whole run.
+   There are two queues, chosen with SAFE_CALCULATION_QUEUE:
+
+   local: Jobs are run by a bounded pool of threads in the web process.
+   database: Jobs are stored as CalculationJob rows and run by any number
+             of safeworker processes on any host sharing the database.
+
+   Both are configured in the Django settings:
+
+   SAFE_CALCULATION_QUEUE: Queue to use, local or database (local)
+   SAFE_CALCULATION_WORKERS: Number of worker threads (2)
+   SAFE_CALCULATION_QUEUE_SIZE: Maximal number of waiting jobs (50)
+   SAFE_WORKER_HEARTBEAT: Seconds between heartbeats of a worker (30)
+   SAFE_WORKER_LEASE: Seconds without heartbeat after which a job is
+                      considered abandoned and claimed again (120)
+   SAFE_WORKER_MAX_ATTEMPTS: Number of times a job is claimed before it
+                             is given up (3)
+   SAFE_WORKER_POLL_INTERVAL: Seconds between checks for new jobs (5)
+"""
+
+import os
+import sys
+import time
+import Queue
+import socket
+import logging
+import datetime
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+
+from safe_geonode.models import CalculationJob
+
+logger = logging.getLogger(__name__)
+
+QUEUE = getattr(settings, 'SAFE_CALCULATION_QUEUE', 'local')
+WORKERS = getattr(settings, 'SAFE_CALCULATION_WORKERS', 2)
+QUEUE_SIZE = getattr(settings, 'SAFE_CALCULATION_QUEUE_SIZE', 50)
+HEARTBEAT = getattr(settings, 'SAFE_WORKER_HEARTBEAT', 30)
+LEASE = getattr(settings, 'SAFE_WORKER_LEASE', 120)
+MAX_ATTEMPTS = getattr(settings, 'SAFE_WORKER_MAX_ATTEMPTS', 3)
+POLL_INTERVAL = getattr(settings, 'SAFE_WORKER_POLL_INTERVAL', 5)
+
+
+class QueueFull(Exception):
+    """No more jobs can be queued
+    """
+    pass
+
+
+class WorkerPool(object):
+    """Bounded pool of threads executing queued functions
+
+    Input
+        workers: Number of worker threads. Threads are started when the
+                 first job is submitted.
+        queue_size: Maximal number of jobs waiting for a worker
+    """
+
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE):
+        self.workers = workers
+        self._queue = Queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work,
+                                          name='safe-worker-%i' %
+                                               len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            function, args, kwargs = self._queue.get()
+            try:
+                function(*args, **kwargs)
+            except:
+                logger.error('Job %s failed', function.__name__,
+                             exc_info=sys.exc_info())
+            finally:
+                # Each thread has its own database connection
+                connection.close()
+                self._queue.task_done()
+
+    def submit(self, function, *args, **kwargs):
+        """Queue function to be called with args and kwargs by a worker
+
+        Raises QueueFull if queue_size jobs are already waiting.
+        """
+
+        self._start()
+        try:
+            self._queue.put_nowait((function, args, kwargs))
+        except Queue.Full:
+            raise QueueFull('There are already %i calculations waiting, '
+                            'please try again later' % self._queue.maxsize)
+
+    def pending(self):
+        """Get number of jobs waiting for a worker
+        """
+
+        return self._queue.qsize()
+
+    def join(self):
+        """Wait until all queued jobs are done
+        """
+
+        self._queue.join()
+
+
+# Pool used for calculations of this process
+POOL = WorkerPool()
+
+
+def submit(function, *args, **kwargs):
+    """Queue function for execution by the pool of this process
+    """
+
+    POOL.submit(function, *args, **kwargs)
+
+
+def enqueue_job(calculation, requested_bbox):
+    """Store a job for calculation in the database queue
+
+    Raises QueueFull if QUEUE_SIZE jobs are already waiting.
+    """
+
+    waiting = CalculationJob.objects.filter(done=False,
+                                            worker__isnull=True).count()
+    if waiting >= QUEUE_SIZE:
+        raise QueueFull('There are already %i calculations waiting, '
+                        'please try again later' % waiting)
+
+    return CalculationJob.objects.create(calculation=calculation,
+                                         requested_bbox=requested_bbox)
+
+
+def node_name():
+    """Get name identifying this worker process across hosts
+    """
+
+    return '%s:%i' % (socket.gethostname(), os.getpid())
+
+
+def claim_job(node, lease=LEASE):
+    """Claim the oldest job that is waiting or was abandoned
+
+    Input
+        node: Name of the claiming worker
+        lease: Seconds without heartbeat after which a claimed job is
+               considered abandoned
+
+    Output
+        Claimed CalculationJob or None if there is nothing to do
+
+    A job is claimed with a conditional update that only succeeds if no
+    other worker changed it since it was read, so every job is claimed by
+    exactly one worker even when many processes poll at the same time.
+    """
+
+    now = datetime.datetime.now()
+    expired = now - datetime.timedelta(seconds=lease)
+
+    candidates = CalculationJob.objects.filter(done=False).filter(
+                    Q(worker__isnull=True) | Q(heartbeat__lt=expired))
+
+    for job in candidates.order_by('created')[:10]:
+        claimed = CalculationJob.objects.filter(id=job.id, done=False,
+                                                worker=job.worker,
+                                                heartbeat=job.heartbeat)
+        count = claimed.update(worker=node, heartbeat=now,
+                               attempts=F('attempts') + 1)
+        if count == 0:
+            # Claimed by another worker in the meantime
+            continue
+
+        job = CalculationJob.objects.get(id=job.id)
+        if job.attempts > MAX_ATTEMPTS:
+            give_up_job(job, 'Calculation was abandoned by %i workers' %
+                             MAX_ATTEMPTS)
+            continue
+
+        return job
+
+    return None
+
+
+def give_up_job(job, errors):
+    """Mark job as done and its calculation as failed
+    """
+
+    calculation = job.calculation
+    calculation.errors = errors
+    calculation.status = 'failed'
+    calculation.save()
+    CalculationJob.objects.filter(id=job.id).update(done=True)
+
+
+class DatabaseWorker(object):
+    """Worker executing jobs claimed from the database queue
+
+    Input
+        execute: Function taking a Calculation, the name of its impact
+                 function and the requested bounding box string
+        threads: Number of jobs executed at the same time
+        node: Name of this worker, recorded in the jobs it claims
+    """
+
+    def __init__(self, execute, threads=WORKERS, node=None):
+        self.execute = execute
+        self.threads = threads
+        self.node = node or node_name()
+        self._lock = threading.Lock()
+        self._running = set()
+        self._stop = threading.Event()
+
+    def heartbeat(self):
+        """Renew the lease of all jobs run by this worker
+        """
+
+        with self._lock:
+            ids = list(self._running)
+
+        if ids:
+            now = datetime.datetime.now()
+            CalculationJob.objects.filter(id__in=ids, worker=self.node,
+                                          done=False).update(heartbeat=now)
+
+    def run_job(self, job):
+        """Execute job and mark it as done
+        """
+
+        with self._lock:
+            self._running.add(job.id)
+
+        try:
+            calculation = job.calculation
+            self.execute(calculation, calculation.impact_function,
+                         job.requested_bbox)
+        finally:
+            with self._lock:
+                self._running.discard(job.id)
+
+        CalculationJob.objects.filter(id=job.id,
+                                      worker=self.node).update(done=True)
+
+    def work(self):
+        """Claim and run jobs until stopped
+        """
+
+        while not self._stop.is_set():
+            try:
+                job = claim_job(self.node)
+                if job is None:
+                    self._stop.wait(POLL_INTERVAL)
+                else:
+                    self.run_job(job)
+            except:
+                logger.error('Worker %s failed', self.node,
+                             exc_info=sys.exc_info())
+                self._stop.wait(POLL_INTERVAL)
+            finally:
+                connection.close()
+
+    def release(self):
+        """Hand running jobs back to the queue so others can claim them
+        """
+
+        with self._lock:
+            ids = list(self._running)
+
+        CalculationJob.objects.filter(id__in=ids, worker=self.node,
+                                      done=False).update(worker=None,
+                                                         heartbeat=None)
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        """Run worker threads and send heartbeats until interrupted
+        """
+
+        threads = []
+        for i in range(self.threads):
+            thread = threading.Thread(target=self.work,
+                                      name='safe-worker-%i' % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            while any(thread.is_alive() for thread in threads):
+                self.heartbeat()
+                connection.close()
+                time.sleep(HEARTBEAT)
+        except KeyboardInterrupt:
+            self.stop()
+            self.release()
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from safe_geonode.models import Server
+from safe_geonode.storage import sync_catalog, INTERNAL_SERVER_URL
+import traceback
+
+
+class Command(BaseCommand):
+    help = ("Refreshes the catalog of layer metadata from the OWS servers. "
+            "Without arguments the local GeoServer and all registered "
+            "servers are synchronized.")
+
+    args = '[server_url...]'
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity'))
+
+        if args:
+            server_urls = list(args)
+        else:
+            server_urls = [INTERNAL_SERVER_URL]
+            server_urls.extend(server.url for server in Server.objects.all())
+
+        failed = []
+        for server_url in server_urls:
+            try:
+                metadata = sync_catalog(server_url)
+            except Exception, e:
+                failed.append(server_url)
+                if verbosity > 0:
+                    print "Could not synchronize %s: %s" % (server_url, e)
+                if verbosity > 1:
+                    traceback.print_exc()
+            else:
+                if verbosity > 0:
+                    print "Synchronized %d layers of %s" % (len(metadata),
+                                                            server_url)
+
+        if failed:
+            raise CommandError('Could not synchronize %s' % ', '.join(failed))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from safe_geonode.jobs import DatabaseWorker, node_name, WORKERS
+from safe_geonode.views import execute_calculation
+
+
+class Command(BaseCommand):
+    help = ("Runs calculations queued in the database. Start it on any "
+            "number of hosts sharing the database of the GeoNode site "
+            "and set SAFE_CALCULATION_QUEUE to 'database'.")
+
+    option_list = BaseCommand.option_list + (
+            make_option('-t', '--threads', dest='threads', type='int',
+                default=WORKERS,
+                help="Number of calculations run at the same time"),
+            make_option('-n', '--node', dest='node', default=None,
+                help="Name of this worker, defaults to host name and process id")
+        )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity'))
+        node = options.get('node') or node_name()
+        threads = options.get('threads')
+
+        worker = DatabaseWorker(execute_calculation, threads=threads,
+                                node=node)
+
+        if verbosity > 0:
+            print "Worker %s running %i threads" % (node, threads)
+
+        worker.run()
@@ -0,0 +1,451 @@
+"""Metrics of the SAFE API and storage layer in Prometheus text format
+
+   Every process counts API requests, OWS traffic, cache lookups, upload
+   retries and running calculations in memory and writes them to its own
+   file in SAFE_METRICS_DIR at most every FLUSH_INTERVAL seconds. The
+   metrics view adds up the files of all processes, so the numbers are
+   complete however many WSGI processes and workers share the directory.
+   Gauges only include processes that are still running. Counters of
+   processes that ended are folded into an archive file, so they never
+   go down.
+
+   SAFE_METRICS_DIR: Directory shared by all processes on this host
+                     (safe_metrics in the temporary directory)
+"""
+
+import os
+import json
+import atexit
+import time
+import fcntl
+import bisect
+import logging
+import binascii
+import tempfile
+import functools
+import threading
+import contextlib
+
+from django.conf import settings
+
+from safe_geonode.scratch import is_process_alive
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = getattr(settings, 'SAFE_METRICS_DIR',
+                      os.path.join(tempfile.gettempdir(), 'safe_metrics'))
+
+# Minimal number of seconds between two writes of the file of a process
+FLUSH_INTERVAL = 1
+
+# File holding the counters of processes that ended
+ARCHIVE = 'archive.json'
+
+# Upper bounds in seconds of the buckets of all histograms
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+           60, 120, 300, 600]
+
+# Type and help text of all metrics
+METRICS = {
+    'safe_requests_total':
+        ('counter', 'API requests by view and status code'),
+    'safe_request_duration_seconds':
+        ('histogram', 'Time taken to answer API requests'),
+    'safe_ows_requests_total':
+        ('counter', 'Requests sent to OWS servers'),
+    'safe_ows_errors_total':
+        ('counter', 'Requests to OWS servers that failed'),
+    'safe_ows_request_duration_seconds':
+        ('histogram', 'Time taken by requests to OWS servers including '
+                      'the transfer of the response'),
+    'safe_ows_bytes_total':
+        ('counter', 'Bytes received from OWS servers before '
+                    'decompression'),
+    'safe_cache_hits_total':
+        ('counter', 'Lookups answered by a cache'),
+    'safe_cache_misses_total':
+        ('counter', 'Lookups not answered by a cache'),
+    'safe_cache_hit_ratio':
+        ('gauge', 'Fraction of lookups answered by a cache'),
+    'safe_save_metadata_retries_total':
+        ('counter', 'Checks of uploaded layers repeated because their '
+                    'metadata was not ready'),
+    'safe_calculations_total':
+        ('counter', 'Calculations by outcome'),
+    'safe_calculations_in_flight':
+        ('gauge', 'Calculations currently running'),
+}
+
+
+def metric_key(name, labels):
+    """Get string identifying a metric with labels in the process files
+    """
+
+    return json.dumps([name, sorted(labels.items())])
+
+
+class MetricsStore(object):
+    """Metrics of one process written to a directory shared by processes
+
+    Input
+        directory: Directory holding one file per process
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._timer = None
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._filename = os.path.join(self.directory, '%i-%s.json' % (
+                                      self._pid,
+                                      binascii.hexlify(os.urandom(4))))
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._last_flush = 0
+
+    def _check_fork(self):
+        # Values inherited from the parent process are written by it
+        if os.getpid() != self._pid:
+            self._reset()
+            self._timer = None
+
+    def inc(self, name, value=1, **labels):
+        """Add value to counter name
+        """
+
+        with self._lock:
+            self._check_fork()
+            key = metric_key(name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+        self.flush()
+
+    def add(self, name, value, **labels):
+        """Add value, which may be negative, to gauge name
+        """
+
+        with self._lock:
+            self._check_fork()
+            key = metric_key(name, labels)
+            self._gauges[key] = self._gauges.get(key, 0) + value
+        self.flush()
+
+    def observe(self, name, value, **labels):
+        """Record value in histogram name
+        """
+
+        with self._lock:
+            self._check_fork()
+            key = metric_key(name, labels)
+            histogram = self._histograms.setdefault(key, {
+                            'buckets': [0] * (len(BUCKETS) + 1),
+                            'sum': 0.0,
+                            'count': 0})
+            histogram['buckets'][bisect.bisect_left(BUCKETS, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+        self.flush()
+
+    def flush(self, force=False):
+        """Write the metrics of this process to its file
+
+        Unless force is True, writes happen at most every FLUSH_INTERVAL
+        seconds and a later write is scheduled for updates in between.
+        """
+
+        with self._lock:
+            self._check_fork()
+            now = time.time()
+            if not force and now - self._last_flush < FLUSH_INTERVAL:
+                if self._timer is None:
+                    self._timer = threading.Timer(FLUSH_INTERVAL,
+                                                  self._scheduled_flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+
+            self._last_flush = now
+            content = json.dumps({'counters': self._counters,
+                                  'gauges': self._gauges,
+                                  'histograms': self._histograms})
+
+            # Metrics must never break the work they measure
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                fd, tmpname = tempfile.mkstemp(prefix='.tmp-',
+                                               dir=self.directory)
+                with os.fdopen(fd, 'w') as fid:
+                    fid.write(content)
+                os.rename(tmpname, self._filename)
+            except (IOError, OSError), e:
+                logger.warning('Could not write metrics to %s: %s'
+                               % (self._filename, e))
+
+    def _scheduled_flush(self):
+        with self._lock:
+            self._timer = None
+        self.flush(force=True)
+
+    def close(self):
+        """Write pending updates, called when the process exits
+        """
+
+        with self._lock:
+            self._check_fork()
+            timer = self._timer
+            self._timer = None
+        if timer is not None:
+            timer.cancel()
+        self.flush(force=True)
+
+    @contextlib.contextmanager
+    def _directory_lock(self):
+        with open(os.path.join(self.directory, '.lock'), 'w') as fid:
+            fcntl.flock(fid, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fid, fcntl.LOCK_UN)
+
+    def collect(self):
+        """Add up the metrics of all processes
+
+        Output
+            Dictionary with keys counters, gauges and histograms, each a
+            dictionary of values by metric key
+
+        Files of processes that ended are merged into the archive.
+        """
+
+        self.flush(force=True)
+
+        total = {'counters': {}, 'gauges': {}, 'histograms': {}}
+        if not os.path.isdir(self.directory):
+            return total
+
+        with self._directory_lock():
+            archive_filename = os.path.join(self.directory, ARCHIVE)
+            archive = read_metrics(archive_filename)
+            archived = False
+
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json') or name == ARCHIVE:
+                    continue
+
+                filename = os.path.join(self.directory, name)
+                metrics = read_metrics(filename)
+                pid = int(name.split('-')[0])
+
+                # A process reusing the id of one that ended has another
+                # file name
+                if (is_process_alive(pid) and
+                    (pid != self._pid or filename == self._filename)):
+                    merge_metrics(total, metrics, gauges=True)
+                else:
+                    merge_metrics(archive, metrics)
+                    archived = True
+                    os.remove(filename)
+
+            if archived:
+                fd, tmpname = tempfile.mkstemp(prefix='.tmp-',
+                                               dir=self.directory)
+                with os.fdopen(fd, 'w') as fid:
+                    json.dump(archive, fid)
+                os.rename(tmpname, archive_filename)
+
+        merge_metrics(total, archive)
+        return total
+
+
+def read_metrics(filename):
+    """Read metrics file written by MetricsStore, empty if missing
+    """
+
+    try:
+        with open(filename) as fid:
+            return json.load(fid)
+    except (IOError, ValueError):
+        return {'counters': {}, 'gauges': {}, 'histograms': {}}
+
+
+def merge_metrics(total, metrics, gauges=False):
+    """Add counters and histograms, and gauges if requested, to total
+    """
+
+    for key, value in metrics['counters'].items():
+        total['counters'][key] = total['counters'].get(key, 0) + value
+
+    if gauges:
+        for key, value in metrics['gauges'].items():
+            total['gauges'][key] = total['gauges'].get(key, 0) + value
+
+    for key, histogram in metrics['histograms'].items():
+        if key not in total['histograms']:
+            total['histograms'][key] = {'buckets': [0] * (len(BUCKETS) + 1),
+                                        'sum': 0.0,
+                                        'count': 0}
+        target = total['histograms'][key]
+        target['buckets'] = [a + b for a, b in zip(target['buckets'],
+                                                   histogram['buckets'])]
+        target['sum'] += histogram['sum']
+        target['count'] += histogram['count']
+
+
+def format_labels(labels):
+    """Format list of (name, value) pairs as Prometheus labels
+    """
+
+    if not labels:
+        return ''
+
+    def escape(value):
+        return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n'))
+
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value))
+                             for name, value in labels)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def exposition(metrics):
+    """Format metrics as returned by collect in Prometheus text format
+    """
+
+    samples = {}
+    for kind in ['counters', 'gauges']:
+        for key, value in sorted(metrics[kind].items()):
+            name, labels = json.loads(key)
+            samples.setdefault(name, []).append(
+                '%s%s %s' % (name, format_labels(labels),
+                             format_value(value)))
+
+    for key, histogram in sorted(metrics['histograms'].items()):
+        name, labels = json.loads(key)
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ['+Inf'], histogram['buckets']):
+            cumulative += count
+            if bound != '+Inf':
+                bound = repr(float(bound))
+            lines.append('%s_bucket%s %i' % (name,
+                                             format_labels(labels +
+                                                           [['le', bound]]),
+                                             cumulative))
+        lines.append('%s_sum%s %s' % (name, format_labels(labels),
+                                      format_value(histogram['sum'])))
+        lines.append('%s_count%s %i' % (name, format_labels(labels),
+                                        histogram['count']))
+
+    # Hit ratios follow from the counters of all processes
+    hits = {}
+    misses = {}
+    for key, value in metrics['counters'].items():
+        name, labels = json.loads(key)
+        if name == 'safe_cache_hits_total':
+            hits[tuple(map(tuple, labels))] = value
+        elif name == 'safe_cache_misses_total':
+            misses[tuple(map(tuple, labels))] = value
+    for labels in sorted(set(hits) | set(misses)):
+        lookups = hits.get(labels, 0) + misses.get(labels, 0)
+        if lookups > 0:
+            samples.setdefault('safe_cache_hit_ratio', []).append(
+                'safe_cache_hit_ratio%s %s' % (format_labels(labels),
+                                               repr(hits.get(labels, 0) /
+                                                    float(lookups))))
+
+    output = []
+    for name in sorted(samples):
+        kind, text = METRICS.get(name, ('untyped', name))
+        output.append('# HELP %s %s' % (name, text))
+        output.append('# TYPE %s %s' % (name, kind))
+        output.extend(samples[name])
+
+    return '\n'.join(output) + '\n'
+
+
+# Metrics of this process
+STORE = MetricsStore(METRICS_DIR)
+atexit.register(lambda: STORE.close())
+
+
+def inc(name, value=1, **labels):
+    """Add value to counter name of this process
+    """
+
+    STORE.inc(name, value, **labels)
+
+
+def add(name, value, **labels):
+    """Add value to gauge name of this process
+    """
+
+    STORE.add(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    """Record value in histogram name of this process
+    """
+
+    STORE.observe(name, value, **labels)
+
+
+def render():
+    """Get metrics of all processes in Prometheus text format
+    """
+
+    return exposition(STORE.collect())
+
+
+def timed(view):
+    """Decorator counting requests and their duration for a view
+
+    Requests are labelled with view and the status code of the response,
+    500 if the view raised an exception.
+    """
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(request, *args, **kwargs):
+            start = time.time()
+            status = 500
+            try:
+                response = function(request, *args, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                inc('safe_requests_total', view=view, status=str(status))
+                observe('safe_request_duration_seconds',
+                        time.time() - start, view=view)
+
+        return wrapper
+
+    return decorator
+
+
+def in_flight(name):
+    """Decorator counting running calls of a function in gauge name
+    """
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            add(name, 1)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add(name, -1)
+
+        return wrapper
+
+    return decorator
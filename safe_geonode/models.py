@@ -1,10 +1,24 @@
 from __future__ import division
 from django.db import models
 from django.contrib.auth.models import User
+from geonode.layers.models import Layer
+from geonode.utils import ogc_server_settings
 from pygments import highlight
 from pygments.lexers import PythonLexer
 from pygments.formatters import HtmlFormatter
+from django.utils import simplejson as json
 import datetime
+import time
+
+# States of a calculation. Queued calculations are run by a worker.
+CALCULATION_STATUS = (('queued', 'Queued'),
+                      ('running', 'Running'),
+                      ('finished', 'Finished'),
+                      ('failed', 'Failed'))
+
+# Stages of a running calculation in the order they are run
+CALCULATION_STAGES = ['metadata', 'download', 'calculation', 'upload',
+                      'output']
 
 
 class Calculation(models.Model):
@@ -26,6 +40,37 @@ class Calculation(models.Model):
     stacktrace = models.TextField(null=True, blank=True)
     layer = models.CharField(max_length=255, null=True, blank=True)
 
+    # Progress of the calculation, stage is one of CALCULATION_STAGES
+    # while running and progress goes from 0 to 1
+    status = models.CharField(max_length=16, choices=CALCULATION_STATUS,
+                              default='queued')
+    stage = models.CharField(max_length=32, null=True, blank=True)
+    progress = models.FloatField(default=0)
+
+    # JSON output of a finished calculation as returned by the API
+    result = models.TextField(null=True, blank=True)
+
+    # Resolution rasters were downloaded at as 'resx,resy' and why it
+    # was chosen, see plan_resolution
+    resolution = models.CharField(max_length=255, null=True, blank=True)
+    resolution_reason = models.TextField(null=True, blank=True)
+
+    # Hash of layers, impact function source, bounding box and resolution.
+    # Calculations with the same key produce the same impact layer.
+    cache_key = models.CharField(max_length=40, null=True, blank=True,
+                                 db_index=True)
+
+    # Seconds spent in each stage as JSON, see set_stage
+    timings = models.TextField(null=True, blank=True)
+
+    # Resources used: bytes transferred to download the layers, number
+    # of vector features and raster pixels of the downloaded layers and
+    # peak resident memory of the process running the calculation
+    bytes_downloaded = models.BigIntegerField(null=True, blank=True)
+    features = models.BigIntegerField(null=True, blank=True)
+    pixels = models.BigIntegerField(null=True, blank=True)
+    peak_rss = models.BigIntegerField(null=True, blank=True)
+
     @property
     def url(self):
         return self.layer.url
@@ -36,6 +81,42 @@ class Calculation(models.Model):
     def pretty_function_source(self):
         return highlight(self.impact_function_source, PythonLexer(), HtmlFormatter())
 
+    def set_stage(self, stage, progress):
+        """Record that the calculation entered a new stage
+
+        The time spent in the previous stage is added to timings.
+        """
+
+        now = time.time()
+        self.end_stage(now)
+        self._stage_started = now
+
+        self.status = 'running'
+        self.stage = stage
+        self.progress = progress
+        self.save()
+
+    def end_stage(self, now=None):
+        """Add the time spent in the current stage to timings
+        """
+
+        started = getattr(self, '_stage_started', None)
+        if self.stage is not None and started is not None:
+            if now is None:
+                now = time.time()
+            timings = self.get_timings()
+            timings[self.stage] = timings.get(self.stage, 0) + now - started
+            self.timings = json.dumps(timings)
+        self._stage_started = None
+
+    def get_timings(self):
+        """Get dictionary of seconds spent in each stage
+        """
+
+        if not self.timings:
+            return {}
+        return json.loads(self.timings)
+
     def __unicode__(self):
         if self.success:
             name = 'Sucessful Calculation'
@@ -44,14 +125,143 @@ class Calculation(models.Model):
         return '%s at %s' % (name, self.run_date)
 
 
+class CalculationJob(models.Model):
+    """Queued calculation waiting for or claimed by a worker
+
+    Workers started with the safeworker command claim a job by setting
+    worker to their node name. While running it they update heartbeat;
+    jobs whose heartbeat is older than the lease are claimed again.
+    """
+
+    calculation = models.OneToOneField(Calculation, related_name='job')
+    requested_bbox = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    worker = models.CharField(max_length=255, null=True, blank=True)
+    heartbeat = models.DateTimeField(null=True, blank=True, db_index=True)
+    attempts = models.IntegerField(default=0)
+    done = models.BooleanField(default=False, db_index=True)
+
+    def __unicode__(self):
+        return 'Job for calculation %s' % self.calculation_id
+
+
+class PerformanceProfile(models.Model):
+    """cProfile statistics of a slow request or calculation
+
+    Captured by safe_geonode.profiling. stats holds the base64 encoded
+    contents of a file written by cProfile, as read by pstats.
+    """
+
+    calculation = models.ForeignKey(Calculation, null=True, blank=True,
+                                    related_name='profiles')
+    name = models.CharField(max_length=64, db_index=True)
+    path = models.CharField(max_length=255, null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    duration = models.FloatField()
+    stats = models.TextField()
+
+    def __unicode__(self):
+        return 'Profile of %s taking %.2f seconds' % (self.name,
+                                                      self.duration)
+
+
 class Server(models.Model):
     name = models.CharField(max_length=255)
     url = models.URLField()
 
+    # Rasters wider or higher than tile_size pixels are downloaded as tiles
+    # using up to download_threads concurrent requests.
+    # If None, SAFE_WCS_TILE_SIZE and SAFE_WCS_DOWNLOAD_THREADS are used.
+    tile_size = models.IntegerField(null=True, blank=True)
+    download_threads = models.IntegerField(null=True, blank=True)
+
     def __unicode__(self):
         return self.name
 
 
+class LayerMetadata(models.Model):
+    """Metadata of a layer published by an OWS server
+
+    Entries are written whenever metadata is fetched from a server, see
+    safe_geonode.catalog, so most lookups are answered by the database.
+    The bounding box, layer type and category are columns so layers can
+    be queried by them.
+    """
+
+    server_url = models.CharField(max_length=255, db_index=True)
+    name = models.CharField(max_length=255, db_index=True)
+    title = models.TextField(null=True, blank=True)
+    layertype = models.CharField(max_length=16, db_index=True)
+    category = models.CharField(max_length=64, null=True, blank=True,
+                                db_index=True)
+    minx = models.FloatField(db_index=True)
+    miny = models.FloatField(db_index=True)
+    maxx = models.FloatField(db_index=True)
+    maxy = models.FloatField(db_index=True)
+
+    # JSON encoded values as found in the dictionaries of get_metadata
+    geotransform = models.TextField(null=True, blank=True)
+    resolution = models.TextField(null=True, blank=True)
+    keywords = models.TextField()
+
+    tile_url = models.TextField(null=True, blank=True)
+    synced = models.DateTimeField(db_index=True)
+
+    @classmethod
+    def from_metadata(cls, server_url, name, metadata, synced):
+        """Create entry from a dictionary as returned by get_metadata
+        """
+
+        minx, miny, maxx, maxy = metadata['bounding_box']
+        return cls(server_url=server_url,
+                   name=name,
+                   title=metadata['title'],
+                   layertype=metadata['layertype'],
+                   category=metadata['keywords'].get('category'),
+                   minx=minx, miny=miny, maxx=maxx, maxy=maxy,
+                   geotransform=json.dumps(metadata['geotransform']),
+                   resolution=json.dumps(metadata['resolution']),
+                   keywords=json.dumps(metadata['keywords']),
+                   tile_url=metadata.get('tile_url'),
+                   synced=synced)
+
+    def to_metadata(self):
+        """Get dictionary of the form returned by get_metadata
+        """
+
+        geotransform = json.loads(self.geotransform)
+        if geotransform is not None:
+            geotransform = tuple(geotransform)
+
+        resolution = json.loads(self.resolution)
+        if resolution is not None:
+            resolution = tuple(resolution)
+
+        return {'layertype': self.layertype,
+                'geotransform': geotransform,
+                'resolution': resolution,
+                'bounding_box': (self.minx, self.miny, self.maxx, self.maxy),
+                'title': self.title,
+                'id': self.name,
+                'keywords': json.loads(self.keywords),
+                'server_url': self.server_url,
+                'tile_url': self.tile_url}
+
+    def __unicode__(self):
+        return '%s on %s' % (self.name, self.server_url)
+
+
+class CatalogSync(models.Model):
+    """Time at which all layers of a server were last written to the catalog
+    """
+
+    server_url = models.CharField(max_length=255, unique=True)
+    synced = models.DateTimeField()
+
+    def __unicode__(self):
+        return '%s synchronized at %s' % (self.server_url, self.synced)
+
+
 class Workspace(models.Model):
     user = models.ForeignKey(User)
     servers = models.ManyToManyField(Server)
@@ -68,3 +278,14 @@ def duration(sender, **kwargs):
     instance.run_duration = round(duration, 2)
 
 models.signals.pre_save.connect(duration, sender=Calculation)
+
+
+def forget_deleted_layer(sender, **kwargs):
+    """Remove layers deleted from GeoNode from the layer catalog
+    """
+
+    instance = kwargs['instance']
+    LayerMetadata.objects.filter(server_url=ogc_server_settings.ows,
+                                 name=instance.typename).delete()
+
+models.signals.post_delete.connect(forget_deleted_layer, sender=Layer)
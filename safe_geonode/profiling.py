@@ -0,0 +1,195 @@
+"""Profiling of slow requests and calculations
+
+   Functions decorated with profiled are run under cProfile when their
+   name is listed in SAFE_PROFILE. Profiles of runs taking longer than
+   SAFE_PROFILE_THRESHOLD seconds are stored as PerformanceProfile rows,
+   linked to the calculation they belong to, and can be downloaded by
+   staff through the profile view. Profiling is off by default.
+
+   Configured in the Django settings:
+
+   SAFE_PROFILE: Names of profiled functions, calculate and questions ([])
+   SAFE_PROFILE_THRESHOLD: Seconds a run must take to be stored (10)
+   SAFE_PROFILE_RATE: Fraction of runs that are profiled (1.0)
+
+   cProfile only sees the thread it was started in, so the time spent
+   in concurrent downloads shows up as waiting in run_stage.
+"""
+
+import os
+import time
+import pstats
+import random
+import base64
+import cProfile
+import tempfile
+import functools
+import threading
+
+from django.conf import settings
+
+from safe_geonode.models import Calculation, PerformanceProfile
+
+PROFILE = getattr(settings, 'SAFE_PROFILE', [])
+THRESHOLD = getattr(settings, 'SAFE_PROFILE_THRESHOLD', 10)
+RATE = getattr(settings, 'SAFE_PROFILE_RATE', 1.0)
+
+# Maximal depth and number of stacks in the collapsed format
+MAX_STACK_DEPTH = 100
+MAX_STACKS = 100000
+
+# Stacks taking less time are not followed, the output is in microseconds
+MIN_STACK_SECONDS = 1.0e-6
+
+# Only one profiler can run in a thread at a time
+_local = threading.local()
+
+
+def profiled(name):
+    """Decorator profiling function if name is in SAFE_PROFILE
+
+    The profile is linked to a calculation if the first argument is a
+    Calculation or has one as its calculation attribute, like requests
+    handled by calculate.
+    """
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if (name not in PROFILE or getattr(_local, 'active', False) or
+                random.random() >= RATE):
+                return function(*args, **kwargs)
+
+            profiler = cProfile.Profile()
+            _local.active = True
+            start = time.time()
+            try:
+                return profiler.runcall(function, *args, **kwargs)
+            finally:
+                duration = time.time() - start
+                _local.active = False
+                if duration >= THRESHOLD:
+                    target = args[0] if args else None
+                    if isinstance(target, Calculation):
+                        calculation = target
+                    else:
+                        calculation = getattr(target, 'calculation', None)
+                    save_profile(profiler, name, duration,
+                                 calculation=calculation,
+                                 path=getattr(target, 'path', None))
+
+        return wrapper
+
+    return decorator
+
+
+def save_profile(profiler, name, duration, calculation=None, path=None):
+    """Store statistics of profiler as a PerformanceProfile
+
+    Input
+        profiler: cProfile.Profile that has been run
+        name: Name of the profiled function
+        duration: Seconds the profiled run took
+        calculation: Optional Calculation the run belongs to
+        path: Optional path of the profiled request
+
+    Output
+        Saved PerformanceProfile
+    """
+
+    fd, filename = tempfile.mkstemp(suffix='.prof')
+    os.close(fd)
+    try:
+        profiler.dump_stats(filename)
+        with open(filename, 'rb') as fid:
+            stats = base64.b64encode(fid.read())
+    finally:
+        os.remove(filename)
+
+    if calculation is not None and calculation.id is None:
+        # Calculations are only saved once they started
+        calculation = None
+
+    return PerformanceProfile.objects.create(calculation=calculation,
+                                             name=name, path=path,
+                                             duration=duration, stats=stats)
+
+
+def load_stats(profile):
+    """Get pstats.Stats of a PerformanceProfile
+    """
+
+    fd, filename = tempfile.mkstemp(suffix='.prof')
+    try:
+        with os.fdopen(fd, 'wb') as fid:
+            fid.write(get_pstats(profile))
+        return pstats.Stats(filename)
+    finally:
+        os.remove(filename)
+
+
+def get_pstats(profile):
+    """Get contents of the file written by cProfile for a profile
+    """
+
+    return base64.b64decode(profile.stats)
+
+
+def collapse_stats(stats):
+    """Convert profile statistics into collapsed stacks
+
+    Input
+        stats: pstats.Stats
+
+    Output
+        List of lines 'caller;...;function microseconds' sorted by stack
+        as read by flamegraph.pl and speedscope
+
+    cProfile records callers but not complete stacks, so the time of a
+    function is split among its callers in proportion to the time spent
+    in calls from each of them. Recursion is cut off, as are stacks
+    taking less than a microsecond and stacks beyond the first
+    MAX_STACKS, so large call graphs with many paths between functions
+    are summarised in bounded time.
+    """
+
+    children = {}
+    for function, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            # Edge is (cc, nc, tt, ct) of calls from caller
+            children.setdefault(caller, []).append((function, edge[3]))
+
+    lines = {}
+    visited = [0]
+
+    def walk(function, stack, seconds):
+        if seconds < MIN_STACK_SECONDS or visited[0] >= MAX_STACKS:
+            return
+        visited[0] += 1
+
+        cc, nc, tt, ct, callers = stats.stats[function]
+        stack = stack + [pstats.func_std_string(function)]
+
+        if ct > 0:
+            own = seconds * tt / ct
+        else:
+            own = 0
+        key = ';'.join(stack)
+        lines[key] = lines.get(key, 0) + own
+
+        if len(stack) >= MAX_STACK_DEPTH or ct <= 0:
+            return
+
+        for child, child_seconds in children.get(function, []):
+            if pstats.func_std_string(child) in stack:
+                continue
+            walk(child, stack, seconds * child_seconds / ct)
+
+    for function, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers:
+            walk(function, [], ct)
+
+    return ['%s %i' % (key, round(seconds * 1e6))
+            for key, seconds in sorted(lines.items())
+            if round(seconds * 1e6) > 0]
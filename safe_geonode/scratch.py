@@ -0,0 +1,229 @@
+"""Scratch space for downloads and conversions
+
+   All temporary files written by safe_geonode live in directories below
+   one scratch root. Work that belongs to one request, such as a
+   calculation, runs inside a workspace which is removed when it ends.
+   Directories created outside a workspace are removed once they are
+   older than SAFE_SCRATCH_MAX_AGE seconds. Whenever the scratch root
+   grows beyond SAFE_SCRATCH_QUOTA bytes, the oldest directories not
+   belonging to a running workspace are removed first.
+
+   Set SAFE_SCRATCH_USE_TMPFS to True to place the scratch root on
+   /dev/shm when no SAFE_SCRATCH_DIR is given.
+"""
+
+import os
+import time
+import errno
+import shutil
+import functools
+import tempfile
+import threading
+import contextlib
+
+from django.conf import settings
+
+# Marker file holding the process id of the owner of an active workspace
+ACTIVE_MARKER = '.active'
+
+# Minimal number of seconds between two scans for eviction
+EVICTION_INTERVAL = 30
+
+
+def default_root():
+    """Get scratch root from the settings
+    """
+
+    root = getattr(settings, 'SAFE_SCRATCH_DIR', None)
+    if root is not None:
+        return root
+
+    if (getattr(settings, 'SAFE_SCRATCH_USE_TMPFS', False) and
+        os.path.isdir('/dev/shm')):
+        return os.path.join('/dev/shm', 'safe_scratch')
+    else:
+        return os.path.join(tempfile.gettempdir(), 'safe_scratch')
+
+
+def is_process_alive(pid):
+    """Determine if a process with the given id is running on this host
+    """
+
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    else:
+        return True
+
+
+def directory_size(dirname):
+    """Get total size in bytes of all files below dirname
+    """
+
+    total = 0
+    for root, dirs, files in os.walk(dirname):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # Removed in the meantime
+                pass
+    return total
+
+
+class ScratchSpace(object):
+    """Manager of temporary directories below a common root
+
+    Input
+        root: Directory holding all scratch directories
+        quota: Maximal number of bytes used below root
+        max_age: Seconds after which directories outside of running
+                 workspaces are removed
+    """
+
+    def __init__(self, root, quota=4 * 1024 ** 3, max_age=6 * 3600):
+        self.root = root
+        self.quota = quota
+        self.max_age = max_age
+        self._local = threading.local()
+        self._last_eviction = 0
+
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                # Created by another process in the meantime
+                pass
+
+    def current(self):
+        """Get the workspace of the current thread or None
+        """
+
+        return getattr(self._local, 'workspace', None)
+
+    @contextlib.contextmanager
+    def use(self, workspace):
+        """Make workspace the current one for the calling thread
+
+        Use this to share a workspace with threads started by its owner.
+        """
+
+        previous = self.current()
+        self._local.workspace = workspace
+        try:
+            yield workspace
+        finally:
+            self._local.workspace = previous
+
+    @contextlib.contextmanager
+    def workspace(self):
+        """Create a workspace which is removed with its contents on exit
+
+        Directories from mkdtemp are created inside the workspace while
+        it is the current one.
+        """
+
+        self.evict()
+
+        workspace = tempfile.mkdtemp(prefix='%i-' % os.getpid(),
+                                     dir=self.root)
+        with open(os.path.join(workspace, ACTIVE_MARKER), 'w') as fid:
+            fid.write(str(os.getpid()))
+
+        try:
+            with self.use(workspace):
+                yield workspace
+        finally:
+            self.remove(workspace)
+
+    def mkdtemp(self, prefix='safe-'):
+        """Create a unique directory in the current workspace or the root
+        """
+
+        workspace = self.current()
+        if workspace is None:
+            self.evict()
+            return tempfile.mkdtemp(prefix=prefix, dir=self.root)
+        else:
+            return tempfile.mkdtemp(prefix=prefix, dir=workspace)
+
+    def remove(self, dirname):
+        """Remove directory and its contents
+        """
+
+        shutil.rmtree(dirname, ignore_errors=True)
+
+    def is_active(self, dirname):
+        """Determine if dirname is a workspace of a running process
+        """
+
+        try:
+            with open(os.path.join(dirname, ACTIVE_MARKER)) as fid:
+                pid = int(fid.read())
+        except (IOError, ValueError):
+            return False
+
+        return is_process_alive(pid)
+
+    def evict(self, force=False):
+        """Remove expired directories and enforce the quota
+
+        Scans happen at most every EVICTION_INTERVAL seconds unless
+        force is True.
+        """
+
+        now = time.time()
+        if not force and now - self._last_eviction < EVICTION_INTERVAL:
+            return
+        self._last_eviction = now
+
+        candidates = []
+        total = 0
+        for name in os.listdir(self.root):
+            dirname = os.path.join(self.root, name)
+            try:
+                modified = os.path.getmtime(dirname)
+            except OSError:
+                continue
+
+            size = directory_size(dirname)
+            total += size
+            if self.is_active(dirname):
+                continue
+
+            if now - modified > self.max_age:
+                self.remove(dirname)
+                total -= size
+            else:
+                candidates.append((modified, size, dirname))
+
+        # Remove oldest directories until quota is met
+        candidates.sort()
+        for modified, size, dirname in candidates:
+            if total <= self.quota:
+                break
+            self.remove(dirname)
+            total -= size
+
+
+def with_workspace(function):
+    """Decorator running function inside a workspace of SCRATCH
+
+    All scratch files created by function are removed when it returns.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with SCRATCH.workspace():
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+# Scratch space used by this process
+SCRATCH = ScratchSpace(default_root(),
+                       quota=getattr(settings, 'SAFE_SCRATCH_QUOTA',
+                                     4 * 1024 ** 3),
+                       max_age=getattr(settings, 'SAFE_SCRATCH_MAX_AGE',
+                                       6 * 3600))
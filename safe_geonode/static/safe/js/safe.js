@@ -102,11 +102,28 @@ function calculate(hazard_name, exposure_name, function_name) {
                 keywords: 'safe',
                 impact_function: function_name
             },
-            success: received,
+            success: calculation_queued,
             error: calculation_error
         });
 };
 
+// Poll status of a queued calculation until it is done
+function calculation_queued(data) {
+    $.ajax({
+        url: data.status_url,
+        success: function(status) {
+            if (status.status == 'finished') {
+                received(status.result);
+            } else if (status.status == 'failed') {
+                calculation_error(status);
+            } else {
+                setTimeout(function() { calculation_queued(data); }, 2000);
+            }
+        },
+        error: calculation_error
+    });
+};
+
 function get_options(items){
     var options = "<option value=\"\">-> Choose one ...</option>";
     for(var key in items){
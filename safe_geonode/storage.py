@@ -6,18 +6,26 @@
 
 import os
 import sys
+import copy
+import json
+import socket
+import httplib
 import time
 import numpy
-import urllib2
+import datetime
+import shutil
 import tempfile
 import contextlib
 import logging
 
 from zipfile import ZipFile
+from xml.etree import ElementTree as etree
 
 from safe_geonode.utilities import LAYER_TYPES
-from safe_geonode.utilities import WCS_TEMPLATE
 from safe_geonode.utilities import WFS_TEMPLATE
+from safe_geonode.utilities import WCS_TILE_TEMPLATE
+from safe_geonode.utilities import CAPABILITIES_TEMPLATE
+from safe_geonode.utilities import WFS_HITS_TEMPLATE
 from safe_geonode.utilities import extract_WGS84_geotransform
 from safe_geonode.utilities import is_sequence
 from safe_geonode.utilities import unique_filename
@@ -26,12 +34,23 @@ from safe_geonode.utilities import geotransform2resolution
 from safe_geonode.utilities import get_bounding_box
 from safe_geonode.utilities import bboxlist2string
 from safe_geonode.utilities import check_bbox_string
+from safe_geonode.utilities import bboxstring2list
+from safe_geonode.utilities import get_raster_grid
+from safe_geonode.utilities import run_in_threads, check_cancelled
+from safe_geonode.models import Server
+from safe_geonode.cache import TTLCache, DownloadCache, make_key
+from safe_geonode import httpclient
+from safe_geonode import catalog
+from safe_geonode import metrics
+from safe_geonode.scratch import SCRATCH
 
 # Do we really need to import these objects? should they be part of the API?
 from safe.storage.vector import Vector
 from safe.storage.raster import Raster
 from safe.api import read_layer
 
+from osgeo import gdal, ogr
+
 from owslib.wcs import WebCoverageService
 from owslib.wfs import WebFeatureService
 
@@ -39,10 +58,65 @@ from geonode.layers.utils import file_upload, GeoNodeException
 from geonode.layers.models import Layer
 from geonode.utils import ogc_server_settings
 
+from django.conf import settings
+
 logger = logging.getLogger(__name__)
 
 INTERNAL_SERVER_URL = ogc_server_settings.ows
 
+# Number of bytes read from the network at a time when downloading layers
+DOWNLOAD_CHUNK_SIZE = getattr(settings, 'SAFE_DOWNLOAD_CHUNK_SIZE', 64 * 1024)
+
+# Parsed layer metadata per server url. Entries are shared between threads
+# and must never be modified, get_metadata hands out copies.
+METADATA_CACHE = TTLCache(
+    timeout=getattr(settings, 'SAFE_METADATA_CACHE_TIMEOUT', 300),
+    max_entries=getattr(settings, 'SAFE_METADATA_CACHE_MAX_ENTRIES', 32),
+    name='metadata')
+
+# Metadata of single layers keyed by (server url, layer name)
+LAYER_METADATA_CACHE = TTLCache(
+    timeout=getattr(settings, 'SAFE_METADATA_CACHE_TIMEOUT', 300),
+    max_entries=getattr(settings, 'SAFE_LAYER_METADATA_CACHE_MAX_ENTRIES',
+                        1024),
+    name='layer_metadata')
+
+# Servers whose per-layer virtual services recently failed for a layer
+# they publish. Layers of these servers are looked up in the capabilities
+# of the server directly.
+NO_VIRTUAL_SERVICES = TTLCache(
+    timeout=getattr(settings, 'SAFE_METADATA_CACHE_TIMEOUT', 300),
+    max_entries=256)
+
+# Servers that recently answered a request, see check_server_reachable
+REACHABLE_SERVERS = TTLCache(
+    timeout=getattr(settings, 'SAFE_REACHABILITY_CACHE_TIMEOUT', 60),
+    max_entries=256, name='reachable_servers')
+
+# Downloaded layers shared by all worker processes on this host.
+# Set SAFE_DOWNLOAD_CACHE_DIR to None to disable. Entries are keyed by
+# get_layer_stamp. Layers of remote servers overwritten without changing
+# their extent, grid or keywords are served from the cache until the
+# entries are SAFE_DOWNLOAD_CACHE_TIMEOUT seconds old.
+DOWNLOAD_CACHE_DIR = getattr(settings, 'SAFE_DOWNLOAD_CACHE_DIR',
+                             os.path.join(tempfile.gettempdir(),
+                                          'safe_download_cache'))
+if DOWNLOAD_CACHE_DIR is None:
+    DOWNLOAD_CACHE = None
+else:
+    DOWNLOAD_CACHE = DownloadCache(
+        DOWNLOAD_CACHE_DIR,
+        max_size=getattr(settings, 'SAFE_DOWNLOAD_CACHE_SIZE', 2 * 1024 ** 3),
+        timeout=getattr(settings, 'SAFE_DOWNLOAD_CACHE_TIMEOUT', 24 * 3600),
+        name='download')
+
+# Default tiling of large WCS requests, see Server.tile_size
+WCS_TILE_SIZE = getattr(settings, 'SAFE_WCS_TILE_SIZE', 2048)
+WCS_DOWNLOAD_THREADS = getattr(settings, 'SAFE_WCS_DOWNLOAD_THREADS', 4)
+
+# Number of downloads produced by clipping a cached layer
+DOWNLOAD_STATS = {'clipped': 0}
+
 def write_raster_data(data, projection, geotransform, filename, keywords=None):
     """Write array to raster file with specified metadata and one data layer
 
@@ -111,19 +185,24 @@ def get_geotransform(server_url, layer_name):
     return metadata['geotransform']
 
 
-def get_metadata_from_layer(layer):
+def get_metadata_from_layer(layer, datatype=None):
     """Get ows metadata from one layer
 
     Input
-        layer: Layer object. It is assumed that it has the extra attribute
-               data_type which is either raster or vector
+        layer: Layer object e.g. obtained from WebCoverageService
+        datatype: Either 'raster' or 'vector'. If None, the layer is
+                  assumed to have the extra attribute datatype.
     """
+
+    if datatype is None:
+        datatype = layer.datatype
+
     # Create empty metadata dictionary
     metadata = {}
 
     # Metadata specific to layer types
-    metadata['layertype'] = layer.datatype
-    if layer.datatype == 'raster':
+    metadata['layertype'] = datatype
+    if datatype == 'raster':
         geotransform = extract_WGS84_geotransform(layer)
         metadata['geotransform'] = geotransform
         metadata['resolution'] = geotransform2resolution(geotransform,
@@ -160,7 +239,7 @@ def get_metadata_from_layer(layer):
     if metadata['resolution'] is not None:
         keyword_dict['resolution'] = round(metadata['resolution'][0], 5)
 
-    keyword_dict['layertype'] = layer.datatype
+    keyword_dict['layertype'] = datatype
 
     if 'title' in keyword_dict:
         metadata['title'] = keyword_dict['title']
@@ -174,6 +253,173 @@ def get_metadata_from_layer(layer):
     return metadata
 
 
+def get_tile_url(server_url, layer_name):
+    """Get the GeoWebCache tile url template for a layer
+    """
+
+    #FIXME(Ariel): This is a weak way of finding the geoserver_url
+    geoserver_url = server_url[:-4]
+
+    return ("%s/gwc/service/gmaps?layers=%s&zoom={z}&x={x}&y={y}"
+            "&format=image/png" % (geoserver_url, layer_name))
+
+
+def check_server_reachable(server_url):
+    """Raise an exception if server_url does not answer requests
+
+    Successful answers are remembered for SAFE_REACHABILITY_CACHE_TIMEOUT
+    seconds and any capabilities request marks a server as reachable,
+    so this rarely costs a request of its own.
+    """
+
+    if server_url in REACHABLE_SERVERS:
+        return
+
+    try:
+        httpclient.get(server_url)
+    except Exception, e:
+        msg = ('Argument server_url doesn\'t appear to be a valid URL'
+               'I got %s. Error message was: %s' % (server_url, str(e)))
+        raise Exception(msg)
+
+    REACHABLE_SERVERS.set(server_url, True)
+
+
+def get_wcs(server_url):
+    """Get WebCoverageService for server, fetching capabilities via the pool
+    """
+
+    xml = httpclient.get(CAPABILITIES_TEMPLATE % (server_url, 'WCS'))
+    return WebCoverageService(server_url, xml=xml, version='1.0.0')
+
+
+def get_wfs(server_url):
+    """Get WebFeatureService for server, fetching capabilities via the pool
+    """
+
+    xml = httpclient.get(CAPABILITIES_TEMPLATE % (server_url, 'WFS'))
+    return WebFeatureService(server_url, xml=xml, version='1.0.0')
+
+
+def get_server_metadata(server_url):
+    """Get metadata for all layers on a server bypassing the cache
+
+    Input
+        server_url: e.g. http://localhost:8001/geoserver-geonode-dev/ows
+
+    Output
+        metadata: Dictionary of metadata dictionaries, one per layer
+    """
+
+    wcs = get_wcs(server_url)
+    wfs = get_wfs(server_url)
+    REACHABLE_SERVERS.set(server_url, True)
+
+    metadata = {}
+    for contents, datatype in [(wfs.contents, 'vector'),
+                               (wcs.contents, 'raster')]:
+        for name, layer in contents.items():
+            layer_metadata = get_metadata_from_layer(layer, datatype)
+            layer_metadata['server_url'] = server_url
+            layer_metadata['tile_url'] = get_tile_url(server_url, name)
+
+            metadata[name] = layer_metadata
+
+    return metadata
+
+
+def get_layer_metadata(server_url, layer_name):
+    """Get metadata for one layer bypassing the cache
+
+    Input
+        server_url: e.g. http://localhost:8001/geoserver-geonode-dev/ows
+        layer_name: Name of layer of the form workspace:name
+
+    Output
+        metadata: Dictionary of metadata fields for specified layer
+
+    GeoServer publishes every layer as a virtual service at
+    <geoserver>/<workspace>/<name>/ows whose capabilities only describe
+    that layer. This makes the cost independent of the number of layers
+    on the server. The grid needed for the geotransform is fetched by
+    OWSLib with a DescribeCoverage request for this coverage only.
+
+    Raises an exception if the layer is not found, in which case callers
+    should fall back to get_server_metadata.
+    """
+
+    workspace, name = layer_name.split(':')
+
+    #FIXME(Ariel): This is a weak way of finding the geoserver_url
+    layer_url = '%s/%s/%s/ows' % (server_url[:-4], workspace, name)
+
+    # Virtual services may list layers without the workspace prefix
+    candidates = [layer_name, name]
+
+    # Try vector first as it does not require a DescribeCoverage request
+    for service, datatype in [(get_wfs, 'vector'),
+                              (get_wcs, 'raster')]:
+        contents = service(layer_url).contents
+        for candidate in candidates:
+            if candidate in contents:
+                layer = contents[candidate]
+                metadata = get_metadata_from_layer(layer, datatype)
+
+                REACHABLE_SERVERS.set(server_url, True)
+
+                # Report the fully qualified name like the global service
+                metadata['id'] = layer_name
+                metadata['server_url'] = server_url
+                metadata['tile_url'] = get_tile_url(server_url, layer_name)
+                return metadata
+
+    msg = ('Layer %s was not found in WxS contents of virtual service %s'
+           % (layer_name, layer_url))
+    raise Exception(msg)
+
+
+def sync_catalog(server_url):
+    """Fetch metadata of all layers of a server and store it
+
+    The in memory cache and the layer catalog are both updated.
+
+    Output
+        metadata: Dictionary of metadata dictionaries, one per layer
+    """
+
+    metadata = get_server_metadata(server_url)
+    METADATA_CACHE.set(server_url, metadata)
+    catalog.store_server(server_url, metadata)
+    return metadata
+
+
+def invalidate_metadata(server_url=None, layer_name=None):
+    """Forget cached metadata for server_url or for all servers if None
+
+    If layer_name is given, only that layer of server_url is forgotten.
+    The capabilities of the server stay cached without it, so the layer
+    is looked up on its own the next time.
+    """
+
+    if layer_name is not None:
+        def without_layer(metadata):
+            metadata = dict(metadata)
+            metadata.pop(layer_name, None)
+            return metadata
+
+        LAYER_METADATA_CACHE.invalidate((server_url, layer_name))
+        METADATA_CACHE.update(server_url, without_layer)
+        return
+
+    METADATA_CACHE.invalidate(server_url)
+    NO_VIRTUAL_SERVICES.invalidate(server_url)
+    if server_url is None:
+        LAYER_METADATA_CACHE.invalidate()
+    else:
+        LAYER_METADATA_CACHE.invalidate_where(
+                                lambda key: key[0] == server_url)
+
+
 def get_metadata(server_url, layer_name=None):
     """Uses OWSLib to get the metadata for a given layer
 
@@ -186,79 +432,647 @@ def get_metadata(server_url, layer_name=None):
     Output
         metadata: Dictionary of metadata fields for specified layer or,
                   if layer_name is None, a dictionary of metadata dictionaries
+
+    Capabilities are cached per server for SAFE_METADATA_CACHE_TIMEOUT
+    seconds. Otherwise metadata is taken from the layer catalog in the
+    database, see safe_geonode.catalog. Only if that fails, a single
+    layer is looked up through its own virtual service and all layers
+    through the capabilities of the server. Fetched metadata is written
+    to the catalog. Servers whose virtual services fail are asked for
+    their capabilities right away for SAFE_METADATA_CACHE_TIMEOUT seconds.
+    A server is only marked so if its capabilities list the layer and the
+    virtual service answered with an error, not for missing layers or
+    connection failures.
     """
 
-    # Get all metadata from server
-    wcs = WebCoverageService(server_url, version='1.0.0')
-    wfs = WebFeatureService(server_url, version='1.0.0')
+    virtual_failed = False
+    if layer_name is not None:
+        # Use the full capabilities if we already have them
+        metadata = METADATA_CACHE.get(server_url)
+        if metadata is not None and layer_name in metadata:
+            return copy.deepcopy(metadata[layer_name])
+
+        key = (server_url, layer_name)
+        layer_metadata = LAYER_METADATA_CACHE.get(key)
+        if layer_metadata is None:
+            layer_metadata = catalog.get_layer(server_url, layer_name)
+            if layer_metadata is not None:
+                LAYER_METADATA_CACHE.set(key, layer_metadata)
+
+        if (layer_metadata is None and
+            server_url not in NO_VIRTUAL_SERVICES):
+            try:
+                layer_metadata = get_layer_metadata(server_url, layer_name)
+            except (socket.error, httplib.HTTPException), e:
+                # Transient, the virtual service is tried again next time
+                logger.debug('Could not reach virtual service of layer %s '
+                             'on %s: %s' % (layer_name, server_url, e))
+            except Exception, e:
+                logger.debug('Could not get metadata for layer %s from its '
+                             'virtual service, using capabilities of %s '
+                             'instead. Error message was: %s'
+                             % (layer_name, server_url, e))
+                virtual_failed = True
+            else:
+                LAYER_METADATA_CACHE.set(key, layer_metadata)
+                catalog.store_layer(server_url, layer_name, layer_metadata)
+
+                # Keep cached capabilities complete
+                def with_layer(metadata):
+                    metadata = dict(metadata)
+                    metadata[layer_name] = layer_metadata
+                    return metadata
+
+                METADATA_CACHE.update(server_url, with_layer)
+
+        if layer_metadata is not None:
+            return copy.deepcopy(layer_metadata)
+
+    metadata = METADATA_CACHE.get(server_url)
+    if metadata is None and layer_name is None:
+        metadata = catalog.get_server(server_url)
+        if metadata is not None:
+            METADATA_CACHE.set(server_url, metadata)
+
+    fresh = metadata is None
+    if fresh:
+        metadata = sync_catalog(server_url)
 
-    # Take care of input options
+    # Return metadata for all layers
     if layer_name is None:
-        layer_names = wcs.contents.keys() + wfs.contents.keys()
-    else:
-        layer_names = [layer_name]
+        return copy.deepcopy(metadata)
 
-    #FIXME(Ariel): This is a weak way of finding the geoserver_url
-    geoserver_url = server_url[:-4]
+    if layer_name not in metadata and not fresh:
+        # Layer may have been added after capabilities were cached
+        metadata = sync_catalog(server_url)
 
-    # Get metadata for requested layer(s)
-    metadata = {}
-    for name in layer_names:
-        if name in wcs.contents:
-            layer = wcs.contents[name]
-            layer.datatype = 'raster'  # Monkey patch layer type
-        elif name in wfs.contents:
-            layer = wfs.contents[name]
-            layer.datatype = 'vector'  # Monkey patch layer type
-        else:
-            msg = ('Layer %s was not found in WxS contents on server %s.\n'
-                   'WCS contents: %s\n'
-                   'WFS contents: %s\n' % (name, server_url,
-                                           wcs.contents, wfs.contents))
-            raise Exception(msg)
+    if virtual_failed and layer_name in metadata:
+        # The server publishes the layer but not its virtual service.
+        # Do not pay for failing requests again for a while.
+        NO_VIRTUAL_SERVICES.set(server_url, True)
 
-        layer_metadata = get_metadata_from_layer(layer)
+    if layer_name not in metadata:
+        msg = ('Layer %s was not found in WxS contents on server %s.\n'
+               'Available layers: %s\n' % (layer_name, server_url,
+                                             metadata.keys()))
+        raise Exception(msg)
 
-        tile_url =  "%s/gwc/service/gmaps?layers=%s&zoom={z}&x={x}&y={y}&format=image/png" % (geoserver_url, name)
-        layer_metadata['server_url'] = server_url
-        layer_metadata['tile_url'] = tile_url
+    # Return metadata for one layer
+    return copy.deepcopy(metadata[layer_name])
 
-        metadata[name] = layer_metadata
 
-    # Return metadata for one or all layers
-    if layer_name is not None:
-        return metadata[layer_name]
-    else:
-        return metadata
+def get_feature_count(server_url, layer_name, bbox):
+    """Count features of a vector layer within a bounding box
+
+    Input
+        server_url: e.g. http://localhost:8001/geoserver-geonode-dev/ows
+        layer_name: Name of layer of the form workspace:name
+        bbox: Bounding box [W, S, E, N] or string
+
+    Output
+        Number of features as reported by a WFS 1.1.0 GetFeature
+        request with resultType=hits, no features are transferred
+    """
+
+    if not isinstance(bbox, basestring):
+        bbox = bboxlist2string(bbox)
+
+    url = WFS_HITS_TEMPLATE % (server_url, layer_name, bbox)
+    content = httpclient.get(url)
+
+    try:
+        root = etree.fromstring(content)
+        return int(root.get('numberOfFeatures'))
+    except (etree.ParseError, TypeError, ValueError):
+        msg = ('Could not count features of layer %s in %s. '
+               'Server response was: %s' % (layer_name, bbox, content[:500]))
+        raise Exception(msg)
+
+
+def is_service_exception(content_type, head):
+    """Determine if a WCS/WFS response is an OGC exception report
+
+    Input
+        content_type: Mime type of response e.g. 'image/tiff'
+        head: First bytes of response
+
+    Output
+        True if response is an exception report rather than layer data
+
+    Layers are always requested as GeoTIFF or SHAPE-ZIP so any XML
+    response is considered an error.
+    """
+
+    if content_type is not None and 'xml' in content_type:
+        return True
+
+    head = head.lstrip()
+    return head.startswith('<?xml') or '<ServiceException' in head
 
 
-def get_file(download_url, suffix):
+def get_file(download_url, suffix, stats=None, dirname=None):
     """Download a file from an HTTP server.
+
+    Input
+        download_url: URL of file to download
+        suffix: Extension of downloaded file e.g. '.tif'
+        stats: Optional dictionary which will be updated with the number
+               of bytes transferred, the time taken in seconds and the
+               throughput in bytes per second, summed over all downloads
+               it was passed to.
+        dirname: Optional directory to download to. If None a new
+                 scratch directory is created.
+
+    Output
+        filename: Name of downloaded file
+
+    The response is streamed to disk in chunks of DOWNLOAD_CHUNK_SIZE
+    bytes so memory use does not depend on the size of the layer.
+    Errors are detected from the content type and the first chunk.
+    Downloads given up on by run_in_threads stop between chunks with
+    CancelledError.
     """
 
-    tempdir = '/tmp/%s' % str(time.time())
-    os.mkdir(tempdir)
+    if dirname is None:
+        dirname = SCRATCH.mkdtemp()
     t = tempfile.NamedTemporaryFile(delete=False,
                                     suffix=suffix,
-                                    dir=tempdir)
+                                    dir=dirname)
+    filename = os.path.abspath(t.name)
 
-    with contextlib.closing(urllib2.urlopen(download_url)) as f:
-        data = f.read()
+    start = time.time()
+    nbytes = 0
+    try:
+        with contextlib.closing(t):
+            with httpclient.urlopen(download_url) as f:
+                content_type = f.content_type
+                data = f.read(DOWNLOAD_CHUNK_SIZE)
+
+                if is_service_exception(content_type, data):
+                    # Exception reports are small, get the rest of the message
+                    data += f.read(DOWNLOAD_CHUNK_SIZE)
+                    msg = ('File download failed.\n'
+                           'URL: %s\n'
+                           'Error message: %s' % (download_url, data))
+                    raise Exception(msg)
+
+                while data:
+                    t.write(data)
+                    nbytes += len(data)
+
+                    # Stop downloads nobody waits for any more
+                    check_cancelled()
+                    data = f.read(DOWNLOAD_CHUNK_SIZE)
+    except Exception:
+        # Do not leave partial downloads behind
+        os.remove(filename)
+        raise
 
-    if '<ServiceException>' in data:
-        msg = ('File download failed.\n'
-               'URL: %s\n'
-               'Error message: %s' % (download_url, data))
-        raise Exception(msg)
+    seconds = time.time() - start
+    throughput = nbytes / seconds if seconds > 0 else 0.0
+    logger.info('Downloaded %i bytes in %.2f seconds (%.1f kB/s) from %s'
+                % (nbytes, seconds, throughput / 1024, download_url))
+
+    if stats is not None:
+        stats['bytes'] = stats.get('bytes', 0) + nbytes
+        stats['seconds'] = stats.get('seconds', 0.0) + seconds
+        if stats['seconds'] > 0:
+            stats['throughput'] = stats['bytes'] / stats['seconds']
+        else:
+            stats['throughput'] = 0.0
 
-    # Write and return filename
-    t.write(data)
-    filename = os.path.abspath(t.name)
     return filename
 
 
+def fetch_layer(download_url, suffix, dirname, stats=None):
+    """Download layer data into dirname
+
+    Input
+        download_url: WCS or WFS request for the layer data
+        suffix: '.tif' for GeoTIFF or '.zip' for zipped shapefiles
+        dirname: Directory where the layer files are stored
+        stats: Optional dictionary updated as by get_file
 
-def download(server_url, layer_name, bbox, resolution=None):
+    Output
+        filename: Name of layer file relative to dirname
+    """
+
+    filename = get_file(download_url, suffix, stats=stats, dirname=dirname)
+    if suffix == '.zip':
+        # The archive is not extracted, see get_virtual_filename
+        zf = ZipFile(filename)
+        namelist = zf.namelist()
+        zf.close()
+        (shpname,) = [name for name in namelist if name.endswith('.shp')]
+        return os.path.join(os.path.basename(filename), shpname)
+
+    return os.path.basename(filename)
+
+
+def get_virtual_filename(filename):
+    """Get name GDAL and OGR can open for a possibly zipped layer file
+
+    Input
+        filename: Layer file name. Files inside zip archives are named
+                  like /path/archive.zip/member.shp
+
+    Output
+        filename: Name using the /vsizip/ virtual file system for files
+                  inside zip archives, otherwise unchanged. GDAL reads
+                  these directly from the archive without extracting it.
+    """
+
+    if '.zip' + os.sep in filename and not filename.startswith('/vsi'):
+        return '/vsizip/' + filename
+    else:
+        return filename
+
+
+def layer_file_exists(filename):
+    """Determine if a layer file, possibly inside a zip archive, exists
+    """
+
+    if filename.startswith('/vsizip/'):
+        archive = filename[len('/vsizip/'):].split('.zip' + os.sep)[0]
+        return os.path.isfile(archive + '.zip')
+    else:
+        return os.path.isfile(filename)
+
+
+def get_tiling(server_url):
+    """Get tile size and number of download threads for a server
+
+    Output
+        tile_size, threads: Values configured for the Server entry with
+                            url server_url or the defaults from settings.
+    """
+
+    tile_size = WCS_TILE_SIZE
+    threads = WCS_DOWNLOAD_THREADS
+    for server in Server.objects.filter(url=server_url)[:1]:
+        if server.tile_size is not None:
+            tile_size = server.tile_size
+        if server.download_threads is not None:
+            threads = server.download_threads
+
+    return tile_size, threads
+
+
+def fetch_raster_tiles(server_url, layer_name, origin, shape, pixel,
+                       dirname, tile_size, threads, stats=None):
+    """Download raster as a grid of tiles and mosaic them into one file
+
+    Input
+        server_url, layer_name: Layer to download
+        origin, shape, pixel: Pixel grid as obtained from get_raster_grid
+        dirname: Directory where the layer file is stored
+        tile_size: Maximal width and height of tiles in pixels
+        threads: Maximal number of concurrent tile requests
+        stats: Optional dictionary updated as by get_file
+
+    Output
+        filename: Name of layer file relative to dirname
+
+    Tiles are requested with exact pixel counts so they line up without
+    resampling. Each tile is written into the mosaic and removed as soon
+    as it arrives, so neither memory nor scratch space holds more than a
+    few tiles at a time. GDAL pages the mosaic to disk through its block
+    cache.
+    """
+
+    west, north = origin
+    nrows, ncols = shape
+    resx, resy = pixel
+
+    tiles = []
+    for row in range(0, nrows, tile_size):
+        for col in range(0, ncols, tile_size):
+            height = min(tile_size, nrows - row)
+            width = min(tile_size, ncols - col)
+            bbox = [west + col * resx, north - (row + height) * resy,
+                    west + (col + width) * resx, north - row * resy]
+            tiles.append((row, col, height, width, bbox))
+
+    tiledir = tempfile.mkdtemp(prefix='.tiles-', dir=dirname)
+
+    def fetch_tile(tile):
+        row, col, height, width, bbox = tile
+        download_url = WCS_TILE_TEMPLATE % (server_url, layer_name,
+                                            bboxlist2string(bbox,
+                                                            decimals=12),
+                                            width, height)
+        # Tiles arrive concurrently, each gets its own statistics
+        tile_stats = {}
+        return tile, get_file(download_url, '.tif', stats=tile_stats,
+                              dirname=tiledir), tile_stats
+
+    filename = layer_name.split(':')[-1] + '.tif'
+    dst = None
+    try:
+        for tile, tile_filename, tile_stats in run_in_threads(fetch_tile,
+                                                              tiles, threads):
+            row, col, height, width, bbox = tile
+            if stats is not None:
+                stats['bytes'] = stats.get('bytes', 0) + tile_stats['bytes']
+                stats['seconds'] = (stats.get('seconds', 0.0) +
+                                    tile_stats['seconds'])
+                if stats['seconds'] > 0:
+                    stats['throughput'] = stats['bytes'] / stats['seconds']
+
+            src = gdal.Open(tile_filename)
+
+            if dst is None:
+                # Create mosaic from properties of first tile
+                band = src.GetRasterBand(1)
+                driver = gdal.GetDriverByName('GTiff')
+                dst = driver.Create(os.path.join(dirname, filename),
+                                    ncols, nrows, src.RasterCount,
+                                    band.DataType,
+                                    ['TILED=YES', 'BIGTIFF=IF_SAFER'])
+                dst.SetProjection(src.GetProjection())
+                dst.SetGeoTransform((west, resx, 0.0, north, 0.0, -resy))
+
+            for i in range(1, src.RasterCount + 1):
+                src_band = src.GetRasterBand(i)
+                dst_band = dst.GetRasterBand(i)
+                nodata = src_band.GetNoDataValue()
+                if nodata is not None:
+                    dst_band.SetNoDataValue(nodata)
+                dst_band.WriteArray(src_band.ReadAsArray(0, 0, width, height),
+                                    col, row)
+
+            src = None
+            os.remove(tile_filename)
+    finally:
+        # Close mosaic to flush data to disk
+        dst = None
+        shutil.rmtree(tiledir, ignore_errors=True)
+
+    return filename
+
+
+def get_grid_window(grid, subgrid):
+    """Locate a pixel grid inside another one
+
+    Input
+        grid, subgrid: (origin, shape, pixel) as obtained from
+                       get_raster_grid
+
+    Output
+        xoff, yoff: Column and row of grid where subgrid starts or None
+                    if the pixels of subgrid are not pixels of grid
+    """
+
+    (west, north), (nrows, ncols), (resx, resy) = grid
+    (sub_west, sub_north), (sub_nrows, sub_ncols), sub_pixel = subgrid
+
+    if not numpy.allclose(sub_pixel, (resx, resy), rtol=1.0e-9, atol=0):
+        return None
+
+    # Offsets must be whole pixels, allowing for rounding errors
+    eps = 1.0e-6
+    x = (sub_west - west) / resx
+    y = (north - sub_north) / resy
+    xoff = int(round(x))
+    yoff = int(round(y))
+    if abs(x - xoff) > eps or abs(y - yoff) > eps:
+        return None
+
+    if (xoff < 0 or yoff < 0 or xoff + sub_ncols > ncols or
+        yoff + sub_nrows > nrows):
+        return None
+
+    return xoff, yoff
+
+
+def clip_raster(source, grid, subgrid, filename):
+    """Cut a grid out of a raster file without resampling
+
+    Input
+        source: Name of raster file on grid
+        grid, subgrid: (origin, shape, pixel) of source and of the raster
+                       to write, as obtained from get_raster_grid
+        filename: Name of GeoTIFF file to write
+
+    The result is the raster the server returns for subgrid, so subgrid
+    must consist of pixels of grid, see get_grid_window. Only the window
+    is read from disk.
+    """
+
+    window = get_grid_window(grid, subgrid)
+    msg = ('Grid %s is not part of the grid %s of raster %s'
+           % (subgrid, grid, source))
+    assert window is not None, msg
+
+    xoff, yoff = window
+    (west, north), (nrows, ncols), (resx, resy) = subgrid
+
+    src = gdal.Open(source)
+    band = src.GetRasterBand(1)
+    driver = gdal.GetDriverByName('GTiff')
+    dst = driver.Create(filename, ncols, nrows, src.RasterCount,
+                        band.DataType)
+    dst.SetProjection(src.GetProjection())
+    dst.SetGeoTransform((west, resx, 0.0, north, 0.0, -resy))
+
+    for i in range(1, src.RasterCount + 1):
+        src_band = src.GetRasterBand(i)
+        dst_band = dst.GetRasterBand(i)
+        nodata = src_band.GetNoDataValue()
+        if nodata is not None:
+            dst_band.SetNoDataValue(nodata)
+        dst_band.WriteArray(src_band.ReadAsArray(xoff, yoff, ncols, nrows))
+
+    # Close datasets to flush data to disk
+    dst = None
+    src = None
+
+
+def clip_vector(source, bbox, filename):
+    """Copy features of a vector file that intersect bounding box
+
+    Input
+        source: Name of vector file covering bbox
+        bbox: Bounding box [W, S, E, N]
+        filename: Name of shapefile to write
+
+    Features are selected by bounding box intersection which is the
+    same filter GeoServer applies to WFS requests with a bbox.
+    """
+
+    src = ogr.Open(get_virtual_filename(source))
+    layer = src.GetLayer(0)
+    layer.SetSpatialFilterRect(*bbox)
+
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    dst = driver.CreateDataSource(filename)
+    name = os.path.splitext(os.path.basename(filename))[0]
+    dst.CopyLayer(layer, name)
+
+    # Close datasets to flush data to disk
+    dst = None
+    src = None
+
+
+def find_covering_download(info):
+    """Find cached download of the same layer covering a bounding box
+
+    Input
+        info: Description of the requested download as stored in
+              the download cache manifests
+
+    Output
+        filename, grid: Name of cached layer file and its pixel grid as
+                        obtained from get_raster_grid, None for vector
+                        layers. None if there is no such file. If several
+                        entries qualify, the smallest is chosen.
+
+    Cached rasters only qualify if the requested grid is part of theirs,
+    so clipping gives the same pixels as a download from the server.
+    Only the cache entries of the layer are read, see get_download_group.
+    """
+
+    bbox = bboxstring2list(info['bbox'])
+    if info['resolution'] is None:
+        subgrid = None
+    else:
+        subgrid = get_raster_grid(bbox, info['resolution'])
+
+    group = get_download_group(info['server_url'], info['layer_name'])
+
+    best = None
+    for key, manifest in DOWNLOAD_CACHE.entries(group):
+        cached = manifest['info']
+        if cached['stamp'] != info['stamp']:
+            continue
+
+        cached_bbox = bboxstring2list(cached['bbox'])
+        if info['resolution'] is None or cached['resolution'] is None:
+            if info['resolution'] != cached['resolution']:
+                continue
+            grid = None
+            if not (cached_bbox[0] <= bbox[0] and
+                    cached_bbox[1] <= bbox[1] and
+                    cached_bbox[2] >= bbox[2] and
+                    cached_bbox[3] >= bbox[3]):
+                continue
+        else:
+            grid = get_raster_grid(cached_bbox, cached['resolution'])
+            if get_grid_window(grid, subgrid) is None:
+                continue
+
+        area = ((cached_bbox[2] - cached_bbox[0]) *
+                (cached_bbox[3] - cached_bbox[1]))
+        if best is None or area < best[0]:
+            best = (area, DOWNLOAD_CACHE.filename(key, manifest), grid)
+
+    if best is None:
+        return None, None
+    else:
+        return best[1], best[2]
+
+
+def clip_or_fetch_layer(fetch, suffix, dirname, info):
+    """Get layer data by clipping a cached download or from the server
+
+    Input
+        fetch: Function downloading the layer into a directory and
+               returning the name of the layer file, see fetch_layer
+        suffix: '.tif' for rasters or '.zip' for vector layers
+        dirname: Directory where the layer files are stored
+        info: Description of requested download, see find_covering_download
+
+    Output
+        filename: Name of layer file relative to dirname
+    """
+
+    source, grid = find_covering_download(info)
+    if source is not None:
+        bbox = bboxstring2list(info['bbox'])
+        basename = os.path.splitext(os.path.basename(source))[0]
+        try:
+            if suffix == '.tif':
+                filename = basename + '.tif'
+                clip_raster(source, grid,
+                            get_raster_grid(bbox, info['resolution']),
+                            os.path.join(dirname, filename))
+            else:
+                filename = basename + '.shp'
+                clip_vector(source, bbox, os.path.join(dirname, filename))
+        except Exception, e:
+            # The entry may have been evicted while reading it
+            logger.debug('Could not clip cached layer %s, downloading '
+                         'instead. Error message was: %s' % (source, e))
+            for name in os.listdir(dirname):
+                os.remove(os.path.join(dirname, name))
+        else:
+            DOWNLOAD_STATS['clipped'] += 1
+            return filename
+
+    return fetch(dirname)
+
+
+def get_layer_stamp(layer_metadata):
+    """Get a value that changes when a layer is modified
+
+    OWS services do not report modification times so the stamp is
+    derived from the extent, grid and keywords published for the layer.
+    For layers of the internal GeoNode the uuid and date of the Layer
+    are added, which save_file_to_geonode updates on every upload.
+    Layers of remote servers overwritten with data of the same extent,
+    grid and keywords keep their stamp.
+    """
+
+    revision = None
+    if layer_metadata.get('server_url') == INTERNAL_SERVER_URL:
+        layers = Layer.objects.filter(typename=layer_metadata['id'])
+        for layer in layers[:1]:
+            revision = [layer.uuid, layer.date.isoformat()]
+
+    # Serialize as JSON so metadata read from the catalog, where tuples
+    # become lists and strings unicode, gives the same stamp
+    return make_key(json.dumps([layer_metadata['bounding_box'],
+                                layer_metadata['geotransform'],
+                                layer_metadata['keywords'],
+                                revision],
+                               sort_keys=True))
+
+
+def get_download_group(server_url, layer_name):
+    """Get group of the download cache entries of a layer
+    """
+
+    return make_key(server_url, layer_name)
+
+
+def invalidate_downloads(server_url, layer_name):
+    """Remove cached downloads of a layer
+    """
+
+    if DOWNLOAD_CACHE is not None:
+        DOWNLOAD_CACHE.invalidate(
+            lambda info: True,
+            group=get_download_group(server_url, layer_name))
+
+
+def get_cache_stats():
+    """Get hit and miss counters of the caches used by this process
+    """
+
+    stats = {}
+    for name, cache in [('metadata', METADATA_CACHE),
+                        ('layer_metadata', LAYER_METADATA_CACHE),
+                        ('download', DOWNLOAD_CACHE)]:
+        if cache is not None:
+            stats[name] = {'hits': cache.hits, 'misses': cache.misses}
+
+    if DOWNLOAD_CACHE is not None:
+        stats['download']['clipped'] = DOWNLOAD_STATS['clipped']
+    return stats
+
+
+def download(server_url, layer_name, bbox, resolution=None, metadata=None,
+             stats=None):
     """Download the source data of a given layer.
 
     Input
@@ -277,18 +1091,20 @@ def download(server_url, layer_name, bbox, resolution=None):
                     and resy.
                     If resolution is None, the 'native' resolution of
                     the dataset is used.
+        metadata: Optional metadata of the layer as returned by
+                  get_metadata. If given, the server is not contacted
+                  for metadata again.
+        stats: Optional dictionary updated with the number of bytes
+               transferred and the time taken, see get_file. Nothing is
+               transferred for layers found in the download cache.
 
     Layer geometry type must be either 'vector' or 'raster'
     """
 
     # Input checks
     assert isinstance(server_url, basestring)
-    try:
-        urllib2.urlopen(server_url)
-    except Exception, e:
-        msg = ('Argument server_url doesn\'t appear to be a valid URL'
-               'I got %s. Error message was: %s' % (server_url, str(e)))
-        raise Exception(msg)
+    if metadata is None:
+        check_server_reachable(server_url)
 
     msg = ('Expected layer_name to be a basestring. '
            'Instead got %s which is of type %s' % (layer_name,
@@ -336,7 +1152,11 @@ def download(server_url, layer_name, bbox, resolution=None):
 
     # Create REST request and download file
     template = None
-    layer_metadata = get_metadata(server_url, layer_name)
+    fetch = None
+    if metadata is None:
+        layer_metadata = get_metadata(server_url, layer_name)
+    else:
+        layer_metadata = metadata
 
     data_type = layer_metadata['layertype']
     if data_type == 'vector':
@@ -349,14 +1169,6 @@ def download(server_url, layer_name, bbox, resolution=None):
         template = WFS_TEMPLATE
         suffix = '.zip'
         download_url = template % (server_url, layer_name, bbox_string)
-        thefilename = get_file(download_url, suffix)
-        dirname = os.path.dirname(thefilename)
-        t = open(thefilename, 'r')
-        zf = ZipFile(t)
-        namelist = zf.namelist()
-        zf.extractall(path=dirname)
-        (shpname,) = [name for name in namelist if '.shp' in name]
-        filename = os.path.join(dirname, shpname)
     elif data_type == 'raster':
 
         if resolution is None:
@@ -364,25 +1176,77 @@ def download(server_url, layer_name, bbox, resolution=None):
             resolution = layer_metadata['resolution']
             #resolution = (resolution, resolution)  #FIXME (Ole): Make nicer
 
-        # Download raster using specified bounding box and resolution
-        template = WCS_TEMPLATE
+        # Download raster on the grid for bbox and resolution, in tiles
+        # if it is large. Pixel counts are requested rather than the
+        # resolution so both ways give the same grid.
         suffix = '.tif'
-        download_url = template % (server_url, layer_name, bbox_string,
-                                   resolution[0], resolution[1])
-        filename = get_file(download_url, suffix)
+        origin, shape, pixel = get_raster_grid(bboxstring2list(bbox_string),
+                                               resolution)
+        download_url = WCS_TILE_TEMPLATE % (server_url, layer_name,
+                                            bbox_string, shape[1], shape[0])
+
+        tile_size, threads = get_tiling(server_url)
+        if max(shape) > tile_size:
+            fetch = lambda d: fetch_raster_tiles(server_url, layer_name,
+                                                 origin, shape, pixel,
+                                                 d, tile_size, threads,
+                                                 stats=stats)
+
+    if fetch is None:
+        fetch = lambda d: fetch_layer(download_url, suffix, d, stats=stats)
+
+    dirname = SCRATCH.mkdtemp()
+    if DOWNLOAD_CACHE is None:
+        filename = os.path.join(dirname, fetch(dirname))
+    else:
+        if resolution is not None:
+            resolution = tuple(float(res) for res in resolution)
+        info = {'server_url': server_url,
+                'layer_name': layer_name,
+                'bbox': bbox_string,
+                'resolution': resolution,
+                'stamp': get_layer_stamp(layer_metadata)}
+        key = make_key(server_url, layer_name, bbox_string,
+                       resolution, info['stamp'])
+        # Cached layers covering the bounding box are clipped locally
+        filename = DOWNLOAD_CACHE.get_or_create(
+            key, lambda d: clip_or_fetch_layer(fetch, suffix, d, info),
+            dirname, info=info,
+            group=get_download_group(server_url, layer_name))
 
-    # Write keywords file
     keywords = layer_metadata['keywords']
-    write_keywords(keywords, os.path.splitext(filename)[0] + '.keywords')
+    filename = get_virtual_filename(filename)
+    if filename.startswith('/vsi'):
+        # Keywords can not be written next to a file in an archive
+        lyr = read_layer(filename)
+        lyr.keywords = keywords
+    else:
+        # Write keywords file
+        write_keywords(keywords, os.path.splitext(filename)[0] + '.keywords')
 
-    # Instantiate layer from file
-    lyr = read_layer(filename)
+        # Instantiate layer from file
+        lyr = read_layer(filename)
 
     # FIXME (Ariel) Don't monkeypatch the layer object
     lyr.metadata = layer_metadata
     return lyr
 
 
+def get_layer_size(layer):
+    """Count features and pixels of a layer returned by download
+
+    Output
+        features, pixels: Number of vector features and raster pixels,
+                          one of them is 0
+    """
+
+    if layer.metadata['layertype'] == 'raster':
+        # Size of the grid, without reading the data
+        return 0, layer.rows * layer.columns
+    else:
+        return len(layer), 0
+
+
 def dummy_save(filename, title, user, metadata=''):
     """Take a file-like object and uploads it to a GeoNode
     """
@@ -512,8 +1376,9 @@ def check_layer(layer, full=False):
 
     if full:
         # Check that layer can be downloaded again
-        downloaded_layer = download(INTERNAL_SERVER_URL, layer_name, bbox)
-        assert os.path.exists(downloaded_layer.filename)
+        downloaded_layer = download(INTERNAL_SERVER_URL, layer_name, bbox,
+                                    metadata=metadata)
+        assert layer_file_exists(downloaded_layer.filename)
 
         # Check integrity between Django layer and file
         assert_bounding_box_matches(layer, downloaded_layer.filename)
@@ -597,21 +1462,11 @@ def save_file_to_geonode(filename, user=None, title=None,
         f.close()
 
     # Take care of file types
+    conversion_dir = None
     if extension == '.asc':
         # We assume this is an AAIGrid ASCII file such as those generated by
         # ESRI and convert it to Geotiff before uploading.
 
-        # Create temporary tif file for upload and check that the road is clear
-        prefix = os.path.split(basename)[-1]
-        upload_filename = unique_filename(prefix=prefix, suffix='.tif')
-        upload_basename, extension = os.path.splitext(upload_filename)
-
-        # Copy any metadata files to unique filename
-        for ext in ['.sld', '.keywords']:
-            if os.path.exists(basename + ext):
-                cmd = 'cp %s%s %s%s' % (basename, ext, upload_basename, ext)
-                run(cmd)
-
         # Check that projection file exists
         prjname = basename + '.prj'
         if not os.path.isfile(prjname):
@@ -619,9 +1474,27 @@ def save_file_to_geonode(filename, user=None, title=None,
                    '%s' % (filename, prjname))
             raise RisikoException(msg)
 
-        # Convert ASCII file to GeoTIFF
-        R = read_layer(filename)
-        R.write_to_file(upload_filename)
+        # Create temporary tif file for upload and check that the road is clear
+        prefix = os.path.split(basename)[-1]
+        conversion_dir = SCRATCH.mkdtemp()
+        upload_filename = unique_filename(prefix=prefix, suffix='.tif',
+                                          dir=conversion_dir)
+        upload_basename = os.path.splitext(upload_filename)[0]
+
+        try:
+            # Copy any metadata files to unique filename
+            for ext in ['.sld', '.keywords']:
+                if os.path.exists(basename + ext):
+                    cmd = 'cp %s%s %s%s' % (basename, ext,
+                                            upload_basename, ext)
+                    run(cmd)
+
+            # Convert ASCII file to GeoTIFF
+            R = read_layer(filename)
+            R.write_to_file(upload_filename)
+        except:
+            SCRATCH.remove(conversion_dir)
+            raise
     else:
         # The specified file is the one to upload
         upload_filename = filename
@@ -649,10 +1522,22 @@ def save_file_to_geonode(filename, user=None, title=None,
         if kw_title is not None:
             layer.title = kw_title
 
+        # Overwritten layers keep their uuid, so mark the new data as a
+        # revision for get_layer_stamp
+        layer.date = datetime.datetime.now()
+        layer.date_type = 'revision'
+
         layer.save()
     except GeoNodeException, e:
         raise
     else:
+        # Cached metadata no longer describes this layer. It is entered
+        # in the caches and the catalog again once check_layer has
+        # fetched its new metadata.
+        invalidate_metadata(INTERNAL_SERVER_URL, layer.typename)
+        invalidate_downloads(INTERNAL_SERVER_URL, layer.typename)
+        catalog.forget_layer(INTERNAL_SERVER_URL, layer.typename)
+
 
         logmsg = ('Uploaded "%s" with name "%s" and title "%s".'
                   % (basename, layer.name, layer.title))
@@ -672,6 +1557,9 @@ def save_file_to_geonode(filename, user=None, title=None,
                     logger.debug('Metadata for layer %s not yet ready - '
                                  'trying again. Error message was: %s'
                                  % (layer.name, errmsg))
+                    invalidate_metadata(INTERNAL_SERVER_URL, layer.typename)
+                    catalog.forget_layer(INTERNAL_SERVER_URL, layer.typename)
+                    metrics.inc('safe_save_metadata_retries_total')
                     time.sleep(0.3)
                 else:
                     ok = True
@@ -684,10 +1572,9 @@ def save_file_to_geonode(filename, user=None, title=None,
                        'correctly: %s' % (layer, errmsg))
                 raise Exception(msg)
     finally:
-        # Clean up generated tif files in either case
-        if extension == '.asc':
-            os.remove(upload_filename)
-            os.remove(upload_filename + '.aux.xml')
+        # Clean up generated tif and metadata files in either case
+        if conversion_dir is not None:
+            SCRATCH.remove(conversion_dir)
 
 
 def save_to_geonode(incoming, user=None, title=None,
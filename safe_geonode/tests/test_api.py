@@ -4,8 +4,12 @@ import sys
 import unittest
 import warnings
 import time
+import datetime
+import shutil
+import tempfile
 
-from safe_geonode.views import calculate
+from safe_geonode.views import calculate, run_stage
+from safe_geonode.views import get_questions
 from safe_geonode.storage import save_file_to_geonode as save_to_geonode
 from safe_geonode.storage import check_layer
 from safe_geonode.storage import assert_bounding_box_matches
@@ -13,8 +17,19 @@ from safe_geonode.storage import download
 from safe_geonode.storage import read_layer
 from safe_geonode.storage import get_metadata
 from safe_geonode.storage import get_bounding_box
+from safe_geonode.storage import layer_file_exists
 from safe_geonode.utilities import get_bounding_box_string
 from safe_geonode.utilities import nanallclose
+from safe_geonode.utilities import raster_pixels
+from safe_geonode.utilities import BYTES_PER_PIXEL
+from safe_geonode.utilities import check_cancelled, CancelledError
+from safe_geonode.models import CALCULATION_STAGES
+from safe_geonode.models import Calculation, PerformanceProfile
+from safe_geonode.profiling import profiled, get_pstats
+from safe_geonode import profiling
+from safe_geonode import views
+from safe_geonode import metrics
+from safe_geonode.benchmarks import questionsbench
 from safe_geonode.tests.utilities import TESTDATA, INTERNAL_SERVER_URL
 
 from geonode.layers.utils import get_valid_user, check_geonode_is_up
@@ -106,6 +121,7 @@ class TestApi(LiveServerTestCase):
         # Run calculation
         c = Client()
         rv = c.post(calculate_url, data=dict(
+                synchronous='true',
                 hazard_server=INTERNAL_SERVER_URL,
                 hazard=hazard_name,
                 exposure_server=INTERNAL_SERVER_URL,
@@ -142,7 +158,7 @@ class TestApi(LiveServerTestCase):
         result_layer = download(INTERNAL_SERVER_URL,
                                 layer_id,
                                 get_bounding_box_string(hazard_filename))
-        assert os.path.exists(result_layer.filename)
+        assert layer_file_exists(result_layer.filename)
 
 
     def test_jakarta_flood_study(self):
@@ -196,6 +212,7 @@ class TestApi(LiveServerTestCase):
         # Run calculation
         c = Client()
         rv = c.post(calculate_url, data=dict(
+                synchronous='true',
                 hazard_server=INTERNAL_SERVER_URL,
                 hazard=hazard_name,
                 exposure_server=INTERNAL_SERVER_URL,
@@ -255,7 +272,8 @@ class TestApi(LiveServerTestCase):
                     exposure=exposure_name,
                     bbox=bbox_correct,
                     impact_function='Earthquake Building Damage Function',
-                    keywords='test,schools,lembang')
+                    keywords='test,schools,lembang',
+                    synchronous='true')
 
 
         calculate_url = reverse('safe-calculate')
@@ -297,6 +315,358 @@ class TestApi(LiveServerTestCase):
                        'an error' % bad_bbox)
             assert 'errors' in data_out, msg
 
+    def test_queued_calculation(self):
+        """Calculations are queued and their status can be followed
+        """
+
+        hazardfile = os.path.join(TESTDATA, 'lembang_mmi_hazmap.asc')
+        hazard_layer = save_to_geonode(hazardfile, user=self.user)
+        hazard_name = '%s:%s' % (hazard_layer.workspace, hazard_layer.name)
+
+        exposurefile = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        exposure_layer = save_to_geonode(exposurefile, user=self.user)
+        exposure_name = '%s:%s' % (exposure_layer.workspace,
+                                   exposure_layer.name)
+
+        c = Client()
+        rv = c.post(reverse('safe-calculate'), data=dict(
+                hazard_server=INTERNAL_SERVER_URL,
+                hazard=hazard_name,
+                exposure_server=INTERNAL_SERVER_URL,
+                exposure=exposure_name,
+                bbox='105.592,-7.809,110.159,-5.647',
+                impact_function='Earthquake Building Damage Function',
+                keywords='test,schools,lembang'))
+
+        self.assertEqual(rv.status_code, 202)
+        data = json.loads(rv.content)
+        assert data['status'] == 'queued'
+        status_url = reverse('safe-calculation', args=[data['id']])
+        assert data['status_url'] == status_url
+
+        # Follow calculation until it is done
+        for i in range(120):
+            rv = c.get(status_url)
+            self.assertEqual(rv.status_code, 200)
+            status = json.loads(rv.content)
+            if status['status'] in ['finished', 'failed']:
+                break
+            assert status['stage'] in [None] + CALCULATION_STAGES
+            time.sleep(1)
+
+        msg = 'Calculation failed: %s' % status['errors']
+        assert status['status'] == 'finished', msg
+        assert status['progress'] == 1.0
+        assert status['result']['success']
+        assert 'layer' in status['result']
+        assert 'raw' in status['result']
+
+        # Time and resources used are recorded
+        result = status['result']
+        assert sorted(result['timings']) == sorted(CALCULATION_STAGES)
+        assert result['timings'] == status['timings']
+        assert sum(result['timings'].values()) <= status['run_duration'] + 1
+        assert result['bytes_downloaded'] > 0
+        assert result['features'] > 0
+        assert result['pixels'] > 0
+        assert result['peak_rss'] > 0
+
+        # Unknown calculations are reported as such
+        rv = c.get(reverse('safe-calculation', args=[data['id'] + 1000]))
+        self.assertEqual(rv.status_code, 404)
+
+        # Stack traces are only shown to the owner and staff
+        failed = Calculation(user=self.user, success=False,
+                             run_date=datetime.datetime.now(),
+                             run_duration=0, status='failed',
+                             errors='Failed', stacktrace='Traceback')
+        failed.save()
+        failed_url = reverse('safe-calculation', args=[failed.id])
+        status = json.loads(c.get(failed_url).content)
+        assert status['errors'] == 'Failed'
+        assert status['stacktrace'] is None
+
+        c.login(username='admin', password='admin')
+        status = json.loads(c.get(failed_url).content)
+        assert status['stacktrace'] == 'Traceback'
+
+    def test_questions_benchmark(self):
+        """Synthetic catalogs give the questions of their plugin registry
+        """
+
+        layers = questionsbench.synthetic_layers(200, seed=1)
+        plugins = questionsbench.synthetic_plugins(20, seed=1)
+        lookup = questionsbench.make_lookup(plugins)
+
+        output = get_questions(layers, plugins, plugin_lookup=lookup)
+        assert sorted(output['functions']) == sorted(plugins)
+        assert len(output['questions']) > 0
+        for question in output['questions']:
+            hazard = layers[question['hazard']]
+            exposure = layers[question['exposure']]
+            assert hazard['keywords']['category'] == 'hazard'
+            assert exposure['keywords']['category'] == 'exposure'
+            for required, layer in zip(
+                            plugins[question['function']].requirements,
+                            [hazard, exposure]):
+                keywords = dict(layer['keywords'],
+                                layertype=layer['layertype'])
+                for key, value in required.items():
+                    assert keywords[key] == value
+
+        results = questionsbench.run(sizes=[10, 100], plugins=10,
+                                     repeats=1)
+        assert [r['layers'] for r in results['sizes']] == [10, 100]
+        assert results['sizes'][1]['bytes'] > results['sizes'][0]['bytes']
+        assert results['exponents']['bytes'] > 0
+
+    def test_calculation_stages(self):
+        """Stages run concurrently and fail when they take too long
+        """
+
+        results = run_stage(lambda x, y: x * y, [(1, 2), (3, 4)], 10, 'test')
+        assert results == [2, 12]
+
+        try:
+            run_stage(time.sleep, [(0,), (5,)], 1, 'test')
+        except Exception, e:
+            assert 'did not complete within 1 seconds' in str(e)
+        else:
+            msg = 'Slow stage should have raised an exception'
+            raise Exception(msg)
+
+        # Calls still running after the timeout are cancelled
+        outcome = []
+
+        def work():
+            try:
+                for i in range(50):
+                    time.sleep(0.1)
+                    check_cancelled()
+                outcome.append('finished')
+            except CancelledError:
+                outcome.append('cancelled')
+
+        try:
+            run_stage(work, [()], 0.5, 'test')
+        except Exception, e:
+            assert 'did not complete within' in str(e)
+        time.sleep(0.5)
+        assert outcome == ['cancelled'], outcome
+
+    def test_calculation_results_are_reused(self):
+        """Identical calculations return the impact layer of the first one
+        """
+
+        hazardfile = os.path.join(TESTDATA, 'lembang_mmi_hazmap.asc')
+        hazard_layer = save_to_geonode(hazardfile, user=self.user)
+        hazard_name = '%s:%s' % (hazard_layer.workspace, hazard_layer.name)
+
+        exposurefile = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        exposure_layer = save_to_geonode(exposurefile, user=self.user)
+        exposure_name = '%s:%s' % (exposure_layer.workspace,
+                                   exposure_layer.name)
+
+        data = dict(hazard_server=INTERNAL_SERVER_URL,
+                    hazard=hazard_name,
+                    exposure_server=INTERNAL_SERVER_URL,
+                    exposure=exposure_name,
+                    bbox='105.592,-7.809,110.159,-5.647',
+                    impact_function='Earthquake Building Damage Function',
+                    keywords='test,schools,lembang',
+                    synchronous='true')
+
+        c = Client()
+        results = []
+        for i in range(2):
+            rv = c.post(reverse('safe-calculate'), data=data)
+            self.assertEqual(rv.status_code, 200)
+            results.append(json.loads(rv.content))
+
+        first, second = results
+        assert first['errors'] is None, first['errors']
+        assert second['errors'] is None, second['errors']
+        assert second['id'] == first['id']
+        assert second['layer'] == first['layer']
+
+    def test_calculation_plan(self):
+        """Cost of a calculation can be estimated without downloading
+        """
+
+        hazardfile = os.path.join(TESTDATA, 'lembang_mmi_hazmap.asc')
+        hazard_layer = save_to_geonode(hazardfile, user=self.user)
+        hazard_name = '%s:%s' % (hazard_layer.workspace, hazard_layer.name)
+
+        exposurefile = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        exposure_layer = save_to_geonode(exposurefile, user=self.user)
+        exposure_name = '%s:%s' % (exposure_layer.workspace,
+                                   exposure_layer.name)
+
+        data = dict(hazard_server=INTERNAL_SERVER_URL,
+                    hazard=hazard_name,
+                    exposure_server=INTERNAL_SERVER_URL,
+                    exposure=exposure_name,
+                    bbox='105.592,-7.809,110.159,-5.647')
+
+        c = Client()
+        rv = c.get(reverse('safe-plan'), data=data)
+        self.assertEqual(rv.status_code, 200)
+        plan = json.loads(rv.content)
+        assert plan['errors'] is None, plan['errors']
+
+        hazard = plan['hazard']
+        assert hazard['layertype'] == 'raster'
+        assert hazard['pixels'] == raster_pixels(hazard['bbox'],
+                                                 hazard['resolution'])
+        assert hazard['bytes'] == hazard['pixels'] * BYTES_PER_PIXEL
+        assert plan['raster_bytes'] == hazard['bytes']
+
+        exposure = plan['exposure']
+        assert exposure['layertype'] == 'vector'
+        assert 0 < exposure['features'] <= len(read_layer(exposurefile))
+
+        # Missing parameters are reported
+        del data['bbox']
+        rv = c.get(reverse('safe-plan'), data=data)
+        self.assertEqual(rv.status_code, 400)
+        assert 'bbox' in json.loads(rv.content)['errors']
+
+        # So are invalid ones
+        data['bbox'] = '106.0,-7.0,200.0,-6.0'
+        rv = c.get(reverse('safe-plan'), data=data)
+        self.assertEqual(rv.status_code, 400)
+        assert json.loads(rv.content)['errors']
+
+    def test_coarsened_raster_with_vector(self):
+        """A raster coarsened to the memory budget can meet a vector layer
+        """
+
+        hazardfile = os.path.join(TESTDATA, 'lembang_mmi_hazmap.asc')
+        hazard_layer = save_to_geonode(hazardfile, user=self.user)
+        hazard_name = '%s:%s' % (hazard_layer.workspace, hazard_layer.name)
+
+        exposurefile = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        exposure_layer = save_to_geonode(exposurefile, user=self.user)
+        exposure_name = '%s:%s' % (exposure_layer.workspace,
+                                   exposure_layer.name)
+
+        data = dict(hazard_server=INTERNAL_SERVER_URL,
+                    hazard=hazard_name,
+                    exposure_server=INTERNAL_SERVER_URL,
+                    exposure=exposure_name,
+                    bbox='105.592,-7.809,110.159,-5.647',
+                    impact_function='Earthquake Building Damage Function',
+                    keywords='test,buildings,lembang',
+                    synchronous='true')
+
+        budget = views.RASTER_MEMORY_BUDGET
+        views.RASTER_MEMORY_BUDGET = 100 * BYTES_PER_PIXEL
+        try:
+            c = Client()
+            rv = c.post(reverse('safe-calculate'), data=data)
+        finally:
+            views.RASTER_MEMORY_BUDGET = budget
+
+        self.assertEqual(rv.status_code, 200)
+        result = json.loads(rv.content)
+        assert result['errors'] is None, result['errors']
+        assert result['resolution'] is not None
+        assert 'native resolution of' in result['resolution_reason']
+        assert 0 < result['pixels'] <= 100, result['pixels']
+        assert result['features'] > 0
+
+    def test_profiling(self):
+        """Slow runs are profiled and can be downloaded by staff
+        """
+
+        def work(calculation):
+            time.sleep(0.1)
+            return sum(range(1000))
+
+        calculation = Calculation(user=self.user,
+                                  run_date=datetime.datetime.now(),
+                                  success=False)
+        calculation.save()
+
+        # Profiling is off by default
+        before = PerformanceProfile.objects.count()
+        profiled('work')(work)(calculation)
+        assert PerformanceProfile.objects.count() == before
+
+        threshold = profiling.THRESHOLD
+        profiling.PROFILE = ['work']
+        profiling.THRESHOLD = 0.05
+        try:
+            assert profiled('work')(work)(calculation) == sum(range(1000))
+        finally:
+            profiling.PROFILE = []
+            profiling.THRESHOLD = threshold
+
+        profile = PerformanceProfile.objects.latest('id')
+        assert profile.name == 'work'
+        assert profile.calculation == calculation
+        assert profile.duration >= 0.1
+
+        url = reverse('safe-profile', args=[profile.id])
+
+        # Profiles are only served to staff
+        c = Client()
+        rv = c.get(url)
+        self.assertEqual(rv.status_code, 200)
+        assert not rv.has_header('Content-Disposition')
+
+        c.login(username='admin', password='admin')
+        rv = c.get(url)
+        self.assertEqual(rv.status_code, 200)
+        assert rv['Content-Disposition'].endswith('.prof')
+        assert rv.content == get_pstats(profile)
+
+        rv = c.get(url, data={'format': 'collapsed'})
+        self.assertEqual(rv.status_code, 200)
+        stacks = rv.content.splitlines()
+        assert any(stack.split(';')[0].endswith('(work)')
+                   for stack in stacks), stacks
+        assert any('sleep' in stack for stack in stacks), stacks
+
+    def test_metrics(self):
+        """Metrics of all processes are exposed in Prometheus format
+        """
+
+        c = Client()
+        rv = c.get(reverse('safe-debug'))
+        self.assertEqual(rv.status_code, 200)
+
+        rv = c.get(reverse('safe-metrics'))
+        self.assertEqual(rv.status_code, 200)
+        assert rv['Content-Type'].startswith('text/plain; version=0.0.4')
+        assert '# TYPE safe_requests_total counter' in rv.content
+        assert 'safe_requests_total{status="200",view="debug"}' in rv.content
+        assert ('safe_request_duration_seconds_bucket{view="debug",'
+                'le="+Inf"}') in rv.content
+
+        # Counters of processes that ended are kept, their gauges are not
+        dirname = tempfile.mkdtemp()
+        try:
+            store = metrics.MetricsStore(dirname)
+            store.inc('safe_calculations_total', status='finished')
+            store.add('safe_calculations_in_flight', 1)
+
+            ended = metrics.MetricsStore(dirname)
+            ended._filename = os.path.join(dirname, '999999-ended.json')
+            ended.inc('safe_calculations_total', 2, status='finished')
+            ended.add('safe_calculations_in_flight', 5)
+            ended.close()
+
+            for i in range(2):
+                output = metrics.exposition(store.collect())
+                assert ('safe_calculations_total{status="finished"} 3'
+                        in output), output
+                assert 'safe_calculations_in_flight 1\n' in output, output
+            assert not os.path.exists(ended._filename)
+            store.close()
+        finally:
+            shutil.rmtree(dirname)
+
     @numpy.testing.dec.skipif(True, ' * Talk to Ole. Intergrid interpolation not yet implemented')
     def test_earthquake_exposure_plugin(self):
         """Population exposure to individual MMI levels can be computed
@@ -340,6 +710,7 @@ class TestApi(LiveServerTestCase):
         # Run calculation
         c = Client()
         rv = c.post(calculate_url, data=dict(
+                synchronous='true',
                 hazard_server=INTERNAL_SERVER_URL,
                 hazard=hazard_name,
                 exposure_server=INTERNAL_SERVER_URL,
@@ -373,7 +744,7 @@ class TestApi(LiveServerTestCase):
         result_layer = download(INTERNAL_SERVER_URL,
                                 layer_name,
                                 get_bounding_box_string(hazard_filename))
-        assert os.path.exists(result_layer.filename)
+        assert layer_file_exists(result_layer.filename)
 
         # Check calculated values
         keywords = result_layer.get_keywords()
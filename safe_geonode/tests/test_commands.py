@@ -1,10 +1,17 @@
 import os
+import datetime
 
 from django.core.management import call_command
 from django.test import LiveServerTestCase
 from safe.common.testing import UNITDATA
 from gisdata import BAD_DATA
+from geonode.layers.utils import get_valid_user
 from safe_geonode import get_version
+from safe_geonode.models import Calculation, CalculationJob
+from safe_geonode.models import CatalogSync, LayerMetadata
+from safe_geonode.storage import INTERNAL_SERVER_URL
+from safe_geonode.jobs import enqueue_job, claim_job, DatabaseWorker
+from safe_geonode.jobs import MAX_ATTEMPTS
 
 class CommandsTestCase(LiveServerTestCase):
 
@@ -28,3 +35,64 @@ class CommandsTestCase(LiveServerTestCase):
     def test_version(self):
         "Test version can be obtained programatically."
         version = get_version()
+
+    def test_safesynclayers(self):
+        "Test safesynclayers enters imported layers in the catalog."
+        layer = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        call_command('safeimportlayers', layer, verbosity=0)
+
+        LayerMetadata.objects.all().delete()
+        call_command('safesynclayers', verbosity=0)
+
+        assert CatalogSync.objects.filter(server_url=INTERNAL_SERVER_URL).exists()
+        entries = LayerMetadata.objects.filter(server_url=INTERNAL_SERVER_URL,
+                                               name__endswith='jakarta_flood_design')
+        assert entries.count() == 1
+        assert entries[0].layertype == 'raster'
+
+    def test_calculation_jobs(self):
+        "Test jobs in the database queue are claimed by one worker at a time."
+        calculation = Calculation.objects.create(user=get_valid_user(),
+                                                 run_date=datetime.datetime.now(),
+                                                 impact_function='Test Function',
+                                                 success=False)
+        job = enqueue_job(calculation, '105.3,-8.3,110.2,-5.5')
+
+        claimed = claim_job('node-a')
+        assert claimed.id == job.id
+        assert claimed.worker == 'node-a'
+        assert claimed.attempts == 1
+
+        # Nothing left to claim while the lease is valid
+        assert claim_job('node-b') is None
+
+        # Jobs of workers that stopped sending heartbeats are claimed again
+        expired = datetime.datetime.now() - datetime.timedelta(hours=1)
+        CalculationJob.objects.filter(id=job.id).update(heartbeat=expired)
+        claimed = claim_job('node-b')
+        assert claimed.worker == 'node-b'
+        assert claimed.attempts == 2
+
+        # Executed jobs are done
+        executed = []
+        worker = DatabaseWorker(lambda *args: executed.append(args),
+                                node='node-b')
+        worker.run_job(claimed)
+        assert executed == [(claimed.calculation, 'Test Function',
+                             '105.3,-8.3,110.2,-5.5')]
+        assert CalculationJob.objects.get(id=job.id).done
+        assert claim_job('node-c') is None
+
+        # Jobs abandoned too often are given up
+        calculation = Calculation.objects.create(user=get_valid_user(),
+                                                 run_date=datetime.datetime.now(),
+                                                 impact_function='Test Function',
+                                                 success=False)
+        job = enqueue_job(calculation, '105.3,-8.3,110.2,-5.5')
+        for i in range(MAX_ATTEMPTS):
+            assert claim_job('node-%i' % i).id == job.id
+            CalculationJob.objects.filter(id=job.id).update(heartbeat=expired)
+
+        assert claim_job('node-d') is None
+        assert CalculationJob.objects.get(id=job.id).done
+        assert Calculation.objects.get(id=calculation.id).status == 'failed'
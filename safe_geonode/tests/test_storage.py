@@ -2,6 +2,7 @@ import os
 import time
 import unittest
 import numpy
+import shutil
 import urllib2
 import tempfile
 import datetime
@@ -11,7 +12,20 @@ from safe_geonode.storage import save_file_to_geonode as save_to_geonode
 from safe_geonode.storage import RisikoException
 from safe_geonode.storage import check_layer, assert_bounding_box_matches
 from safe_geonode.storage import get_bounding_box
-from safe_geonode.storage import download, get_metadata
+from safe_geonode.storage import download, get_metadata, get_feature_count
+from safe_geonode.storage import get_layer_metadata, get_server_metadata
+from safe_geonode.storage import DOWNLOAD_CACHE, DOWNLOAD_STATS
+from safe_geonode.storage import METADATA_CACHE
+from safe_geonode.storage import NO_VIRTUAL_SERVICES
+from safe_geonode.storage import invalidate_downloads, layer_file_exists
+from safe_geonode.storage import invalidate_metadata, sync_catalog
+from safe_geonode.storage import get_layer_stamp, get_download_group
+from safe_geonode.models import Server, LayerMetadata
+from safe_geonode.cache import DownloadCache
+from safe_geonode import httpclient
+from safe_geonode.benchmarks.owsserver import StandInServer
+from safe_geonode.benchmarks.owsserver import SyntheticRaster
+from safe_geonode.benchmarks.owsserver import SyntheticVector
 from safe_geonode.storage import read_layer
 from safe_geonode.utilities import get_bounding_box_string
 from safe_geonode.utilities import bboxstring2list
@@ -752,6 +766,321 @@ class TestStorage(LiveServerTestCase):
         assert layer_appears_immediately, msg
 
 
+    def test_metadata_cache(self):
+        """Cached metadata is not shared with callers and follows uploads
+        """
+
+        filename = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(filename, user=self.user, overwrite=True)
+        layer_name = layer.typename
+
+        metadata = get_metadata(INTERNAL_SERVER_URL, layer_name)
+        metadata['keywords']['category'] = 'modified'
+
+        # Modifying the returned dictionary must not affect the cache
+        metadata = get_metadata(INTERNAL_SERVER_URL, layer_name)
+        msg = 'Cached metadata was modified by caller: %s' % metadata
+        assert metadata['keywords']['category'] == 'hazard', msg
+
+        all_metadata = get_metadata(INTERNAL_SERVER_URL)
+        assert layer_name in all_metadata
+
+        # A layer uploaded after the cache was filled must be found
+        filename = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        layer = save_to_geonode(filename, user=self.user, overwrite=False)
+        metadata = get_metadata(INTERNAL_SERVER_URL, layer.typename)
+        assert metadata['layertype'] == 'vector'
+
+        # Uploads do not drop the capabilities of the server but add to them
+        assert INTERNAL_SERVER_URL in METADATA_CACHE
+        all_metadata = get_metadata(INTERNAL_SERVER_URL)
+        assert layer_name in all_metadata
+        assert layer.typename in all_metadata
+
+    def test_layer_metadata_lookup(self):
+        """Metadata of one layer matches metadata from full capabilities
+        """
+
+        for filename in [os.path.join('hazard', 'jakarta_flood_design.tif'),
+                         os.path.join('exposure', 'buildings_osm_4326.shp')]:
+            path = os.path.join(UNITDATA, filename)
+            layer = save_to_geonode(path, user=self.user, overwrite=True)
+            layer_name = layer.typename
+
+            metadata = get_layer_metadata(INTERNAL_SERVER_URL, layer_name)
+            ref_metadata = get_server_metadata(INTERNAL_SERVER_URL)[layer_name]
+
+            for key in ['id', 'title', 'layertype', 'keywords',
+                        'resolution', 'server_url', 'tile_url']:
+                msg = ('Value for %s was %s from the layer but %s from '
+                       'the server' % (key, metadata[key], ref_metadata[key]))
+                assert metadata[key] == ref_metadata[key], msg
+
+            assert numpy.allclose(metadata['bounding_box'],
+                                  ref_metadata['bounding_box'])
+            if metadata['geotransform'] is not None:
+                assert numpy.allclose(metadata['geotransform'],
+                                      ref_metadata['geotransform'])
+
+    def test_layer_catalog(self):
+        """Metadata of uploaded layers is served from the layer catalog
+        """
+
+        filename = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(filename, user=self.user, overwrite=True)
+        layer_name = layer.typename
+
+        entry = LayerMetadata.objects.get(server_url=INTERNAL_SERVER_URL,
+                                          name=layer_name)
+        assert entry.layertype == 'raster'
+        assert entry.category == 'hazard'
+
+        ref_metadata = get_layer_metadata(INTERNAL_SERVER_URL, layer_name)
+
+        # Without cached capabilities the catalog answers without requests
+        invalidate_metadata()
+        requests = sum(httpclient.POOL.requests.values())
+        metadata = get_metadata(INTERNAL_SERVER_URL, layer_name)
+
+        msg = 'Metadata in catalog was %s, expected %s' % (metadata,
+                                                           ref_metadata)
+        assert metadata == ref_metadata, msg
+        assert get_layer_stamp(metadata) == get_layer_stamp(ref_metadata)
+        assert sum(httpclient.POOL.requests.values()) == requests
+
+        # All layers are taken from the catalog once it was synchronized
+        sync_catalog(INTERNAL_SERVER_URL)
+        invalidate_metadata()
+        requests = sum(httpclient.POOL.requests.values())
+        all_metadata = get_metadata(INTERNAL_SERVER_URL)
+        assert layer_name in all_metadata
+        assert sum(httpclient.POOL.requests.values()) == requests
+
+    def test_download_cache(self):
+        """Repeated downloads are served from the download cache
+        """
+
+        if DOWNLOAD_CACHE is None:
+            return
+
+        filename = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(filename, user=self.user, overwrite=True)
+        bbox = get_bounding_box_string(filename)
+
+        H1 = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+        hits = DOWNLOAD_CACHE.hits
+        H2 = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+
+        msg = 'Second download was not served from the cache'
+        assert DOWNLOAD_CACHE.hits == hits + 1, msg
+
+        msg = 'Cached downloads must be given separate files'
+        assert H1.filename != H2.filename, msg
+        assert nanallclose(H1.get_data(), H2.get_data())
+        assert H1.get_keywords() == H2.get_keywords()
+
+        # Downloads are indexed by layer
+        group = get_download_group(INTERNAL_SERVER_URL, layer.typename)
+        assert len(list(DOWNLOAD_CACHE.entries(group))) == 1
+
+        # Uploading the same data again changes the stamp of the layer,
+        # so other hosts do not serve their cached copies
+        metadata = get_metadata(INTERNAL_SERVER_URL, layer.typename)
+        stamp = get_layer_stamp(metadata)
+        save_to_geonode(filename, user=self.user, overwrite=True)
+        assert get_layer_stamp(metadata) != stamp
+
+        # Temporary directories of killed processes are removed eventually
+        cache = DownloadCache(tempfile.mkdtemp())
+        try:
+            stale = tempfile.mkdtemp(prefix='.tmp-', dir=cache.root)
+            fresh = tempfile.mkdtemp(prefix='.trash-', dir=cache.root)
+            past = time.time() - cache.STALE_AGE - 1
+            os.utime(stale, (past, past))
+            cache.evict()
+            assert not os.path.exists(stale)
+            assert os.path.exists(fresh)
+        finally:
+            shutil.rmtree(cache.root, ignore_errors=True)
+
+    def test_download_clipped_from_cache(self):
+        """Downloads inside a cached bounding box are clipped locally
+        """
+
+        if DOWNLOAD_CACHE is None:
+            return
+
+        for filename in [os.path.join('hazard', 'jakarta_flood_design.tif'),
+                         os.path.join('exposure', 'buildings_osm_4326.shp')]:
+            path = os.path.join(UNITDATA, filename)
+            layer = save_to_geonode(path, user=self.user, overwrite=True)
+            bbox = bboxstring2list(get_bounding_box_string(path))
+
+            L1 = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+
+            # Shrink bounding box by about a quarter on each side, by
+            # whole pixels for rasters
+            dx = (bbox[2] - bbox[0]) / 4
+            dy = (bbox[3] - bbox[1]) / 4
+            if filename.endswith('.tif'):
+                resx, resy = L1.get_resolution()
+                dx = round(dx / resx) * resx
+                dy = round(dy / resy) * resy
+            sub_bbox = [bbox[0] + dx, bbox[1] + dy,
+                        bbox[2] - dx, bbox[3] - dy]
+
+            clipped = DOWNLOAD_STATS['clipped']
+            L2 = download(INTERNAL_SERVER_URL, layer.typename, sub_bbox)
+
+            msg = 'Download of %s was not clipped from cache' % sub_bbox
+            assert DOWNLOAD_STATS['clipped'] == clipped + 1, msg
+
+            if filename.endswith('.tif'):
+                # Clipped raster is on the grid the server returns
+                result_bbox = L2.get_bounding_box()
+                msg = ('Clipped layer has bounding box %s, expected %s'
+                       % (result_bbox, sub_bbox))
+                assert numpy.allclose(result_bbox, sub_bbox,
+                                      rtol=1.0e-12), msg
+
+                row = int(round(dy / resy))
+                col = int(round(dx / resx))
+                A1 = L1.get_data(nan=True)
+                A2 = L2.get_data(nan=True)
+                assert nanallclose(A2, A1[row:row + A2.shape[0],
+                                          col:col + A2.shape[1]])
+
+                # Grids not made of cached pixels are downloaded
+                shifted = [sub_bbox[0] + resx / 3, sub_bbox[1],
+                           sub_bbox[2] + resx / 3, sub_bbox[3]]
+                download(INTERNAL_SERVER_URL, layer.typename, shifted)
+                msg = 'Download of %s was clipped from cache' % shifted
+                assert DOWNLOAD_STATS['clipped'] == clipped + 1, msg
+            else:
+                assert len(L2) <= len(L1)
+
+            assert L1.get_keywords() == L2.get_keywords()
+
+    def test_tiled_raster_download(self):
+        """Large rasters are downloaded in tiles without changing the data
+        """
+
+        hazard_filename = os.path.join(UNITDATA, 'hazard',
+                                       'jakarta_flood_design.tif')
+        H = read_layer(hazard_filename)
+        A_ref = H.get_data(nan=True)
+
+        hazard_layer = save_to_geonode(hazard_filename, user=self.user)
+        hazard_name = hazard_layer.typename
+        invalidate_downloads(INTERNAL_SERVER_URL, hazard_name)
+
+        # Force a grid of several tiles
+        Server.objects.create(name='Tiled', url=INTERNAL_SERVER_URL,
+                              tile_size=max(A_ref.shape) // 3,
+                              download_threads=2)
+
+        bbox = get_bounding_box_string(hazard_filename)
+        H = download(INTERNAL_SERVER_URL, hazard_name, bbox)
+        A = H.get_data(nan=True)
+
+        msg = ('Shape of tiled raster was %s. Expected %s'
+               % (A.shape, A_ref.shape))
+        assert A.shape == A_ref.shape, msg
+        assert nanallclose(A, A_ref, rtol=1.0e-8)
+
+        # Tiled and whole downloads share their grid at any resolution
+        bb = bboxstring2list(bbox)
+        bb = [bb[0] + 0.013, bb[1] + 0.017, bb[2] - 0.011, bb[3] - 0.007]
+        res = H.get_resolution()[0] * 0.7
+        T = download(INTERNAL_SERVER_URL, hazard_name, bb, resolution=res)
+
+        Server.objects.all().delete()
+        invalidate_downloads(INTERNAL_SERVER_URL, hazard_name)
+        W = download(INTERNAL_SERVER_URL, hazard_name, bb, resolution=res)
+
+        msg = ('Geotransform of tiled raster was %s. Expected %s'
+               % (T.get_geotransform(), W.get_geotransform()))
+        assert numpy.allclose(T.get_geotransform(), W.get_geotransform(),
+                              rtol=1.0e-12), msg
+        assert T.get_data().shape == W.get_data().shape
+
+    def test_vector_download_from_archive(self):
+        """Vector layers are read from the downloaded archive directly
+        """
+
+        filename = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        V_ref = read_layer(filename)
+        layer = save_to_geonode(filename, user=self.user, overwrite=True)
+
+        bbox = get_bounding_box_string(filename)
+        V = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+
+        msg = 'Expected layer read through /vsizip/, got %s' % V.filename
+        assert V.filename.startswith('/vsizip/'), msg
+        assert layer_file_exists(V.filename)
+
+        msg = ('Expected %i features, got %i' % (len(V_ref), len(V)))
+        assert len(V) == len(V_ref), msg
+
+        keywords = V.get_keywords()
+        for key, value in V_ref.get_keywords().items():
+            assert keywords[key] == value
+
+    def test_stand_in_server(self):
+        """Layers of the benchmark stand-in server can be downloaded
+        """
+
+        raster = SyntheticRaster('bench:hazard', 40, 80)
+        vector = SyntheticVector('bench:exposure', 50)
+        server = StandInServer([raster, vector])
+        server.start()
+        try:
+            metadata = get_metadata(server.url)
+            for layer in [raster, vector]:
+                msg = 'Expected layer %s in %s' % (layer.name,
+                                                   metadata.keys())
+                assert layer.name in metadata, msg
+                assert metadata[layer.name]['layertype'] == layer.layertype
+
+            H = download(server.url, raster.name, raster.bbox,
+                         metadata=metadata[raster.name])
+            A = H.get_data()
+            msg = 'Expected shape %s, got %s' % ((40, 80), A.shape)
+            assert A.shape == (40, 80), msg
+            assert numpy.allclose(A, raster.data)
+
+            E = download(server.url, vector.name, vector.bbox,
+                         metadata=metadata[vector.name])
+            msg = 'Expected %i features, got %i' % (50, len(E))
+            assert len(E) == 50, msg
+            assert get_feature_count(server.url, vector.name,
+                                     vector.bbox) == 50
+
+            # Missing layers do not disable virtual services
+            invalidate_metadata(server.url)
+            try:
+                get_metadata(server.url, 'bench:missing')
+            except Exception:
+                pass
+            else:
+                raise Exception('Missing layer should have raised')
+            assert server.url not in NO_VIRTUAL_SERVICES
+        finally:
+            invalidate_metadata(server.url)
+            server.stop()
+
+        # Servers without virtual services are not asked again for a while
+        server = StandInServer([raster, vector], virtual_services=False)
+        server.start()
+        try:
+            assert get_metadata(server.url, raster.name)['layertype'] == \
+                'raster'
+            assert server.url in NO_VIRTUAL_SERVICES
+        finally:
+            invalidate_metadata(server.url)
+            LayerMetadata.objects.filter(server_url=server.url).delete()
+            server.stop()
+
     def test_geotransform_from_geonode(self):
         """Geotransforms of GeoNode layers can be correctly determined
         """
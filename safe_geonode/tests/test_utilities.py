@@ -0,0 +1,205 @@
+import numpy
+import unittest
+
+from safe_geonode.views import build_questions
+from safe_geonode.utilities import bbox_intersection, BoundingBoxIndex
+from safe_geonode.utilities import bbox_intersections, bbox_overlap_matrix
+from safe_geonode.utilities import bbox_validity, bbox_areas
+from safe_geonode.utilities import buffered_bounding_box, buffered_bounding_boxes
+from safe_geonode.utilities import bboxlist2string, check_bbox_string
+from safe_geonode.utilities import plan_resolution, raster_pixels
+from safe_geonode.utilities import get_raster_grid, BYTES_PER_PIXEL
+
+
+class TestUtilities(unittest.TestCase):
+    """Tests of helpers that need neither GeoNode nor GeoServer
+    """
+
+    def test_build_questions(self):
+        """Admissible functions are looked up once per keyword signature
+        """
+
+        def layer(category, subcategory, layertype, title,
+                  bbox=(106.0, -7.0, 107.0, -6.0)):
+            return {'layertype': layertype,
+                    'bounding_box': bbox,
+                    'keywords': {'category': category,
+                                 'subcategory': subcategory,
+                                 'title': title}}
+
+        layers = {'flood_a': layer('hazard', 'flood', 'raster', 'Flood A'),
+                  'flood_b': layer('hazard', 'flood', 'raster', 'Flood B'),
+                  'quake': layer('hazard', 'earthquake', 'raster', 'Quake'),
+                  'roads': layer('exposure', 'road', 'vector', 'Roads'),
+                  'houses_a': layer('exposure', 'building', 'vector', 'A'),
+                  'houses_b': layer('exposure', 'building', 'vector', 'B'),
+                  'boundaries': {'layertype': 'vector',
+                                 'bounding_box': (95.0, -11.0, 141.0, 6.0),
+                                 'keywords': {}}}
+
+        calls = []
+
+        def plugin_lookup(keywords):
+            calls.append(keywords)
+            hazard, exposure = keywords
+            if (hazard['subcategory'] == 'flood' and
+                exposure['subcategory'] == 'building'):
+                return {'Flood Building Impact Function': None}
+            return {}
+
+        questions = build_questions(layers, plugin_lookup=plugin_lookup)
+
+        # Two hazard and two exposure signatures
+        assert len(calls) == 4
+        for hazard, exposure in calls:
+            assert hazard['layertype'] == 'raster'
+            assert exposure['layertype'] == 'vector'
+            assert 'title' not in hazard
+
+        pairs = sorted((q['hazard'], q['exposure']) for q in questions)
+        assert pairs == [('flood_a', 'houses_a'), ('flood_a', 'houses_b'),
+                         ('flood_b', 'houses_a'), ('flood_b', 'houses_b')]
+        for question in questions:
+            assert question['function'] == 'Flood Building Impact Function'
+
+        # Layer keywords are left alone
+        assert 'layertype' not in layers['flood_a']['keywords']
+
+        # Only pairs overlapping each other and the area of interest
+        layers['flood_b']['bounding_box'] = (106.5, -6.5, 107.5, -5.5)
+        layers['houses_b']['bounding_box'] = (105.0, -8.0, 106.4, -6.6)
+
+        questions = build_questions(layers, plugin_lookup=plugin_lookup)
+        pairs = sorted((q['hazard'], q['exposure']) for q in questions)
+        assert pairs == [('flood_a', 'houses_a'), ('flood_a', 'houses_b'),
+                         ('flood_b', 'houses_a')]
+
+        questions = build_questions(layers, plugin_lookup=plugin_lookup,
+                                    bbox=[106.6, -6.4, 106.9, -6.1])
+        pairs = sorted((q['hazard'], q['exposure']) for q in questions)
+        assert pairs == [('flood_a', 'houses_a'), ('flood_b', 'houses_a')]
+
+    def test_bounding_box_index(self):
+        """Bounding box index finds the same boxes as bbox_intersection
+        """
+
+        numpy.random.seed(17)
+        boxes = []
+        for i in range(200):
+            west, south = numpy.random.uniform(-50, 50, 2)
+            width, height = numpy.random.uniform(0.1, 20, 2)
+            boxes.append((i, [west, south, west + width, south + height]))
+
+        index = BoundingBoxIndex(boxes)
+        assert len(index) == len(boxes)
+
+        for key, bbox in boxes[:50]:
+            expected = [k for k, box in boxes
+                        if bbox_intersection(bbox, box) is not None]
+            assert sorted(index.query(bbox)) == sorted(expected)
+
+        # Boxes sharing a border do not overlap
+        index = BoundingBoxIndex([('a', [0, 0, 1, 1])])
+        assert index.query([1, 0, 2, 1]) == []
+        assert index.query([0.5, 0.5, 2, 2]) == ['a']
+
+    def test_bbox_kernels(self):
+        """Batch bounding box functions agree with the single box versions
+        """
+
+        numpy.random.seed(23)
+        boxes = []
+        for i in range(100):
+            west, south = numpy.random.uniform(-100, 100, 2)
+            width, height = numpy.random.uniform(-5, 40, 2)
+            boxes.append([west, south, west + width, south + height])
+        viewport = [-30.0, -20.0, 40.0, 35.0]
+
+        valid = bbox_validity(boxes)
+        intersections, mask = bbox_intersections(boxes, viewport)
+        matrix = bbox_overlap_matrix(boxes)
+        areas = bbox_areas(boxes)
+        buffered = buffered_bounding_boxes(boxes, (0.5, 0.25))
+
+        for i, box in enumerate(boxes):
+            bbox_string = bboxlist2string(box)
+            try:
+                check_bbox_string(bbox_string)
+            except AssertionError:
+                assert not valid[i], bbox_string
+            else:
+                assert valid[i], bbox_string
+
+            well_formed = box[0] < box[2] and box[1] < box[3]
+            if well_formed:
+                expected = bbox_intersection(box, viewport)
+                assert mask[i] == (expected is not None)
+                if expected is not None:
+                    assert numpy.allclose(intersections[i], expected)
+
+                for j, other in enumerate(boxes):
+                    if other[0] < other[2] and other[1] < other[3]:
+                        expected = bbox_intersection(box, other) is not None
+                        assert matrix[i, j] == expected
+            else:
+                assert not mask[i]
+                assert areas[i] == 0
+
+            assert numpy.allclose(buffered[i],
+                                  buffered_bounding_box(box, (0.5, 0.25)))
+
+        assert numpy.allclose(bbox_areas([[0, 0, 2, 3]]), [6])
+        assert numpy.allclose(buffered_bounding_boxes([[0, 0, 1, 1]], 1),
+                              [[-1, -1, 2, 2]])
+
+    def test_resolution_planner(self):
+        """Raster resolution is coarsened to multiples of native resolutions
+        """
+
+        def layer(name, layertype, resolution=None):
+            return {'id': name, 'layertype': layertype,
+                    'resolution': resolution}
+
+        hazard = layer('hazard', 'raster', (0.01, 0.01))
+        exposure = layer('exposure', 'raster', (0.025, 0.025))
+        vector = layer('vector', 'vector')
+
+        # 10 x 10 degrees at 0.01 degrees is 10^6 pixels per raster
+        bbox = [100, -10, 110, 0]
+
+        resolution, reason = plan_resolution(vector, vector, bbox, 1000)
+        assert resolution is None
+
+        resolution, reason = plan_resolution(hazard, exposure, bbox,
+                                             2 * 10 ** 6 * BYTES_PER_PIXEL)
+        assert resolution == (0.01, 0.01)
+        assert 'fits' in reason
+
+        # Half the pixels in each direction is a quarter of the bytes
+        budget = 2 * 10 ** 6 * BYTES_PER_PIXEL / 4
+        resolution, reason = plan_resolution(hazard, exposure, bbox, budget)
+        assert numpy.allclose(resolution, (0.02, 0.02)), resolution
+        assert '2 times the native resolution of hazard' in reason
+
+        # The exposure grid is finer than the third multiple of the hazard
+        budget = 2 * 10 ** 6 * BYTES_PER_PIXEL / 5
+        resolution, reason = plan_resolution(hazard, exposure, bbox, budget)
+        assert numpy.allclose(resolution, (0.025, 0.025)), resolution
+        assert 'native resolution of exposure' in reason
+
+        # A single raster is coarsened on its own
+        resolution, reason = plan_resolution(hazard, vector, bbox,
+                                             10 ** 6 * BYTES_PER_PIXEL / 8)
+        assert numpy.allclose(resolution, (0.03, 0.03)), resolution
+
+        # Pixels are counted on the grid that is downloaded
+        assert raster_pixels([0, 0, 1, 1], (0.3, 0.3)) == 9
+        assert raster_pixels([0, 0, 1, 1], (0.3, 0.3)) == \
+            numpy.prod(get_raster_grid([0, 0, 1, 1], (0.3, 0.3))[1])
+
+        # Chosen resolutions always fit
+        for budget in [10 ** 4, 10 ** 6, 10 ** 9]:
+            resolution, reason = plan_resolution(hazard, exposure, bbox,
+                                                 budget)
+            size = 2 * raster_pixels(bbox, resolution) * BYTES_PER_PIXEL
+            assert size <= budget, reason
@@ -8,6 +8,10 @@ urlpatterns = patterns('',
 
 urlpatterns += patterns('safe_geonode.views',
                        url(r'^api/v1/calculate/$', 'calculate', name='safe-calculate'),
+                       url(r'^api/v1/calculation/(?P<calculation_id>\d+)/$', 'calculation_status', name='safe-calculation'),
+                       url(r'^api/v1/plan/$', 'plan', name='safe-plan'),
                        url(r'^api/v1/questions/$', 'questions', name='safe-questions'),
+                       url(r'^api/v1/profile/(?P<profile_id>\d+)/$', 'profile', name='safe-profile'),
                        url(r'^api/v1/debug/$', 'debug', name='safe-debug'),
+                       url(r'^api/v1/metrics/$', 'metrics_view', name='safe-metrics'),
 )
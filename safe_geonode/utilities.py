@@ -2,11 +2,17 @@
 """
 
 import os
+import sys
 import copy
+import bisect
 import numpy
 import math
+import time
+import resource
 import logging
+import threading
 
+from multiprocessing.pool import ThreadPool
 from osgeo import ogr
 from tempfile import mkstemp
 from urllib2 import urlopen
@@ -44,6 +50,24 @@ WFS_TEMPLATE = '%s?service=WFS&version=1.0.0' + \
     '&request=GetFeature&typeName=%s' + \
     '&outputFormat=SHAPE-ZIP&bbox=%s'
 
+# Template for capabilities documents, takes server url and service name
+CAPABILITIES_TEMPLATE = '%s?service=%s&version=1.0.0&request=GetCapabilities'
+
+# Template for downloading one tile of a raster with an exact pixel count
+WCS_TILE_TEMPLATE = '%s?version=1.0.0' + \
+    '&service=wcs&request=getcoverage&format=GeoTIFF&' + \
+    'store=false&coverage=%s&crs=EPSG:4326&bbox=%s' + \
+    '&width=%i&height=%i'
+
+# Template for counting features in a bounding box without downloading
+# them. Takes server url, layer name and bounding box string.
+WFS_HITS_TEMPLATE = '%s?service=WFS&version=1.1.0' + \
+    '&request=GetFeature&typeName=%s&resultType=hits' + \
+    '&bbox=%s,EPSG:4326'
+
+# Bytes per pixel of rasters read into memory as 64 bit floats
+BYTES_PER_PIXEL = 8
+
 
 # Miscellaneous auxiliary functions
 def unique_filename(**kwargs):
@@ -271,6 +295,61 @@ def bbox_intersection(*args):
         return None
 
 
+class BoundingBoxIndex(object):
+    """Index of bounding boxes answering which of them overlap a box
+
+    Input
+        items: List of (key, bbox) pairs where each bbox has the
+               form [W, S, E, N]
+
+    Boxes are sorted by their western border. A query only inspects
+    boxes whose western border lies within the widest box west of the
+    queried box and east of its western border, so it does not have
+    to visit every box.
+    Boxes overlap when bbox_intersection of them is not None, boxes
+    only sharing a border do not overlap.
+    """
+
+    def __init__(self, items):
+        self._entries = sorted(((list(bbox), key) for key, bbox in items),
+                               key=lambda entry: entry[0][0])
+        self._wests = [bbox[0] for bbox, key in self._entries]
+
+        if self._entries:
+            self._max_width = max(bbox[2] - bbox[0]
+                                  for bbox, key in self._entries)
+        else:
+            self._max_width = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def query(self, bbox):
+        """Get keys of all boxes overlapping bbox
+
+        Input
+            bbox: Bounding box of the form [W, S, E, N]
+
+        Output
+            List of keys in order of the western borders of their boxes
+        """
+
+        west, south, east, north = bbox
+
+        # Boxes further west cannot reach the western border
+        start = bisect.bisect_right(self._wests, west - self._max_width)
+
+        # Boxes starting at or east of the eastern border cannot overlap
+        stop = bisect.bisect_left(self._wests, east)
+
+        keys = []
+        for box, key in self._entries[start:stop]:
+            if box[2] > west and box[1] < north and box[3] > south:
+                keys.append(key)
+
+        return keys
+
+
 def buffered_bounding_box(bbox, resolution):
     """Grow bounding box with one unit of resolution in each direction
 
@@ -323,6 +402,245 @@ def buffered_bounding_box(bbox, resolution):
     return bbox
 
 
+def bbox_array(boxes):
+    """Convert bounding boxes to an array with one box per row
+
+    Input
+        boxes: Bounding box [W, S, E, N] or sequence of bounding boxes
+
+    Output
+        Array of floats with shape (N, 4)
+    """
+
+    try:
+        array = numpy.array(boxes, dtype=numpy.float64)
+    except (ValueError, TypeError), e:
+        msg = ('Bounding boxes %s contained non-numeric entries, '
+               'original error was "%s".' % (str(boxes), e))
+        raise AssertionError(msg)
+
+    if array.ndim == 1:
+        array = array.reshape(1, -1)
+
+    msg = ('Bounding boxes must have 4 coordinates [W, S, E, N]. '
+           'I got %s' % str(boxes))
+    assert array.ndim == 2 and array.shape[1] == 4, msg
+
+    return array
+
+
+def bbox_validity(boxes):
+    """Determine which bounding boxes are valid
+
+    Input
+        boxes: Bounding boxes as accepted by bbox_array
+
+    Output
+        Boolean array of shape (N,) which is True where the box lies
+        within longitudes [-180:180] and latitudes [-90:90] and has
+        W < E and S < N, the conditions of check_bbox_string.
+    """
+
+    boxes = bbox_array(boxes)
+    west, south, east, north = boxes.T
+
+    return ((-180 <= west) & (west <= 180) &
+            (-180 <= east) & (east <= 180) &
+            (-90 <= south) & (south <= 90) &
+            (-90 <= north) & (north <= 90) &
+            (west < east) & (south < north))
+
+
+def bbox_areas(boxes):
+    """Get area of bounding boxes in square degrees
+
+    Input
+        boxes: Bounding boxes as accepted by bbox_array
+
+    Output
+        Array of shape (N,). Boxes with W >= E or S >= N have area 0.
+    """
+
+    boxes = bbox_array(boxes)
+    width = numpy.maximum(boxes[:, 2] - boxes[:, 0], 0)
+    height = numpy.maximum(boxes[:, 3] - boxes[:, 1], 0)
+    return width * height
+
+
+def bbox_intersections(boxes, *others):
+    """Intersect bounding boxes row by row
+
+    Input
+        boxes: Bounding boxes as accepted by bbox_array
+        others: Further bounding boxes, each either of the same number of
+                rows as boxes or a single box intersected with every row
+
+    Output
+        intersections: Array of shape (N, 4) with the minimal common box
+                       of each row
+        mask: Boolean array of shape (N,) which is True where the
+              intersection is not empty. This is where bbox_intersection
+              would not return None.
+    """
+
+    result = bbox_array(boxes).copy()
+    for other in [[-180, -90, 180, 90]] + list(others):
+        other = bbox_array(other)
+        result[:, :2] = numpy.maximum(result[:, :2], other[:, :2])
+        result[:, 2:] = numpy.minimum(result[:, 2:], other[:, 2:])
+
+    mask = (result[:, 0] < result[:, 2]) & (result[:, 1] < result[:, 3])
+    return result, mask
+
+
+def bbox_overlap_matrix(boxes, others=None):
+    """Determine which pairs of bounding boxes overlap
+
+    Input
+        boxes: N bounding boxes as accepted by bbox_array
+        others: M bounding boxes. If None, boxes are compared to themselves.
+
+    Output
+        Boolean array of shape (N, M) which is True where the intersection
+        of boxes[i] and others[j] is not empty
+    """
+
+    boxes = bbox_array(boxes)
+    if others is None:
+        others = boxes
+    else:
+        others = bbox_array(others)
+
+    west = numpy.maximum(numpy.maximum(boxes[:, 0, None],
+                                       others[None, :, 0]), -180)
+    south = numpy.maximum(numpy.maximum(boxes[:, 1, None],
+                                        others[None, :, 1]), -90)
+    east = numpy.minimum(numpy.minimum(boxes[:, 2, None],
+                                       others[None, :, 2]), 180)
+    north = numpy.minimum(numpy.minimum(boxes[:, 3, None],
+                                        others[None, :, 3]), 90)
+
+    return (west < east) & (south < north)
+
+
+def buffered_bounding_boxes(boxes, resolution):
+    """Grow bounding boxes by resolution in each direction
+
+    Input
+        boxes: Bounding boxes as accepted by bbox_array
+        resolution: Either None, one resolution for both directions,
+                    (resx, resy) for all boxes or an array of shape (N, 2)
+                    with (resx, resy) for each box
+
+    Output
+        Array of shape (N, 4), see buffered_bounding_box
+    """
+
+    boxes = bbox_array(boxes).copy()
+
+    if resolution is None:
+        return boxes
+
+    resolution = numpy.array(resolution, dtype=numpy.float64)
+    if resolution.ndim == 0:
+        resolution = numpy.array([resolution, resolution])
+
+    resx = resolution[..., 0]
+    resy = resolution[..., 1]
+
+    boxes[:, 0] -= resx
+    boxes[:, 1] -= resy
+    boxes[:, 2] += resx
+    boxes[:, 3] += resy
+
+    return boxes
+
+
+class CancelledError(Exception):
+    """Raised by check_cancelled in calls that were given up on
+    """
+    pass
+
+
+# Cancellation events of the run_in_threads calls a thread works for
+_cancellation = threading.local()
+
+
+def check_cancelled():
+    """Raise CancelledError if the results of this thread are not wanted
+
+    Long running functions passed to run_in_threads, directly or further
+    down, call this regularly so they stop soon after a timeout.
+    """
+
+    for event in getattr(_cancellation, 'events', []):
+        if event.is_set():
+            raise CancelledError('Call was cancelled')
+
+
+def run_in_threads(function, arguments, threads, timeout=None):
+    """Apply function to each item of arguments using a pool of threads
+
+    Input
+        function: Function taking one argument
+        arguments: List of arguments
+        threads: Maximal number of concurrent calls
+        timeout: Optional number of seconds all calls must complete in
+
+    Output
+        Iterator over results in the order they complete.
+        Exceptions raised by function are raised by the iterator.
+        multiprocessing.TimeoutError is raised when the time is up.
+
+    Threads can not be killed, so calls still running when the iterator
+    stops, e.g. on timeout, keep running. They are cancelled instead:
+    check_cancelled raises CancelledError in them from then on, also in
+    threads they start through run_in_threads themselves. Calls that do
+    not check, or are blocked in a read, finish their work unnoticed.
+    """
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    cancel = threading.Event()
+    events = getattr(_cancellation, 'events', []) + [cancel]
+
+    def call(argument):
+        _cancellation.events = events
+        try:
+            return function(argument)
+        finally:
+            _cancellation.events = []
+
+    pool = ThreadPool(max(1, min(threads, len(arguments))))
+    try:
+        results = pool.imap_unordered(call, arguments)
+        for i in range(len(arguments)):
+            if timeout is None:
+                yield results.next()
+            else:
+                yield results.next(max(0, deadline - time.time()))
+    finally:
+        cancel.set()
+        pool.terminate()
+
+
+def get_peak_rss():
+    """Get peak resident memory of this process in bytes
+
+    This is the maximum since the process started, so for long running
+    processes it may stem from earlier work.
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, Mac OS X bytes
+    if sys.platform == 'darwin':
+        return peak
+    else:
+        return peak * 1024
+
+
 def is_sequence(x):
     """Determine if x behaves like a true sequence but not a string
 
@@ -486,6 +804,119 @@ def get_common_resolution(haz_metadata, exp_metadata):
     return raster_resolution
 
 
+def get_raster_grid(bbox, resolution):
+    """Get pixel grid of a raster downloaded for a bounding box
+
+    Input
+        bbox: Bounding box [W, S, E, N]
+        resolution: (resx, resy)
+
+    Output
+        origin: (west, north) of grid
+        shape: (nrows, ncols) of grid
+        pixel: (resx, resy) of grid
+
+    The grid is anchored at the corner of bbox and covers it exactly, so
+    layers of a calculation downloaded for the same bbox and resolution
+    share their grid. Pixel counts are rounded, so pixels are slightly
+    larger or smaller than resolution if the bbox is not a multiple of it.
+    """
+
+    resx, resy = resolution
+    west, south, east, north = bbox
+
+    ncols = max(1, int(round((east - west) / resx)))
+    nrows = max(1, int(round((north - south) / resy)))
+
+    return ((west, north), (nrows, ncols),
+            (float(east - west) / ncols, float(north - south) / nrows))
+
+
+def raster_pixels(bbox, resolution):
+    """Count pixels of a raster downloaded for a bounding box
+
+    Input
+        bbox: Bounding box [W, S, E, N]
+        resolution: (resx, resy)
+
+    Output
+        Number of pixels of the grid of get_raster_grid, at least 1
+    """
+
+    nrows, ncols = get_raster_grid(bbox, resolution)[1]
+    return nrows * ncols
+
+
+def plan_resolution(haz_metadata, exp_metadata, bbox, budget):
+    """Choose raster resolution so that rasters fit into a memory budget
+
+    Input
+        haz_metadata: Metadata for hazard layer
+        exp_metadata: Metadata for exposure layer
+        bbox: Bounding box [W, S, E, N] of the data to download
+        budget: Maximal number of bytes of raster data held in memory
+
+    Output
+        raster_resolution: Resolution to download rasters at or None for
+                           the native resolution, see get_common_resolution
+        reason: Sentence explaining the choice
+
+    The resolution of get_common_resolution is used if it fits. If not,
+    the finest integer multiple of the native resolution of one of the
+    raster layers that fits is used. The multiple only sizes the pixels,
+    rasters are still resampled onto the grid of the bounding box, see
+    get_raster_grid.
+    """
+
+    rasters = [metadata for metadata in [haz_metadata, exp_metadata]
+               if metadata['layertype'] == 'raster']
+    if not rasters:
+        return None, 'No raster layers are involved.'
+
+    raster_resolution = get_common_resolution(haz_metadata, exp_metadata)
+
+    def size(resolution):
+        # Every raster is downloaded at the same resolution
+        return (len(rasters) * raster_pixels(bbox, resolution) *
+                BYTES_PER_PIXEL)
+
+    resolution = raster_resolution or rasters[0]['resolution']
+    estimate = size(resolution)
+    if estimate <= budget:
+        reason = ('Native resolution %s fits an estimated %i bytes into '
+                  'the budget of %i bytes.' % (tuple(resolution), estimate,
+                                               budget))
+        return raster_resolution, reason
+
+    best = None
+    for metadata in rasters:
+        resx, resy = metadata['resolution']
+
+        # Pixel count falls with the square of the factor
+        factor = max(1, int(math.sqrt(size((resx, resy)) / budget)))
+        while (size((resx * factor, resy * factor)) > budget and
+               raster_pixels(bbox, (resx * factor, resy * factor)) > 1):
+            factor += 1
+
+        candidate = (resx * factor, resy * factor)
+        if best is None or candidate[0] * candidate[1] < best[0][0] * best[0][1]:
+            best = candidate, factor, metadata
+
+    resolution, factor, metadata = best
+    if factor == 1:
+        grid = 'the native resolution of %s' % metadata['id']
+    else:
+        grid = ('%i times the native resolution of %s'
+                % (factor, metadata['id']))
+
+    reason = ('Native resolution %s would need an estimated %i bytes, '
+              'more than the budget of %i bytes. Using %s instead, which '
+              'needs %i bytes.'
+              % (tuple(raster_resolution or rasters[0]['resolution']),
+                 estimate, budget, grid, size(resolution)))
+    return resolution, reason
+
+
 def get_bounding_boxes(haz_metadata, exp_metadata, req_bbox):
     """Check and get appropriate bounding boxes for input layers
 
@@ -510,9 +941,12 @@ def get_bounding_boxes(haz_metadata, exp_metadata, req_bbox):
         check_bbox_string(req_bbox)
         vpt_bbox = bboxstring2list(req_bbox)
     elif is_sequence(req_bbox):
-        x = bboxlist2string(req_bbox)
-        check_bbox_string(x)
-        vpt_bbox = bboxstring2list(x)
+        boxes = bbox_array(req_bbox)
+        msg = ('Bounding box %s must be of the form [W, S, E, N] with '
+               'W < E within [-180:180] and S < N within [-90:90]'
+               % str(req_bbox))
+        assert len(boxes) == 1 and bbox_validity(boxes)[0], msg
+        vpt_bbox = boxes[0].tolist()
     else:
         msg = ('Invalid bounding box %s (%s). '
                'It must be a string or a list' % (str(req_bbox), type(req_bbox)))
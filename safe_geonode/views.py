@@ -24,30 +24,78 @@ All API calls start with:
 from __future__ import division
 
 import sys
+import time
 import inspect
 import datetime
 
+from multiprocessing import TimeoutError
+
 from safe_geonode.storage import download
 from safe_geonode.storage import get_metadata
 from safe_geonode.storage import save_file_to_geonode
+from safe_geonode.storage import get_cache_stats
+from safe_geonode.storage import get_layer_stamp
+from safe_geonode.storage import get_feature_count
+from safe_geonode.storage import get_layer_size
 from safe_geonode.models import Calculation, Workspace
+from safe_geonode.models import PerformanceProfile
+from safe_geonode.profiling import profiled, load_stats, get_pstats
+from safe_geonode.profiling import collapse_stats
+from safe_geonode.scratch import SCRATCH, with_workspace
+from safe_geonode.cache import make_key
+from safe_geonode import jobs
+from safe_geonode import metrics
 from safe_geonode.utilities import bboxlist2string
 from safe_geonode.utilities import titelize
-from safe_geonode.utilities import get_common_resolution, get_bounding_boxes
+from safe_geonode.utilities import get_bounding_boxes, plan_resolution
+from safe_geonode.utilities import run_in_threads
+from safe_geonode.utilities import get_peak_rss
+from safe_geonode.utilities import raster_pixels, BYTES_PER_PIXEL
+from safe_geonode.utilities import BoundingBoxIndex
+from safe_geonode.utilities import bbox_intersections
+from safe_geonode.utilities import check_bbox_string, bboxstring2list
 
 from safe.api import get_admissible_plugins
 from safe.api import calculate_impact
 
 from geonode.layers.utils import get_valid_user
+from geonode.layers.models import Layer
 
 from django.utils import simplejson as json
 from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.db import connection
 from geonode.utils import ogc_server_settings
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.cache import cache_page
+from django.contrib.admin.views.decorators import staff_member_required
 
 from urlparse import urljoin
+from StringIO import StringIO
+
+# Seconds for which results of calculations are reused, None disables it
+RESULT_CACHE_TIMEOUT = getattr(settings, 'SAFE_RESULT_CACHE_TIMEOUT',
+                               7 * 24 * 3600)
+
+# Seconds to wait for an identical calculation that is still running
+RESULT_WAIT_TIMEOUT = getattr(settings, 'SAFE_RESULT_WAIT_TIMEOUT', 1800)
+RESULT_POLL_INTERVAL = 2
+
+# Maximal number of bytes of raster data of one calculation, rasters
+# are downloaded at a coarser resolution if they would need more
+RASTER_MEMORY_BUDGET = getattr(settings, 'SAFE_RASTER_MEMORY_BUDGET',
+                               512 * 1024 ** 2)
+
+# Keywords describing a single layer rather than what kind of layer it
+# is. Impact functions do not select layers by them.
+DESCRIPTIVE_KEYWORDS = ['title', 'source', 'resolution']
+
+# Seconds within which metadata of both layers and their downloads must
+# have arrived. Both layers are handled at the same time.
+METADATA_TIMEOUT = getattr(settings, 'SAFE_METADATA_TIMEOUT', 120)
+DOWNLOAD_TIMEOUT = getattr(settings, 'SAFE_DOWNLOAD_TIMEOUT', 1800)
 
 
 def exception_format(e):
@@ -90,57 +138,57 @@ def get_servers(user):
     return geoservers
 
 
-@csrf_exempt
-def calculate(request, save_output=save_file_to_geonode):
-    start = datetime.datetime.now()
+@with_workspace
+@metrics.in_flight('safe_calculations_in_flight')
+@profiled('calculate')
+def execute_calculation(calculation, impact_function_name, requested_bbox,
+                        save_output=save_file_to_geonode):
+    """Download layers, compute impact and upload the result
 
-    if request.method == 'GET':
-        # FIXME: Add a basic form here to be able to generate the POST request.
-        return HttpResponse('This should be accessed by robots, not humans.'
-                            'In other words using HTTP POST instead of GET.')
-    elif request.method == 'POST':
-        data = request.POST
-        impact_function_name = data['impact_function']
-        hazard_server = data['hazard_server']
-        hazard_layer = data['hazard']
-        exposure_server = data['exposure_server']
-        exposure_layer = data['exposure']
-        requested_bbox = data['bbox']
-        keywords = data['keywords']
+    Input
+        calculation: Calculation instance holding the requested layers
+        impact_function_name: Name of the impact function to use
+        requested_bbox: Bounding box string of the area of interest
+        save_output: Function uploading the impact file to GeoNode
 
-    if request.user.is_anonymous():
-        theuser = get_valid_user()
-    else:
-        theuser = request.user
+    Output
+        Dictionary for the JSON response. It holds the keys errors and
+        stacktrace if the calculation failed.
 
-    # Create entry in database
-    calculation = Calculation(user=theuser,
-                              run_date=start,
-                              hazard_server=hazard_server,
-                              hazard_layer=hazard_layer,
-                              exposure_server=exposure_server,
-                              exposure_layer=exposure_layer,
-                              impact_function=impact_function_name,
-                              success=False)
+    Progress and outcome are recorded in calculation as it runs. Scratch
+    files are kept until it returns.
+    """
+
+    hazard_server = calculation.hazard_server
+    hazard_layer = calculation.hazard_layer
+    exposure_server = calculation.exposure_server
+    exposure_layer = calculation.exposure_layer
+    theuser = calculation.user
 
     # Wrap main computation loop in try except to catch and present
     # messages and stack traces in the application
     try:
-        # Get metadata
-        haz_metadata = get_metadata(hazard_server, hazard_layer)
-        exp_metadata = get_metadata(exposure_server, exposure_layer)
-
-        # Determine common resolution in case of raster layers
-        raster_resolution = get_common_resolution(haz_metadata, exp_metadata)
-
-        # Get reconciled bounding boxes
-        haz_bbox, exp_bbox, imp_bbox = get_bounding_boxes(haz_metadata,
-                                                          exp_metadata,
-                                                          requested_bbox)
+        # Get metadata, reconciled bounding boxes and common resolution
+        # in case of raster layers, coarsened if needed to stay within
+        # the memory budget
+        calculation.set_stage('metadata', 0.0)
+        planned = plan_layers(hazard_server, hazard_layer,
+                              exposure_server, exposure_layer, requested_bbox)
+        haz_metadata = planned['hazard_metadata']
+        exp_metadata = planned['exposure_metadata']
+        haz_bbox = planned['hazard_bbox']
+        exp_bbox = planned['exposure_bbox']
+        imp_bbox = planned['impact_bbox']
+        raster_resolution = planned['resolution']
+        if raster_resolution is not None:
+            calculation.resolution = '%.12g,%.12g' % tuple(raster_resolution)
+        calculation.resolution_reason = planned['resolution_reason']
 
         # Record layers to download
-        download_layers = [(hazard_server, hazard_layer, haz_bbox),
-                           (exposure_server, exposure_layer, exp_bbox)]
+        download_layers = [(hazard_server, hazard_layer, haz_bbox,
+                            haz_metadata),
+                           (exposure_server, exposure_layer, exp_bbox,
+                            exp_metadata)]
 
         # Add linked layers if any FIXME: STILL TODO!
 
@@ -158,30 +206,65 @@ def calculate(request, save_output=save_file_to_geonode):
         calculation.impact_function_source = impact_function_source
 
         calculation.bbox = bboxlist2string(imp_bbox)
-        calculation.save()
+        calculation.cache_key = make_key(hazard_server, hazard_layer,
+                                         get_layer_stamp(haz_metadata),
+                                         exposure_server, exposure_layer,
+                                         get_layer_stamp(exp_metadata),
+                                         impact_function_name,
+                                         impact_function_source,
+                                         calculation.bbox,
+                                         raster_resolution)
+        calculation.set_stage('download', 0.1)
+
+        # Reuse the result of an identical calculation if there is one
+        previous = find_memoized_calculation(calculation)
+        if previous is not None:
+            calculation.layer = previous.layer
+            calculation.result = previous.result
+            calculation.success = True
+            finish_calculation(calculation, 'finished')
+            calculation.save()
+            return json.loads(previous.result)
 
         # Start computation
         msg = 'Performing requested calculation'
         #logger.info(msg)
 
         # Download selected layer objects
-        layers = []
-        for server, layer_name, bbox in download_layers:
-            msg = ('- Downloading layer %s from %s'
-                   % (layer_name, server))
-            #logger.info(msg)
-            L = download(server, layer_name, bbox, raster_resolution)
-            layers.append(L)
+        def fetch(server, layer_name, bbox, metadata):
+            # Layers are downloaded concurrently, so each gets its own
+            # statistics. Vector layers have no resolution.
+            stats = {}
+            if metadata['layertype'] == 'raster':
+                resolution = raster_resolution
+            else:
+                resolution = None
+            layer = download(server, layer_name, bbox, resolution,
+                             metadata=metadata, stats=stats)
+            return layer, stats
+
+        fetched = run_stage(fetch, download_layers, DOWNLOAD_TIMEOUT,
+                            'download')
+        layers = [layer for layer, stats in fetched]
+
+        calculation.bytes_downloaded = sum(stats.get('bytes', 0)
+                                           for layer, stats in fetched)
+        sizes = [get_layer_size(layer) for layer in layers]
+        calculation.features = sum(features for features, pixels in sizes)
+        calculation.pixels = sum(pixels for features, pixels in sizes)
 
         # Calculate result using specified impact function
         msg = ('- Calculating impact using %s' % impact_function_name)
         #logger.info(msg)
+        calculation.set_stage('calculation', 0.4)
 
         impact_file = calculate_impact(layers=layers,
                                        impact_fcn=impact_function)
 
         # Upload result to internal GeoServer
         msg = ('- Uploading impact layer %s' % impact_file.name)
+        calculation.set_stage('upload', 0.8)
+
         # Determine layer title for upload
         output_kw = impact_file.get_keywords()
         title = impact_file.get_name() + " using " + output_kw['hazard_title'] + \
@@ -201,15 +284,235 @@ def calculate(request, save_output=save_file_to_geonode):
         trace = exception_format(e)
         calculation.errors = errors
         calculation.stacktrace = trace
+        finish_calculation(calculation, 'failed')
         calculation.save()
-        jsondata = json.dumps({'errors': errors, 'stacktrace': trace})
-        return HttpResponse(jsondata, mimetype='application/json')
+        return {'errors': errors, 'stacktrace': trace}
 
     calculation.layer = urljoin(settings.SITEURL, result.get_absolute_url())
     calculation.success = True
+    calculation.set_stage('output', 0.9)
+
+    output = calculation_output(calculation, impact_file, result)
+
+    finish_calculation(calculation, 'finished')
+    output.update(calculation_report(calculation))
+
+    # Keep output for clients polling the status of the calculation
+    calculation.result = json.dumps(output)
     calculation.save()
 
-    output = calculation.__dict__
+    return output
+
+
+def finish_calculation(calculation, status):
+    """Close the last stage of calculation and record its peak memory
+
+    The calculation is not saved.
+    """
+
+    calculation.end_stage()
+    calculation.peak_rss = get_peak_rss()
+    calculation.status = status
+    calculation.stage = None
+    if status == 'finished':
+        calculation.progress = 1.0
+
+    metrics.inc('safe_calculations_total', status=status)
+
+
+def calculation_report(calculation):
+    """Get status, timings and resource use of a calculation
+
+    Output
+        Dictionary ready for json.dumps
+    """
+
+    return {'status': calculation.status,
+            'stage': calculation.stage,
+            'progress': calculation.progress,
+            'timings': calculation.get_timings(),
+            'bytes_downloaded': calculation.bytes_downloaded,
+            'features': calculation.features,
+            'pixels': calculation.pixels,
+            'peak_rss': calculation.peak_rss}
+
+
+def plan_layers(hazard_server, hazard_layer, exposure_server, exposure_layer,
+                requested_bbox):
+    """Get what is needed to download the layers of a calculation
+
+    Input
+        hazard_server, hazard_layer: Server url and name of hazard layer
+        exposure_server, exposure_layer: Same for the exposure layer
+        requested_bbox: Bounding box string of the area of interest
+
+    Output
+        Dictionary with keys hazard_metadata, exposure_metadata,
+        hazard_bbox, exposure_bbox, impact_bbox, resolution and
+        resolution_reason, see get_bounding_boxes and plan_resolution
+
+    Only metadata is requested, no data is downloaded.
+    """
+
+    haz_metadata, exp_metadata = run_stage(get_metadata,
+                                           [(hazard_server, hazard_layer),
+                                            (exposure_server, exposure_layer)],
+                                           METADATA_TIMEOUT, 'metadata')
+
+    haz_bbox, exp_bbox, imp_bbox = get_bounding_boxes(haz_metadata,
+                                                      exp_metadata,
+                                                      requested_bbox)
+
+    resolution, reason = plan_resolution(haz_metadata, exp_metadata,
+                                         haz_bbox, RASTER_MEMORY_BUDGET)
+
+    return {'hazard_metadata': haz_metadata,
+            'exposure_metadata': exp_metadata,
+            'hazard_bbox': haz_bbox,
+            'exposure_bbox': exp_bbox,
+            'impact_bbox': imp_bbox,
+            'resolution': resolution,
+            'resolution_reason': reason}
+
+
+def estimate_layer(server_url, layer_name, bbox, metadata, resolution):
+    """Estimate the size of the download of one layer
+
+    Input
+        server_url, layer_name: Where the layer is served
+        bbox: Bounding box [W, S, E, N] to be downloaded
+        metadata: Metadata of the layer as returned by get_metadata
+        resolution: Common raster resolution or None for the native one
+
+    Output
+        Dictionary with the layertype and, for rasters, the resolution
+        and estimated pixels and bytes or, for vectors, the number of
+        features as counted by the server.
+    """
+
+    estimate = {'layer': layer_name,
+                'server': server_url,
+                'layertype': metadata['layertype'],
+                'bbox': bbox}
+
+    if metadata['layertype'] == 'raster':
+        if resolution is None:
+            resolution = metadata['resolution']
+        pixels = raster_pixels(bbox, resolution)
+        estimate['resolution'] = list(resolution)
+        estimate['pixels'] = pixels
+        estimate['bytes'] = pixels * BYTES_PER_PIXEL
+    else:
+        estimate['features'] = get_feature_count(server_url, layer_name,
+                                                 bbox)
+
+    return estimate
+
+
+def run_stage(function, arguments, timeout, stage):
+    """Call function for each tuple of arguments concurrently
+
+    Input
+        function: Function to call
+        arguments: List of argument tuples, one per call
+        timeout: Number of seconds all calls must complete in
+        stage: Name of the stage used in error messages
+
+    Output
+        List of results in the order of arguments
+
+    Calls share the scratch workspace of the calling thread. The first
+    exception raised by a call is raised again. Calls still running on
+    timeout are cancelled, see run_in_threads: downloads stop at their
+    next chunk, other work runs to its end.
+    """
+
+    workspace = SCRATCH.current()
+
+    def call(item):
+        index, args = item
+        try:
+            with SCRATCH.use(workspace):
+                return index, function(*args)
+        finally:
+            # Database connections are per thread
+            connection.close()
+
+    results = [None] * len(arguments)
+    try:
+        for index, result in run_in_threads(call, list(enumerate(arguments)),
+                                            len(arguments), timeout=timeout):
+            results[index] = result
+    except TimeoutError:
+        msg = ('Stage %s of the calculation did not complete within %s '
+               'seconds' % (stage, timeout))
+        raise Exception(msg)
+
+    return results
+
+
+def find_memoized_calculation(calculation):
+    """Find a successful calculation with the same cache key
+
+    Input
+        calculation: Calculation with cache_key set and saved
+
+    Output
+        Finished Calculation whose result can be reused or None
+
+    If an identical calculation started earlier is still running, wait
+    for it to finish, so identical requests arriving together are
+    computed once. Waiting blocks the thread, so it ends once the running
+    calculation is older than SAFE_RESULT_WAIT_TIMEOUT or
+    SAFE_DOWNLOAD_TIMEOUT seconds, whichever is shorter. By then its
+    downloads alone would have timed out.
+    """
+
+    if not RESULT_CACHE_TIMEOUT:
+        return None
+
+    wait_timeout = min(RESULT_WAIT_TIMEOUT, DOWNLOAD_TIMEOUT)
+    while True:
+        now = datetime.datetime.now()
+        since = now - datetime.timedelta(seconds=RESULT_CACHE_TIMEOUT)
+        same = Calculation.objects.filter(cache_key=calculation.cache_key,
+                                          run_date__gte=since)
+        same = same.exclude(id=calculation.id)
+
+        finished = same.filter(status='finished', success=True)
+        for previous in finished.order_by('-run_date'):
+            if previous.result is None:
+                continue
+
+            # The impact layer may have been deleted in the meantime
+            typename = json.loads(previous.result)['layer']['id']
+            if Layer.objects.filter(typename=typename).exists():
+                return previous
+
+        # Calculations are only waited for by those started after them,
+        # and calculations that run for too long are not waited for
+        started = now - datetime.timedelta(seconds=wait_timeout)
+        running = same.filter(status='running', id__lt=calculation.id,
+                              run_date__gte=started)
+        if not running.exists():
+            return None
+
+        time.sleep(RESULT_POLL_INTERVAL)
+
+
+def calculation_output(calculation, impact_file, result):
+    """Build the API response of a successful calculation
+
+    Input
+        calculation: Finished Calculation instance
+        impact_file: Impact layer as returned by calculate_impact
+        result: GeoNode layer the impact was uploaded to
+
+    Output
+        Dictionary ready for json.dumps
+    """
+
+    output = dict(calculation.__dict__)
 
     # json.dumps does not like datetime objects,
     # let's make it a json string ourselves
@@ -254,19 +557,251 @@ def calculate(request, save_output=save_file_to_geonode):
                             'in %s' % calculation.run_duration
 
     # Delete _state and _user_cache item from the dict,
-    # they were created automatically by Django
-    del output['_user_cache']
-    del output['_state']
+    # they were created automatically by Django.
+    # The result is stored in the calculation itself.
+    for key in ['_user_cache', '_state', '_stage_started', 'result']:
+        output.pop(key, None)
 
     # If success == True and errors = '' ...
     # ... let's make errors=None for backwards compat
     if output['success'] and len(output['errors']) == 0:
         output['errors'] = None
 
+    return output
+
+
+def run_calculation(calculation_id, impact_function_name, requested_bbox,
+                    save_output=save_file_to_geonode):
+    """Execute a queued calculation, called by the worker pool
+    """
+
+    calculation = Calculation.objects.get(id=calculation_id)
+    execute_calculation(calculation, impact_function_name, requested_bbox,
+                        save_output=save_output)
+
+
+@csrf_exempt
+@metrics.timed('calculate')
+@profiled('calculate')
+def calculate(request, save_output=save_file_to_geonode):
+    """Run or queue a calculation
+
+       The calculation is queued and 202 is returned together with the id
+       of the calculation and the url where its status can be followed.
+       Post synchronous=true to wait for the calculation and get its
+       result right away instead.
+    """
+    start = datetime.datetime.now()
+
+    if request.method == 'GET':
+        # FIXME: Add a basic form here to be able to generate the POST request.
+        return HttpResponse('This should be accessed by robots, not humans.'
+                            'In other words using HTTP POST instead of GET.')
+    elif request.method == 'POST':
+        data = request.POST
+        impact_function_name = data['impact_function']
+        hazard_server = data['hazard_server']
+        hazard_layer = data['hazard']
+        exposure_server = data['exposure_server']
+        exposure_layer = data['exposure']
+        requested_bbox = data['bbox']
+        keywords = data['keywords']
+        synchronous = data.get('synchronous', '').lower() in ['true', '1']
+
+    if request.user.is_anonymous():
+        theuser = get_valid_user()
+    else:
+        theuser = request.user
+
+    # Create entry in database
+    calculation = Calculation(user=theuser,
+                              run_date=start,
+                              hazard_server=hazard_server,
+                              hazard_layer=hazard_layer,
+                              exposure_server=exposure_server,
+                              exposure_layer=exposure_layer,
+                              impact_function=impact_function_name,
+                              success=False)
+
+    # Link a profile of this request to the calculation, see profiled
+    request.calculation = calculation
+
+    if synchronous:
+        output = execute_calculation(calculation, impact_function_name,
+                                     requested_bbox, save_output=save_output)
+        jsondata = json.dumps(output)
+        return HttpResponse(jsondata, mimetype='application/json')
+
+    calculation.save()
+    try:
+        if jobs.QUEUE == 'database':
+            jobs.enqueue_job(calculation, requested_bbox)
+        else:
+            jobs.submit(run_calculation, calculation.id,
+                        impact_function_name, requested_bbox,
+                        save_output=save_output)
+    except jobs.QueueFull, e:
+        calculation.errors = str(e)
+        calculation.status = 'failed'
+        calculation.save()
+        jsondata = json.dumps({'errors': calculation.errors})
+        return HttpResponse(jsondata, mimetype='application/json', status=409)
+
+    output = {'id': calculation.id,
+              'status': calculation.status,
+              'status_url': reverse('safe-calculation',
+                                    args=[calculation.id])}
+    jsondata = json.dumps(output)
+    return HttpResponse(jsondata, mimetype='application/json', status=202)
+
+
+@csrf_exempt
+@metrics.timed('plan')
+def plan(request):
+    """Estimate the cost of a calculation without running it
+
+       Takes the hazard, hazard_server, exposure, exposure_server and bbox
+       parameters of calculate by GET or POST. Returns the bounding boxes
+       and raster resolution a calculation would use together with the
+       estimated pixels and bytes of each raster and the number of
+       features of each vector layer. Nothing is downloaded, so clients
+       can reject or downscale expensive requests before queueing them.
+
+       Invalid parameters are answered with status 400, other failures,
+       such as unreachable servers, with status 500.
+    """
+
+    if request.method == 'POST':
+        data = request.POST
+    else:
+        data = request.GET
+
+    missing = [key for key in ['hazard_server', 'hazard',
+                               'exposure_server', 'exposure', 'bbox']
+               if key not in data]
+    if missing:
+        jsondata = json.dumps({'errors': 'Missing parameters: %s' %
+                                         ', '.join(missing)})
+        return HttpResponse(jsondata, mimetype='application/json',
+                            status=400)
+
+    hazard_server = data['hazard_server']
+    hazard_layer = data['hazard']
+    exposure_server = data['exposure_server']
+    exposure_layer = data['exposure']
+
+    try:
+        planned = plan_layers(hazard_server, hazard_layer,
+                              exposure_server, exposure_layer, data['bbox'])
+        resolution = planned['resolution']
+
+        layers = run_stage(estimate_layer,
+                           [(hazard_server, hazard_layer,
+                             planned['hazard_bbox'],
+                             planned['hazard_metadata'], resolution),
+                            (exposure_server, exposure_layer,
+                             planned['exposure_bbox'],
+                             planned['exposure_metadata'], resolution)],
+                           METADATA_TIMEOUT, 'plan')
+    except Exception, e:
+        # Input is checked by assertions, anything else is our failure
+        if isinstance(e, AssertionError):
+            status = 400
+        else:
+            status = 500
+        output = {'errors': str(e), 'stacktrace': exception_format(e)}
+        jsondata = json.dumps(output)
+        return HttpResponse(jsondata, mimetype='application/json',
+                            status=status)
+
+    hazard, exposure = layers
+    raster_bytes = sum(layer.get('bytes', 0) for layer in layers)
+
+    if resolution is not None:
+        resolution = list(resolution)
+
+    output = {'hazard': hazard,
+              'exposure': exposure,
+              'bbox': bboxlist2string(planned['impact_bbox']),
+              'hazard_bbox': bboxlist2string(planned['hazard_bbox']),
+              'exposure_bbox': bboxlist2string(planned['exposure_bbox']),
+              'resolution': resolution,
+              'resolution_reason': planned['resolution_reason'],
+              'raster_bytes': raster_bytes,
+              'memory_budget': RASTER_MEMORY_BUDGET,
+              'errors': None}
+
+    jsondata = json.dumps(output)
+    return HttpResponse(jsondata, mimetype='application/json')
+
+
+def calculation_status(request, calculation_id):
+    """Get status of a calculation
+
+       Reports status (queued, running, finished or failed), the current
+       stage and progress between 0 and 1 together with the seconds spent
+       in each stage so far and the resources used. Once finished, result
+       holds the same output a synchronous calculation returns.
+
+       The stacktrace of failed calculations is only shown to the user
+       who started the calculation and to staff.
+    """
+
+    calculation = get_object_or_404(Calculation, id=calculation_id)
+
+    if request.user.is_staff or request.user == calculation.user:
+        stacktrace = calculation.stacktrace
+    else:
+        stacktrace = None
+
+    output = calculation_report(calculation)
+    output.update({'id': calculation.id,
+                   'run_duration': calculation.run_duration,
+                   'errors': calculation.errors or None,
+                   'stacktrace': stacktrace})
+
+    if calculation.status == 'finished':
+        output['result'] = json.loads(calculation.result)
+
     jsondata = json.dumps(output)
     return HttpResponse(jsondata, mimetype='application/json')
 
 
+@staff_member_required
+def profile(request, profile_id):
+    """Download a profile captured by profiled
+
+       The format GET parameter selects pstats (default), a file for
+       pstats.Stats and tools like snakeviz, collapsed, stacks for
+       flame graph tools, or text, the functions with the highest
+       cumulative time as printed by pstats.
+    """
+
+    profile = get_object_or_404(PerformanceProfile, id=profile_id)
+    format = request.GET.get('format', 'pstats')
+
+    if format == 'pstats':
+        response = HttpResponse(get_pstats(profile),
+                                mimetype='application/octet-stream')
+        response['Content-Disposition'] = ('attachment; filename='
+                                           'safe-profile-%i.prof' % profile.id)
+        return response
+    elif format == 'collapsed':
+        lines = collapse_stats(load_stats(profile))
+        return HttpResponse('\n'.join(lines) + '\n', mimetype='text/plain')
+    elif format == 'text':
+        stats = load_stats(profile)
+        stats.stream = StringIO()
+        stats.sort_stats('cumulative').print_stats(100)
+        return HttpResponse(stats.stream.getvalue(), mimetype='text/plain')
+    else:
+        jsondata = json.dumps({'errors': 'Unknown format %s, use pstats, '
+                                         'collapsed or text' % format})
+        return HttpResponse(jsondata, mimetype='application/json',
+                            status=400)
+
+
+@metrics.timed('debug')
 def debug(request):
     """Show a list of all the functions"""
     plugin_list = get_admissible_plugins()
@@ -285,12 +820,134 @@ def debug(request):
              'doc': f.__doc__,
             })
 
-    output = {'plugins': plugins_info}
+    output = {'plugins': plugins_info,
+              'cache': get_cache_stats()}
     jsondata = json.dumps(output)
     return HttpResponse(jsondata, mimetype='application/json')
 
 
+def keyword_signature(layer_metadata):
+    """Get the keywords impact functions select a layer by
+
+    Input
+        layer_metadata: Dictionary as returned by get_metadata
+
+    Output
+        Tuple of sorted (keyword, value) pairs including layertype.
+        Layers with the same signature are admissible for the same
+        impact functions.
+    """
+
+    keywords = dict(layer_metadata['keywords'])
+    keywords['layertype'] = layer_metadata['layertype']
+
+    return tuple(sorted((key, value) for key, value in keywords.items()
+                        if key not in DESCRIPTIVE_KEYWORDS))
+
+
+def build_questions(layers, plugin_lookup=get_admissible_plugins, bbox=None):
+    """Find hazard, exposure and impact function combinations
+
+    Input
+        layers: Dictionary of layer metadata by layer name
+        plugin_lookup: Function returning the admissible impact functions
+                       for a list of keyword dictionaries
+        bbox: Optional bounding box [W, S, E, N] of the area of interest
+
+    Output
+        List of dictionaries with keys hazard, exposure and function
+
+    Only pairs of layers whose bounding boxes overlap each other and
+    bbox, if given, are considered. Exposures overlapping a hazard are
+    found through a BoundingBoxIndex. plugin_lookup is called once for
+    each pair of hazard and exposure keyword signatures. Layers are not
+    modified.
+    """
+
+    hazards = []
+    exposures = []
+
+    # First get the list of all hazards and exposures
+    for name, params in layers.items():
+        category = params['keywords'].get('category')
+        if category == 'hazard':
+            hazards.append(name)
+        elif category == 'exposure':
+            exposures.append(name)
+
+    signatures = dict((name, keyword_signature(layers[name]))
+                      for name in hazards + exposures)
+    index = BoundingBoxIndex([(name, layers[name]['bounding_box'])
+                              for name in exposures])
+
+    # Areas where hazards may meet exposures
+    hazards.sort()
+    areas = [layers[name]['bounding_box'] for name in hazards]
+    if bbox is not None and hazards:
+        # Malformed boxes give empty intersections as well
+        areas, overlaps = bbox_intersections(areas, bbox)
+        hazards = [name for name, ok in zip(hazards, overlaps) if ok]
+        areas = areas[overlaps]
+
+    questions = []
+    admissible = {}
+
+    # Then find exposures overlapping each hazard and the functions
+    # for their signatures to make 3-tuples of hazard, exposure and function
+    for hazard, area in zip(hazards, areas):
+        for exposure in index.query(area):
+            key = (signatures[hazard], signatures[exposure])
+            if key not in admissible:
+                keywords = [dict(key[0]), dict(key[1])]
+                admissible[key] = plugin_lookup(keywords=keywords)
+
+            for function in admissible[key]:
+                questions.append({'hazard': hazard,
+                                  'exposure': exposure,
+                                  'function': function})
+
+    return questions
+
+
+def get_questions(layers, plugins, plugin_lookup=get_admissible_plugins,
+                  bbox=None):
+    """Get the output of the questions view
+
+    Input
+        layers: Dictionary of layer metadata by layer name
+        plugins: Dictionary of all impact functions by name
+        plugin_lookup: Function returning the admissible impact functions
+                       for a list of keyword dictionaries
+        bbox: Optional bounding box [W, S, E, N] of the area of interest
+
+    Output
+        Dictionary with keys layers, functions and questions. Layers are
+        restricted to those overlapping bbox, if given.
+    """
+
+    if bbox is not None:
+        index = BoundingBoxIndex([(name, params['bounding_box'])
+                                  for name, params in layers.items()])
+        layers = dict((name, layers[name]) for name in index.query(bbox))
+
+    functions = {}
+    for name, f in plugins.items():
+        functions[name] = {'doc': f.__doc__,
+                            }
+        for key in ['author', 'title', 'rating']:
+            if hasattr(f, key):
+                functions[name][key] = getattr(f, key)
+
+    output = {'layers': layers, 'functions': functions}
+    output['questions'] = build_questions(layers,
+                                          plugin_lookup=plugin_lookup,
+                                          bbox=bbox)
+    return output
+
+
 #@cache_page(60 * 15)
+@metrics.timed('questions')
+@profiled('questions')
 def questions(request):
     """Get a list of all the questions, layers and functions
 
@@ -300,8 +957,22 @@ def questions(request):
 
        e.g. http://127.0.0.1:8000/riab/api/v1/functions/?geoservers=http:...
        assumes version 1.0.0
+
+       An optional bbox parameter of the form W,S,E,N restricts layers
+       to those overlapping it and questions to hazards and exposures
+       that overlap each other within it.
     """
 
+    bbox = None
+    if 'bbox' in request.GET:
+        try:
+            check_bbox_string(request.GET['bbox'])
+        except AssertionError, e:
+            jsondata = json.dumps({'errors': str(e)})
+            return HttpResponse(jsondata, mimetype='application/json',
+                                status=400)
+        bbox = bboxstring2list(request.GET['bbox'])
+
     if 'geoservers' in request.GET:
         # FIXME for the moment assume version 1.0.0
         gs = request.GET['geoservers'].split(',')
@@ -310,51 +981,21 @@ def questions(request):
         geoservers = get_servers(request.user)
 
     layers = {}
-    functions = {}
-
     for geoserver in geoservers:
         layers.update(get_metadata(geoserver['url']))
 
-    admissible_plugins = get_admissible_plugins()
-    for name, f in admissible_plugins.items():
-        functions[name] = {'doc': f.__doc__,
-                            }
-        for key in ['author', 'title', 'rating']:
-            if hasattr(f, key):
-                functions[name][key] = getattr(f, key)
-
-    output = {'layers': layers, 'functions': functions}
-
-    hazards = []
-    exposures = []
-
-    # First get the list of all hazards and exposures
-    for name, params in layers.items():
-        keywords = params['keywords']
-        if 'category' in keywords:
-            if keywords['category'] == 'hazard':
-                hazards.append(name)
-            elif keywords['category'] == 'exposure':
-                exposures.append(name)
-
-    questions = []
-
-    # Then iterate over hazards and exposures to find 3-tuples of hazard, exposure and functions
-    for hazard in hazards:
-        for exposure in exposures:
-            hazard_keywords = layers[hazard]['keywords']
-            exposure_keywords = layers[exposure]['keywords']
-
-            hazard_keywords['layertype'] = layers[hazard]['layertype']
-            exposure_keywords['layertype'] = layers[exposure]['layertype']
+    output = get_questions(layers, get_admissible_plugins(), bbox=bbox)
+    jsondata = json.dumps(output)
+    return HttpResponse(jsondata, mimetype='application/json')
 
-            keywords = [hazard_keywords, exposure_keywords]
-            plugins = get_admissible_plugins(keywords=keywords)
 
-            for function in plugins:
-                questions.append({'hazard': hazard, 'exposure': exposure, 'function': function})
+def metrics_view(request):
+    """Get metrics of all processes in Prometheus text format
 
-    output['questions'] = questions
+       Covers requests to the API, requests to OWS servers, caches,
+       retries while uploading impact layers and running calculations,
+       see safe_geonode.metrics.
+    """
 
-    jsondata = json.dumps(output)
-    return HttpResponse(jsondata, mimetype='application/json')
+    return HttpResponse(metrics.render(),
+                        mimetype='text/plain; version=0.0.4; charset=utf-8')